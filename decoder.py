@@ -59,6 +59,8 @@ def valid_model(args, watcher, model, dev, dataflow=['src', 'trg'], print_out=Fa
         
         if args.multi_width > 1:
             info_str += ', speed-up={:.4f}, pred-len={:.4f}'.format(1 / (np.mean(outputs['saved_time'])), np.mean(outputs['pred_acc']) * args.multi_width)
+        if 'exit_depth' in outputs:
+            info_str += ', layers={:.2f}'.format(np.mean(outputs['exit_depth']))
 
         watcher.step_progress_bar(info_str=info_str, step=sum(dev_outputs['sents']))    
         used_t = time.time() - start_t
@@ -70,6 +72,11 @@ def valid_model(args, watcher, model, dev, dataflow=['src', 'trg'], print_out=Fa
         outputs['pred_len'] = np.mean(outputs['pred_acc']) * args.multi_width
         outputs['tb_data'] += [('dev/SPEEDUP', outputs['speed_up']), ('dev/PREDLEN', outputs['pred_len'])]
 
+    if 'exit_depth' in outputs:   # greedy decoding only; beam search and multi_width have no early exit
+        outputs['exit_depth'] = np.mean(outputs['exit_depth'])
+        outputs['tb_data'] += [('dev/EXITDEPTH', outputs['exit_depth'])]
+        watcher.info('early exit: {:.2f} decoder layers per token on average'.format(outputs['exit_depth']))
+
     # tokenize + segmentation
     sources = src_segmenter([src_tokenizer(i) for i in outputs['src']])
     decodes = segmenter([tokenizer(o) for o in outputs['dec']])
@@ -95,6 +102,12 @@ def valid_model(args, watcher, model, dev, dataflow=['src', 'trg'], print_out=Fa
             print(t, file=handles[1], flush=True)
             print(d, file=handles[2], flush=True)
 
+        if 'n_best' in outputs:   # beam search (--n_best): "sentence ||| translation ||| score", in the order above
+            with open(os.path.join(decoding_path, names[2].replace('.dec.', '.nbest.')), 'w') as handle:
+                for i, (s, hypotheses) in enumerate(sorted(zip(outputs['src'], outputs['n_best']), key=lambda a: a[0])):
+                    for d, score in hypotheses:
+                        print('{} ||| {} ||| {:.4f}'.format(i, ' '.join(segmenter([tokenizer(d)])[0]), score), file=handle, flush=True)
+
     # clean cached memory
     torch.cuda.empty_cache()
 
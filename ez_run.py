@@ -16,12 +16,13 @@ from time import gmtime, strftime
 from learner import train_model, train_autoencoder
 from decoder import valid_model
 
-from models.core import INF, TINY, softmax
+from models.core import INF, TINY, softmax, upgrade_state_dict, quantize_int8, load_lexical_table, Shortlist, \
+    head_importance, prune_heads, prune_as, group_as
 from models.transformer import Transformer
 from models.transformer_vae import AutoTransformer, AutoTransformer2
 
 from data_loader import MultiDataLoader
-from utils import Watcher
+from utils import Watcher, Timer
 from torch.nn.parallel.distributed import DistributedDataParallel as DDP
 
 
@@ -49,7 +50,10 @@ parser.add_argument('--test_set', type=str, default=None,  help='which test set
 parser.add_argument('--multi', action='store_true', help='enable multilingual training for Transformer.')
 parser.add_argument('--sample_prob', nargs='*', type=float, help='probabilities of each input dataset.')
 parser.add_argument('--input_conv', type=int, default=0, help='adding additional convolution in the first layer for byte level..')
+parser.add_argument('--downsample', type=int, default=1, help='strided convolution over the source embeddings (byte level): the encoder runs over 1/K of the positions')
 parser.add_argument('--local_attention', type=int, default=0, help='force to use local attention for the first K layers.')
+parser.add_argument('--local_window', type=int, default=2, help='local attention only attends to positions |i - j| <= local_window.')
+parser.add_argument('--attention_chunk', type=int, default=0, help='memory-efficient attention over blocks of K queries/keys (0: full attention).')
 
 # character/byte-level Transformer
 parser.add_argument('--base', type=str, default='bpe', choices=['byte', 'char', 'bpe', 'word'])
@@ -78,18 +82,27 @@ parser.add_argument('--d_model',  type=int, default=512,   help='basic parameter
 parser.add_argument('--d_hidden', type=int, default=2048,  help='used in feedforward network')
 parser.add_argument('--warmup',   type=int, default=4000,  help='warming-up steps during training')
 parser.add_argument('--n_layers', type=int, default=6,     help='number of encoder-decoder')
+parser.add_argument('--n_enc_layers', type=int, default=None, help='number of encoder layers (default: n_layers)')
+parser.add_argument('--n_dec_layers', type=int, default=None, help='number of decoder layers (default: n_layers); the decoding latency grows with it')
 parser.add_argument('--n_heads',  type=int, default=8,     help='number of heads for multi-head attention')
 parser.add_argument('--n_cross_heads', type=int, default=8,  help='number of heads for multi-head attention')
+parser.add_argument('--n_kv_heads', type=int, default=None, help='grouped-query attention in the decoder: number of key / value heads (default: all); a multi-head checkpoint is converted when loaded')
 parser.add_argument('--drop_ratio', type=float, default=0.1, help='dropout ratio')
 
 # model ablation settings
 parser.add_argument('--block_order', type=str, default='tdan', choices=['tdan', 'tdna', 'tnda'])
+parser.add_argument('--dec_selfattn', type=str, default='multihead', choices=['multihead', 'average'], help='decoder self-attention; average: cumulative average + gates, constant time per decoding step (greedy)')
+parser.add_argument('--layernorm', type=str, default='std', choices=['std', 'fused'], help='std: (x - mean) / (std + eps) as in the existing checkpoints; fused: native layer norm, and dropout + residual add as one op (tdan, tnda)')
 parser.add_argument('--normalize_emb', action='store_true', help='normalize embedding (IO)')
 parser.add_argument('--causal_enc', action='store_true', help='use unidirectional encoder (useful for real-time translation)')
 parser.add_argument('--encoder_lm', action='store_true', help='use unidirectional encoder with additional loss as a LM')
 parser.add_argument('--causal',   action='store_true', help='use causal attention')
 parser.add_argument('--cross_attn_fashion', type=str, default='forward', choices=['forward', 'reverse', 'last_layer'])
 parser.add_argument('--share_embeddings', action='store_true', help='share embeddings between encoder and decoder')
+parser.add_argument('--reversible_encoder', action='store_true', help='reversible (pre-norm) encoder layers: constant activation memory in depth, requires --cross_attn_fashion last_layer')
+parser.add_argument('--adaptive_softmax', action='store_true', help='use a frequency-clustered adaptive softmax as the decoder output layer')
+parser.add_argument('--adaptive_coverage', type=float, nargs='*', default=[0.8, 0.95], help='adaptive softmax: token coverage of the head and of each cluster')
+parser.add_argument('--adaptive_div', type=int, default=4, help='adaptive softmax: dimension reduction of each following cluster')
 parser.add_argument('--relative_pos', action='store_true', help="""
                                                                 use relative position in the attention, instead of positional encoding.
                                                                 currently supports the simplest case: left (0), self(1), right(2)
@@ -103,16 +116,21 @@ parser.add_argument('--exact_match', action='store_true', help='match with the 1
 parser.add_argument('--constant_penalty', type=float, default=0)
 
 # running setting
-parser.add_argument('--mode',    type=str, default='train',  help='train, test or data')  # "data": preprocessing and save vocabulary
+parser.add_argument('--mode',    type=str, default='train',  help='train, test, quantize, shortlist, prune or data')  # "data": preprocessing and save vocabulary
+parser.add_argument('--quantized', action='store_true', help='load an int8 model saved by --mode quantize (CPU inference)')
 parser.add_argument('--seed',    type=int, default=19920206, help='seed for randomness')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16: mixed-precision (autocast) training and decoding')
 
 # training
 parser.add_argument('--label_smooth',  type=float, default=0.1,   help='regularization via label-smoothing during training.')
+parser.add_argument('--exit_loss',     type=float, default=0,     help='early exit: weight of the (averaged) losses of the intermediate decoder layers.')
+parser.add_argument('--loss_chunk',    type=int, default=0,       help='compute the loss over slices of K target tokens, recomputed in backward (0: all at once).')
 parser.add_argument('--eval_every',    type=int, default=1000,    help='run dev every')
 parser.add_argument('--att_plot_every',type=int, default=250,     help='visualization the attention matrix of a sampled training set.')
 parser.add_argument('--save_every',    type=int, default=50000,   help='save the best checkpoint every 50k updates')
 parser.add_argument('--maximum_steps', type=int, default=1000000, help='maximum steps you take to train a model')
 parser.add_argument('--inter_size',    type=int, default=4,       help='process multiple batches before one update')
+parser.add_argument('--checkpoint_every', type=int, default=0,    help='recompute every k-th block in backward instead of storing its activations (0: store everything)')
 parser.add_argument('--batch_size',    type=int, default=2048,    help='# of tokens processed per batch')
 parser.add_argument('--maxlen',        type=int, default=10000,   help='limit the train set sentences to this many tokens')
 parser.add_argument('--maxatt_size',   type=int, default=2200000, help= """
@@ -126,7 +144,14 @@ parser.add_argument('--disable_lr_schedule', action='store_true', help='disable
 # decoding
 parser.add_argument('--length_ratio',  type=int,   default=6, help='maximum lengths of decoding')
 parser.add_argument('--beam_size',     type=int,   default=1, help='beam-size used in Beamsearch, default using greedy decoding')
+parser.add_argument('--jit_decoder',   type=str,   default='none', choices=['none', 'eager', 'script', 'compile'], help='greedy decoding with a single-step decoder module (cached keys/values), optionally scripted or compiled')
 parser.add_argument('--alpha',         type=float, default=1, help='length normalization weights')
+parser.add_argument('--n_best',        type=int,   default=1, help='beam search: also output the n best translations with their scores (.nbest file)')
+parser.add_argument('--exit_threshold', type=float, default=1.0, help='early exit: stop at the first decoder layer whose prediction is more confident than this (greedy decoding; 1: off)')
+parser.add_argument('--shortlist',     type=str,   default=None, help='lexical table of fast_align (-p): decode over a vocabulary shortlist')
+parser.add_argument('--shortlist_k',   type=int,   default=10, help='shortlist: top-k target words per source word')
+parser.add_argument('--shortlist_frequent', type=int, default=1000, help='shortlist: the most frequent target words always included')
+parser.add_argument('--prune_ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75], help='--mode prune: ratios of the attention heads removed')
 parser.add_argument('--original',      action='store_true', help='output the original output files, not the tokenized ones.')
 parser.add_argument('--decode_test',   action='store_true', help='evaluate scores on test set instead of using dev set.')
 
@@ -198,6 +223,7 @@ hp_str = (  f".{args.dataset}_{args.params}_"
             f"{'causal_' if args.causal_enc else ''}"
             f"{'rp_' if args.relative_pos else ''}"
             f"{'lm_' if args.encoder_lm else ''}"
+            f"{'aan_' if args.dec_selfattn == 'average' else ''}"
             f"{args.base}_"
             f"{args.label_smooth}_"
             f"{args.inter_size*args.batch_size*args.world_size}_"
@@ -225,9 +251,12 @@ else:
 
 # special for Pytorch 0.4
 args.device = "cuda:{}".format(args.local_rank) 
+if (args.mode == 'quantize') or args.quantized:  # int8 models run on CPU
+    args.device = 'cpu'
 
 # setup multi-gpu
-torch.cuda.set_device(args.local_rank)
+if args.device != 'cpu':
+    torch.cuda.set_device(args.local_rank)
 if args.distributed:
     torch.distributed.init_process_group(backend='nccl', init_method='env://')
 
@@ -252,6 +281,15 @@ dataloader = MultiDataLoader(args, watcher, vocab_file=args.vocab_file)
 
 # build the model
 model = eval(args.model)(dataloader.SRC, dataloader.TRG, args)  # build the model either Transformer or AutoEncoder.
+
+# a pruned checkpoint has fewer attention heads: shrink the model before counting / quantizing / loading;
+# a multi-head checkpoint for grouped-query attention (--n_kv_heads): average its key / value heads
+pretrained_dict = None
+if args.load_from != 'none':
+    pretrained_dict = upgrade_state_dict(torch.load(
+        os.path.join(args.workspace_prefix, 'models', args.load_from + '.pt'), map_location='cpu'))
+    prune_as(model, pretrained_dict)
+    group_as(model, pretrained_dict)
 watcher.info(model)
 
 def count_parameters(model):
@@ -260,24 +298,31 @@ watcher.info("total trainable parameters: {}".format(format(count_parameters(mod
 watcher.info("Vocabulary size: {}/{}.".format(len(dataloader.SRC.vocab), len(dataloader.TRG.vocab)))
 
 # use GPU 
-if torch.cuda.is_available():
+if args.quantized:
+    model = quantize_int8(model)
+elif torch.cuda.is_available() and (args.device != 'cpu'):
     model.cuda()
 
 if args.distributed:
     model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank)
 
 # load pre-trained parameters
-if args.load_from != 'none':
-    with torch.cuda.device(args.local_rank):
-        pretrained_dict = torch.load(
-            os.path.join(args.workspace_prefix, 'models', args.load_from + '.pt'),
-            map_location=lambda storage, loc: storage.cuda())
-        model_dict = model.state_dict()
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-        model_dict.update(pretrained_dict) 
-        model.load_state_dict(model_dict)
-
-decoding_path = os.path.join(args.workspace_prefix, 'decodes', args.load_from if args.mode == 'test' else (args.prefix + hp_str))
+if pretrained_dict is not None:
+    model_dict = model.state_dict()
+    pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
+    model_dict.update(pretrained_dict) 
+    model.load_state_dict(model_dict)
+
+# vocabulary shortlist for decoding
+shortlist = None
+if args.shortlist is not None:
+    assert (args.model == 'Transformer') and (not args.adaptive_softmax) and (args.multi_width == 1), 'the shortlist needs the full softmax (IO).'
+    shortlist = Shortlist(load_lexical_table(args.shortlist, dataloader.SRC.vocab, dataloader.TRG.vocab, args.shortlist_k),
+                          dataloader.TRG.vocab, min(args.shortlist_frequent, len(dataloader.TRG.vocab)))
+    if args.mode != 'shortlist':
+        model.shortlist = shortlist
+
+decoding_path = os.path.join(args.workspace_prefix, 'decodes', args.load_from if args.mode in ['test', 'quantize', 'shortlist', 'prune'] else (args.prefix + hp_str))
 if (args.local_rank == 0) and (not os.path.exists(decoding_path)):
     os.mkdir(decoding_path)
 
@@ -302,5 +347,72 @@ elif args.mode == 'test':
             valid_model(args, watcher, model, test_set, decoding_path=decoding_path, names=names, dataflow=['trg', 'trg'])
         else:
             valid_model(args, watcher, model, test_set, decoding_path=decoding_path, names=names)
+        if shortlist is not None:
+            watcher.info('shortlist: {:.1f} words on average out of {}'.format(sum(shortlist.sizes) / len(shortlist.sizes), len(dataloader.TRG.vocab)))
+
+elif args.mode == 'quantize':
+    watcher.info('int8 dynamic quantization of the pre-trained model (CPU inference)...')
+    assert args.load_from != 'none', 'must quantize a pre-trained model.'
+    with torch.no_grad():
+        test_set = (dataloader.test if args.decode_test else dataloader.dev)[0]  # the first language pair
+        results = dict()
+        for precision in ['fp32', 'int8']:
+            if precision == 'int8':
+                getattr(model, 'decoder_steps', dict()).clear()   # built from the float projections
+                model = quantize_int8(model)
+                torch.save(model.state_dict(), os.path.join(args.workspace_prefix, 'models', args.load_from + '.int8.pt'))
+                watcher.info('saved the int8 model: {}.int8.pt (decode it with --quantized)'.format(args.load_from))
+
+            with Timer() as timer:
+                outputs = valid_model(args, watcher, model, test_set)
+            results[precision] = (outputs['corpus_bleu'], sum(outputs['sents']) / timer.elapsed_secs)
+            watcher.info('{}: BLEU={:.3f}, speed={:.2f} sents/s'.format(precision, *results[precision]))
+
+        watcher.info('int8 v.s. fp32: BLEU delta={:.3f}, speed-up={:.2f}x'.format(
+                     results['int8'][0] - results['fp32'][0], results['int8'][1] / results['fp32'][1]))
+
+elif args.mode == 'shortlist':
+    watcher.info('decoding over the full vocabulary v.s. the shortlist...')
+    assert args.load_from != 'none', 'must decode from a pre-trained model.'
+    assert shortlist is not None, 'a lexical table is needed (--shortlist).'
+    with torch.no_grad():
+        test_set = (dataloader.test if args.decode_test else dataloader.dev)[0]  # the first language pair
+        results = dict()
+        for vocab in ['full', 'shortlist']:
+            model.shortlist = shortlist if vocab == 'shortlist' else None
+            with Timer() as timer:
+                outputs = valid_model(args, watcher, model, test_set)
+            results[vocab] = (outputs['corpus_bleu'], sum(outputs['sents']) / timer.elapsed_secs)
+            watcher.info('{}: BLEU={:.3f}, speed={:.2f} sents/s'.format(vocab, *results[vocab]))
+
+        watcher.info('shortlist: {:.1f} words on average ({} at most) out of {}'.format(
+                     sum(shortlist.sizes) / len(shortlist.sizes), max(shortlist.sizes), len(dataloader.TRG.vocab)))
+        watcher.info('shortlist v.s. full: BLEU delta={:.3f}, speed-up={:.2f}x'.format(
+                     results['shortlist'][0] - results['full'][0], results['shortlist'][1] / results['full'][1]))
+
+elif args.mode == 'prune':
+    watcher.info('pruning the attention heads of the pre-trained model by importance...')
+    assert args.load_from != 'none', 'must prune a pre-trained model.'
+    test_set = (dataloader.test if args.decode_test else dataloader.dev)[0]  # the first language pair
+    importance = head_importance(model, test_set)
+    with torch.no_grad():
+        results = dict()
+        for ratio in [0] + args.prune_ratios:
+            pruned = model
+            if ratio > 0:
+                getattr(model, 'decoder_steps', dict()).clear()   # built from the unpruned projections
+                pruned = copy.deepcopy(model)
+                heads = prune_heads(pruned, importance, ratio)
+                torch.save(pruned.state_dict(), os.path.join(args.workspace_prefix, 'models', '{}.pruned{}.pt'.format(args.load_from, ratio)))
+                watcher.info('saved the pruned model: {}.pruned{}.pt ({} heads left; {:,} parameters)'.format(
+                             args.load_from, ratio, sum(heads.values()), count_parameters(pruned)))
+
+            with Timer() as timer:
+                outputs = valid_model(args, watcher, pruned, test_set)
+            results[ratio] = (outputs['corpus_bleu'], sum(outputs['sents']) / timer.elapsed_secs)
+            watcher.info('pruned {}: BLEU={:.3f}, speed={:.2f} sents/s'.format(ratio, *results[ratio]))
+
+        watcher.info('heads pruned v.s. BLEU delta / speed-up: ' + ', '.join('{}: {:.3f} / {:.2f}x'.format(
+                     ratio, results[ratio][0] - results[0][0], results[ratio][1] / results[0][1]) for ratio in args.prune_ratios))
 
 watcher.info("done.")
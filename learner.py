@@ -8,6 +8,7 @@ from torch.autograd import Variable
 from tqdm import tqdm, trange
 from utils import *
 from decoder import valid_model
+from models.core import capture_attention, collect_attention
 
 import torch.distributed as dist
 
@@ -125,6 +126,7 @@ def train_model(args, watcher, model, train, dev, save_path=None, maxsteps=None,
             info_str = 'training step = {}, lr={:.7f}, '.format(iters, opt.param_groups[0]['lr'])
             info = defaultdict(lambda:[])
             pairs = []
+            attention_maps = []
 
             # prepare the data
             for inter_step in range(args.inter_size):
@@ -141,11 +143,15 @@ def train_model(args, watcher, model, train, dev, save_path=None, maxsteps=None,
                 else:
                     batch = sample_a_training_set(train, args.sample_prob)
 
-                # --- attention visualization --- #
-                if (check(args.att_plot_every, 1) and (inter_step == 0) and (args.local_rank == 0)):
-                    model.module.attention_flag = True
+                # --- attention visualization (one sentence, one head of every attention) --- #
+                plot_attention = check(args.att_plot_every, 1) and (inter_step == 0) and (args.local_rank == 0) \
+                                 and args.tensorboard and (not args.debug)
+                if plot_attention:
+                    capture_attention(model.module, row=0, head=0)
 
                 info_ = model(batch, dataflow=['src', 'trg'])
+                if plot_attention:
+                    attention_maps = collect_attention(model.module)
                 info_['loss'] = info_['loss'] / args.inter_size
                 info_['loss'].backward()
 
@@ -176,12 +182,13 @@ def train_model(args, watcher, model, train, dev, save_path=None, maxsteps=None,
                     watcher.add_tensorboard('train/{}'.format(keyword), info[keyword] / args.world_size / args.inter_size, iters)
                     
                     # -- attention visualization -- #
-                    if (model.module.attention_maps is not None) and (args.local_rank == 0):
+                    if (len(attention_maps) > 0) and (args.local_rank == 0):
                         watcher.info('Attention visualization at Tensorboard')
                         with Timer() as visualization_timer:
-                            for name, value in model.module.attention_maps:
-                                watcher.add_tensorboard(name, value, iters, 'figure')
-                            model.module.attention_maps = None
+                            for name, value in attention_maps:
+                                figure = visualize_attention([''] * value.size(1), [''] * value.size(0), value.numpy())
+                                watcher.add_tensorboard(name, figure, iters, 'figure')
+                            attention_maps = []
                         watcher.info('Attention visualization cost: {}s'.format(visualization_timer.elapsed_secs))
 
         watcher.step_progress_bar(info_str=info_str)
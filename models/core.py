@@ -1,13 +1,17 @@
 import torch
 import math
 import copy
+import contextlib
+import heapq
 
 from collections import defaultdict
+from typing import List, Optional
 from abc import ABCMeta, abstractmethod
 from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Variable, Function
 from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
+from torch.utils.checkpoint import checkpoint
 from utils import computeGLEU, masked_sort, unsorted, colored_seq
 
 INF = 1e10
@@ -52,6 +56,53 @@ def positional_encodings_like(x, t=None):   # hope to be differentiable
 
     return encodings
 
+def sinusoid_table(T, d_model, device=None):
+    # the same (interleaved sin/cos) encodings as positional_encodings_like, for positions 0 ... T-1
+    positions = torch.arange(0, T, device=device).float()
+    channels = torch.arange(0, d_model, 2, device=device).float() / d_model
+    channels = 1 / (10000 ** channels)
+
+    encodings = positions.unsqueeze(-1) @ channels.unsqueeze(0)  # T x 256
+    encodings = torch.cat([torch.sin(encodings).unsqueeze(-1), torch.cos(encodings).unsqueeze(-1)], -1)
+    return encodings.contiguous().view(T, -1)                    # T x 512
+
+_mask_cache = dict()
+
+def cached_mask(T, device, dtype=torch.float, window=None):
+    """
+    T x T attention masks (INF on the masked positions), built once per device and sliced afterwards.
+    window=None gives the causal mask, otherwise the local mask keeping |i - j| <= window.
+    """
+    key = (window, device, dtype)
+    mask = _mask_cache.get(key, None)
+    if (mask is None) or (mask.size(0) < T):
+        size = 64 if mask is None else mask.size(0)
+        while size < T:
+            size *= 2
+
+        ones = torch.ones(size, size, device=device, dtype=dtype)
+        if window is None:
+            mask = ones.triu(1) * INF
+        else:
+            mask = (ones.triu(window + 1) + ones.tril(-window - 1)) * INF
+        _mask_cache[key] = mask
+    return mask[:T, :T]
+
+def grow(buffer, size, limit, dim=1):
+    """
+    decoding state buffers start small and are doubled (up to limit) when they need to hold `size` steps.
+    """
+    if buffer.size(dim) >= size:
+        return buffer
+    capacity = buffer.size(dim)
+    while capacity < size:
+        capacity *= 2
+    shape = list(buffer.size())
+    shape[dim] = min(capacity, limit)
+    new_buffer = buffer.new_zeros(shape)
+    new_buffer.narrow(dim, 0, buffer.size(dim)).copy_(buffer)
+    return new_buffer
+
 def linear_wn(in_features, out_features, dropout=0):
     """Weight-normalized Linear layer (input: N x T x C)"""
     m = Linear(in_features, out_features)
@@ -86,12 +137,16 @@ def demask(inputs, the_mask):
     outputs[indices] = inputs
     return outputs.view(*the_mask.size())
 
+# reduced precision (bfloat16 under autocast) --> float32; float32/float64 are kept
+def upcast(x):
+    return x.to(torch.promote_types(x.dtype, torch.float))
+
 # F.softmax has strange default behavior, normalizing over dim 0 for 3D inputs
 def softmax(x):
-    return F.softmax(x, dim=-1)
+    return F.softmax(upcast(x), dim=-1)
 
 def log_softmax(x):
-    return F.log_softmax(x, dim=-1)
+    return F.log_softmax(upcast(x), dim=-1)
 
 def logsumexp(x, dim=-1):
     x_max = x.max(dim, keepdim=True)[0]
@@ -120,18 +175,119 @@ def cross_entropy_with_smooth(outputs, targets, label_smooth=0.1, reweight=None)
         nll_loss = (F.nll_loss(logits, targets, reduction='none') * reweight).mean()
         return nll_loss * (1 - label_smooth) - logits.mean() * label_smooth
 
+def chunked_cross_entropy_with_smooth(project, inputs, targets, label_smooth=0.1, chunk=4096):
+    """
+    the same loss as cross_entropy_with_smooth(project(inputs), targets), computed over slices of the tokens.
+    Only the logits of one slice are alive at a time; in training they are recomputed in backward.
+    """
+    def slice_loss(x, y):
+        logits = log_softmax(project(x))
+        return F.nll_loss(logits, y, reduction='sum') * (1 - label_smooth) - logits.mean(-1).sum() * label_smooth
+
+    loss = 0
+    for s in range(0, targets.size(0), chunk):
+        x, y = inputs[s: s + chunk], targets[s: s + chunk]
+        if torch.is_grad_enabled() and x.requires_grad:
+            loss = loss + checkpoint(slice_loss, x, y, use_reentrant=False)
+        else:
+            loss = loss + slice_loss(x, y)
+    return loss / targets.size(0)
+
 def shift(x, n, right = False, value=0):
+    """
+    new_x[:, t, i] = x[:, t + i, i] (left) or x[:, t - i, i] (right), filled with value out of the sequence.
+    A single copy through the diagonal (strided) view of a padded tensor.
+    """
     if x.dim() == 2:
         x = x.unsqueeze(-1).expand(*x.size()[:2], n)
-    new_x = x.new_zeros(*x.size()) + value
-    new_x[:, :, 0] = x[:, :, 0]
+    B, T = x.size(0), x.size(1)
+    padded = x.new_full((B, T + n - 1, n), value)
+    diagonal = padded.as_strided((B, T, n), (padded.stride(0), padded.stride(1), padded.stride(1) + padded.stride(2)))
+    if right:
+        diagonal.copy_(x)
+        return padded[:, :T].contiguous()
+    padded[:, :T] = x
+    return diagonal.contiguous()
+
+def chunked_attention(query, key, value, mask=None, causal=False, window=None, scale=1, dropout=None, chunk=128):
+    """
+    Memory-efficient attention: queries and keys are processed block by block with an online softmax,
+    so the full (Tq x Tk) score matrix is never stored. In training every query block is recomputed
+    in backward (checkpointing), which keeps the activation memory linear in the sequence length.
+    query: (B x n) x Tq x d, key/value: (B x n) x Tk x d, mask: (B x n) x Tk or (B x n) x Tq x Tk
+    """
+    Tq, Tk = query.size(1), key.size(1)
+    offset = Tk - Tq    # causal attention may work on non-square attention.
+
+    def attend(q, key, value, mask, qs):
+        qe = qs + q.size(1)
+        dtype = torch.promote_types(q.dtype, torch.float)
+        m = q.new_full((q.size(0), q.size(1), 1), -float('inf'), dtype=dtype)   # running max
+        l = q.new_zeros(q.size(0), q.size(1), 1, dtype=dtype)                   # running normalizer
+        o = q.new_zeros(q.size(0), q.size(1), value.size(-1), dtype=dtype)      # running outputs
+
+        for ks in range(0, Tk, chunk):
+            ke = min(ks + chunk, Tk)
+            if causal and (ks > qe - 1 + offset):             # the remaining keys are all in the future.
+                break
+            if (window is not None) and ((ke - 1 < qs + offset - window) or (ks > qe - 1 + offset + window)):
+                continue                                      # out of the local window.
+
+            dot_products = upcast(q @ key[:, ks: ke].transpose(1, 2))   # masks in float32
+            if causal:
+                dot_products = dot_products - cached_mask(Tk, key.device, dot_products.dtype)[qs + offset: qe + offset, ks: ke]
+            if window is not None:
+                dot_products = dot_products - cached_mask(Tk, key.device, dot_products.dtype, window=window)[qs + offset: qe + offset, ks: ke]
+            if mask is not None:
+                if mask.dim() == 2:
+                    dot_products = dot_products - (1 - mask[:, None, ks: ke]) * INF
+                else:
+                    dot_products = dot_products - (1 - mask[:, :, ks: ke]) * INF
+
+            logits = dot_products / scale
+            m_new = torch.max(m, logits.max(-1, keepdim=True)[0])
+            probs = torch.exp(logits - m_new)
+            decay = torch.exp(m - m_new)
+
+            l = l * decay + probs.sum(-1, keepdim=True)       # dropout is only applied to the numerator
+            o = o * decay + (dropout(probs) if dropout is not None else probs) @ value[:, ks: ke]
+            m = m_new
+        return o / l
+
+    outputs = []
+    for qs in range(0, Tq, chunk):
+        q = query[:, qs: qs + chunk]
+        q_mask = mask if (mask is None) or (mask.dim() == 2) else mask[:, qs: qs + chunk]
 
-    for i in range(1, n):
-        if not right:
-            new_x[:, :-i, i] = x[:, i:, i]
+        if torch.is_grad_enabled() and any(x.requires_grad for x in (q, key, value)):
+            outputs.append(checkpoint(attend, q, key, value, q_mask, qs, use_reentrant=False))
         else:
-            new_x[:, i:, i] = x[:, :-i, i]
-    return new_x
+            outputs.append(attend(q, key, value, q_mask, qs))
+    return torch.cat(outputs, 1)
+
+def local_attention(query, key, value, mask=None, causal=False, window=2, scale=1, dropout=None):
+    """
+    Sliding-window attention: query i only attends to the keys |i - j| <= window, and only
+    these T x (2 x window + 1) scores are computed (O(T x window) time and memory).
+    query/key/value: (B x n) x T x d, mask: (B x n) x T
+    """
+    W = 2 * window + 1
+    key = F.pad(key, (0, 0, window, window)).unfold(1, W, 1)      # (B x n) x T x d x W (a view)
+    value = F.pad(value, (0, 0, window, window)).unfold(1, W, 1)  # (B x n) x T x d x W (a view)
+    if mask is None:
+        mask = query.new_ones(query.size(0), query.size(1))
+    mask = F.pad(mask, (window, window)).unfold(1, W, 1)          # (B x n) x T x W, out of the sequence --> 0
+
+    dot_products = upcast((query.unsqueeze(-2) @ key).squeeze(-2))  # (B x n) x T x W, masks in float32
+    dot_products = dot_products - (1 - mask) * INF
+    if causal:
+        future = (torch.arange(W, device=query.device) > window).type_as(dot_products)
+        dot_products = dot_products - future * INF
+
+    probs = softmax(dot_products / scale)
+    if dropout is not None:
+        probs = dropout(probs)
+    return (probs.unsqueeze(-2) @ value.transpose(-1, -2)).squeeze(-2)
 
 # torch.matmul can't do (4, 3, 2) @ (4, 2) -> (4, 3)
 def matmul(x, y):
@@ -203,6 +359,37 @@ def topK_search(logits, mask_src, N=100):
     return output, mask_src
 
 
+class PositionalEncoding(nn.Module):
+    """
+    Sinusoidal position table, computed once and grown (doubled) when a longer sequence comes.
+    Returns the same encodings as positional_encodings_like.
+    """
+    def __init__(self, d_model, max_len=256):
+        super().__init__()
+        self.d_model = d_model
+        self.register_buffer('table', sinusoid_table(max_len, d_model), persistent=False)
+
+    def extend(self, T):
+        if T > self.table.size(0):
+            size = self.table.size(0)
+            while size < T:
+                size *= 2
+            self.table = sinusoid_table(size, self.d_model, device=self.table.device)
+
+    def prefix(self, T):  # T x d_model, a view of the table
+        self.extend(T)
+        return self.table[:T]
+
+    def forward(self, x, t=None):
+        if t is None:
+            self.extend(x.size(-2))
+            return self.table[:x.size(-2)].type_as(x).expand_as(x)
+
+        t = t.long()
+        self.extend(t.max().item() + 1)
+        return self.table[t].type_as(x)
+
+
 class Linear(nn.Linear):
     def forward(self, x):
         size = x.size()
@@ -210,48 +397,87 @@ class Linear(nn.Linear):
             x.contiguous().view(-1, size[-1])).view(*size[:-1], -1)
 
 
-class LayerNorm(nn.Module):
+def layer_norm(x, gamma, beta, eps: float, fused: bool):   # LayerNorm as a function (TorchScript-able)
+    if fused:
+        return F.layer_norm(x, [x.size(-1)], gamma, beta, eps)
+    mean = x.mean(-1, keepdim=True)
+    return gamma * (x - mean) / (x.std(-1, keepdim=True) + eps) + beta
+
 
-    def __init__(self, d_model, eps=1e-6):
+def dropout_add(x, y, p: float, training: bool):   # x + dropout(y) in one pass: the scaled mask is applied by addcmul
+    if (not training) or (p == 0):
+        return x + y
+    mask = torch.empty_like(y).bernoulli_(1 - p)
+    return torch.addcmul(x, y, mask, value=1 / (1 - p))
+
+
+class LayerNorm(nn.Module):
+    """
+    fused=False (default): gamma * (x - mean) / (std + eps) + beta, with the unbiased std -- the numerics of
+    the existing checkpoints. fused=True: the native layer norm (biased variance, eps inside the sqrt).
+    """
+    def __init__(self, d_model, eps=1e-6, fused=False):
         super().__init__()
         self.gamma = nn.Parameter(torch.ones(d_model))
         self.beta = nn.Parameter(torch.zeros(d_model))
         self.eps = eps
+        self.fused = fused
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.gamma * (x - mean) / (std + self.eps) + self.beta
+        x = upcast(x)   # statistics in float32 (bfloat16 autocast)
+        return layer_norm(x, self.gamma, self.beta, self.eps, self.fused)
 
 
 class ResidualBlock(nn.Module):
-
-    def __init__(self, layer, d_model, drop_ratio, pos=0, order='tdan'):
+    """
+    the order of the operations (t: transformation, d: dropout, a: residual add, n: layer norm)
+    is resolved once here; the common orders run as a single expression. With fused=True (--layernorm fused) the norm
+    is the native one, and a dropout followed by the residual add (tdan, tnda) is a single op (dropout_add).
+    """
+    def __init__(self, layer, d_model, drop_ratio, pos=0, order='tdan', fused=False):
         super().__init__()
+        assert len(order) >= 4, 'at least 4 operations in one block'
+        assert order[0] == 't', 'we must start from transformation'
+        assert order.count('t') == 1, 'only one transformation in a block'
+        assert set(order) <= set('tdan'), 'unknown operation in {}'.format(order)
+
         self.layer = layer
         self.dropout = nn.Dropout(drop_ratio)
-        self.layernorm = LayerNorm(d_model)
+        self.layernorm = LayerNorm(d_model, fused=fused)
         self.pos = pos
         self.order = order
+        if fused:
+            self.residual = {'tdan': self.fused_post_norm, 'tdna': self.pre_add, 'tnda': self.fused_pre_dropout}.get(order, self.walk)
+        else:
+            self.residual = {'tdan': self.post_norm, 'tdna': self.pre_add, 'tnda': self.pre_dropout}.get(order, self.walk)
 
     def forward(self, *x):
-        y = x    
-        assert len(self.order) >= 4, 'at least 4 operations in one block'
-        assert self.order[0] == 't', 'we must start from transformation'
-        for c in self.order:
-            if c == 't':
-                y = self.layer(*y)
-            elif c == 'd':
+        return self.residual(x[self.pos], self.layer(*x))
+
+    def post_norm(self, x, y):    # tdan
+        return self.layernorm(x + self.dropout(y))
+
+    def pre_add(self, x, y):      # tdna
+        return x + self.layernorm(self.dropout(y))
+
+    def pre_dropout(self, x, y):  # tnda
+        return x + self.dropout(self.layernorm(y))
+
+    def fused_post_norm(self, x, y):    # tdan, fused
+        return self.layernorm(dropout_add(x, y, self.dropout.p, self.training))
+
+    def fused_pre_dropout(self, x, y):  # tnda, fused
+        return dropout_add(x, self.layernorm(y), self.dropout.p, self.training)
+
+    def walk(self, x, y):         # any other order
+        for c in self.order[1:]:
+            if c == 'd':
                 y = self.dropout(y)
             elif c == 'a':
-                y = x[self.pos] + y
+                y = x + y
             elif c == 'n':
                 y = self.layernorm(y)
-            else:
-                raise NotImplementedError
-
         return y
-        # return self.layernorm(x[self.pos] + self.dropout(self.layer(*x)))
 
 
 class HighwayBlock(nn.Module):
@@ -270,27 +496,36 @@ class HighwayBlock(nn.Module):
 
 class Attention(nn.Module):
 
-    def __init__(self, d_key, drop_ratio, causal, noisy=False, local=False):
+    def __init__(self, d_key, drop_ratio, causal, noisy=False, local=False, window=2, chunk=0):
         super().__init__()
         self.scale = math.sqrt(d_key)
         self.dropout = nn.Dropout(drop_ratio)
         self.causal = causal
         self.local = local
-        self.window = 2
+        self.window = window
         self.noisy  = noisy
-        self.p_attn = None
+        self.chunk = chunk
+        self.capture = None       # (index, size): keep a copy of one attention map in the next forward, see capture_attention
+        self.attention_map = None
 
     def forward(self, query, key, value=None, mask=None, beta=0, tau=1):
-        dot_products = matmul(query, key.transpose(1, 2))   # batch x trg_len x trg_len
+        if self.local and (value is not None) and (query.dim() == 3) and (query.size(1) == key.size(1)) \
+            and ((mask is None) or (mask.dim() == 2)) and (not self.noisy):
+            return local_attention(query, key, value, mask, self.causal, self.window, self.scale, self.dropout)
+
+        if (self.chunk > 0) and (value is not None) and (query.dim() == 3) and (not self.noisy):
+            return chunked_attention(query, key, value, mask, self.causal, self.window if self.local else None,
+                                     self.scale, self.dropout, self.chunk)
+
+        dot_products = upcast(matmul(query, key.transpose(1, 2)))   # batch x trg_len x trg_len, masks in float32
 
         if query.dim() == 3 and self.causal: # and (query.size(1) == key.size(1)):
-            tri = key.data.new(key.size(1), key.size(1)).fill_(1).triu(1) * INF
+            tri = cached_mask(key.size(1), key.device, dot_products.dtype)
             tri = tri[-query.size(1):]       # caual attention may work on non-square attention.
             dot_products.data.sub_(tri.unsqueeze(0))
 
         if self.local:
-            window_mask = key.new_ones(key.size(1), key.size(1))
-            window_mask = (window_mask.triu(self.window+1) + window_mask.tril(-self.window-1)) * INF
+            window_mask = cached_mask(key.size(1), key.device, dot_products.dtype, window=self.window)
             dot_products.data.sub_(window_mask.unsqueeze(0))
 
         if mask is not None:
@@ -311,32 +546,122 @@ class Attention(nn.Module):
             probs = softmax(logits)
         else:
             probs = gumbel_softmax(logits, beta=beta, tau=tau)
-        self.p_attn = probs
+        if (self.capture is not None) and (probs.dim() == 3):
+            self.attention_map = self.downsampled_map(probs, mask, *self.capture)
 
         # return the attention results
         return matmul(self.dropout(probs), value)
 
+    @staticmethod
+    def downsampled_map(probs, mask, index, size):   # one (row x head) map, without the padded keys, pooled to <= size x size
+        if index >= probs.size(0):
+            return None
+        probs = probs[index].detach().float()
+        if (mask is not None) and (mask.dim() == 2):
+            probs = probs[:, :max(int(mask[index].sum().item()), 1)]
+        Tq, Tk = probs.size()
+        return F.adaptive_avg_pool2d(probs[None], (min(Tq, size), min(Tk, size)))[0] * (Tk / min(Tk, size))  # rows still sum to ~1
+
 
 class MultiHead2(nn.Module):
 
-    def __init__(self, d_key, d_value, n_heads, drop_ratio=0.1, causal=False, noisy=False, local=False):
+    def __init__(self, d_key, d_value, n_heads, drop_ratio=0.1, causal=False, noisy=False, local=False, window=2, chunk=0, n_kv_heads=None):
         super().__init__()
-        self.attention = Attention(d_key, drop_ratio, causal=causal, noisy=noisy, local=local)
-        self.wq = Linear(d_key,   d_key, bias=True)
-        self.wk = Linear(d_key,   d_key, bias=True)
-        self.wv = Linear(d_value, d_value, bias=True)
-        self.wo = Linear(d_value, d_key, bias=True)
+        n_kv_heads = n_kv_heads or n_heads   # grouped-query attention: the heads of a group share one key / value head
+        assert n_heads % n_kv_heads == 0, 'the number of heads must be a multiple of the key / value heads.'
+
+        self.attention = Attention(d_key, drop_ratio, causal=causal, noisy=noisy, local=local, window=window, chunk=chunk)
+        self.d_key = d_key      # widths of the projections (n_heads x head size)
+        self.d_value = d_value
+        self.d_kv_key = d_key // n_heads * n_kv_heads      # widths of the key / value projections (n_kv_heads x head size)
+        self.d_kv_value = d_value // n_heads * n_kv_heads
         self.n_heads = n_heads
+        self.n_kv_heads = n_kv_heads
+        self.wqkv = Linear(d_key, d_key + self.d_kv_key + self.d_kv_value, bias=True)  # packed query, key, value projections
+        self.wo = Linear(d_value, d_key, bias=True)
         self.local = local
+        self.register_buffer('heads', torch.arange(n_heads))  # the (original) heads kept, see prune
+        self.head_mask = None   # N gates on the outputs of the heads (head importance)
+
+    def prune(self, heads):
+        """ keep the given heads only: the projections are sliced, the head size and the scale do not change. """
+        heads = sorted(heads)
+        assert len(heads) > 0, 'at least one head.'
+        assert self.n_kv_heads == self.n_heads, 'the heads of grouped-query attention can not be pruned.'
+        D, V, N = self.d_key, self.d_value, self.n_heads
+
+        def rows(d, offset=0):
+            return torch.cat([torch.arange(h * d, (h + 1) * d) for h in heads]).to(self.wqkv.weight.device) + offset
+
+        qkv, o = torch.cat([rows(D // N), rows(D // N, D), rows(V // N, 2 * D)]), rows(V // N)
+        wqkv = Linear(self.wqkv.in_features, qkv.size(0), bias=True).to(self.wqkv.weight.device)
+        wo = Linear(o.size(0), self.wo.out_features, bias=True).to(self.wo.weight.device)
+        with torch.no_grad():
+            wqkv.weight.copy_(self.wqkv.weight[qkv])
+            wqkv.bias.copy_(self.wqkv.bias[qkv])
+            wo.weight.copy_(self.wo.weight[:, o])
+            wo.bias.copy_(self.wo.bias)
+
+        self.wqkv, self.wo = wqkv, wo
+        self.heads = self.heads[torch.tensor(heads, device=self.heads.device)]
+        self.d_key, self.d_value, self.n_heads = len(heads) * (D // N), len(heads) * (V // N), len(heads)
+        self.d_kv_key, self.d_kv_value, self.n_kv_heads = self.d_key, self.d_value, self.n_heads
+
+    def group(self, n_kv_heads):
+        """ grouped-query attention from multi-head attention (Ainslie et al., 2023): the key / value projections of
+            the heads in a group are averaged. The queries and the output projection do not change. """
+        assert self.n_kv_heads == self.n_heads, 'the keys / values are grouped already.'
+        D, V, N = self.d_key, self.d_value, self.n_heads
+        wqkv = Linear(self.wqkv.in_features, D + (D + V) // N * n_kv_heads, bias=True).to(self.wqkv.weight.device)
+        with torch.no_grad():
+            wqkv.weight.copy_(self.group_rows(self.wqkv.weight, D, V, N, n_kv_heads))
+            wqkv.bias.copy_(self.group_rows(self.wqkv.bias, D, V, N, n_kv_heads))
+
+        self.wqkv = wqkv
+        self.n_kv_heads, self.d_kv_key, self.d_kv_value = n_kv_heads, D // N * n_kv_heads, V // N * n_kv_heads
+
+    @staticmethod
+    def group_rows(param, d_key, d_value, n_heads, n_kv_heads):   # packed wqkv rows: average the key / value heads of each group
+        query, key, value = param.split([d_key, d_key, d_value], 0)
+        key, value = (x.view(n_kv_heads, n_heads // n_kv_heads, x.size(0) // n_heads, *x.size()[1:]).mean(1).reshape(-1, *x.size()[1:])
+                      for x in (key, value))
+        return torch.cat([query, key, value], 0)
+
+    def project(self, query, key, value):
+        D, K, V = self.d_key, self.d_kv_key, self.d_kv_value
+        if (query is key) and (key is value):   # self-attention: one GEMM for all the projections
+            return self.wqkv(query).split([D, K, V], -1)
+
+        if not isinstance(self.wqkv, nn.Linear):   # int8 (packed) weights can not be sliced: project and split
+            query = self.wqkv(query)[..., :D]
+            if key is value:
+                return (query, ) + tuple(self.wqkv(key)[..., D:].split([K, V], -1))
+            return query, self.wqkv(key)[..., D: D + K], self.wqkv(value)[..., D + K:]
+
+        weight, bias = self.wqkv.weight, self.wqkv.bias
+        query = F.linear(query, weight[:D], bias[:D])
+        if key is value:                        # (incremental) self-attention, cross-attention 
+            key, value = F.linear(key, weight[D:], bias[D:]).split([K, V], -1)
+        else:
+            key = F.linear(key, weight[D: D + K], bias[D: D + K])
+            value = F.linear(value, weight[D + K:], bias[D + K:])
+        return query, key, value
+
+    def split_heads(self, x, n_heads, repeats=1):   # B x T x D --> (B x n x r) x T x (D/n), with a single copy
+        B, T, D = x.size()
+        x = x.view(B, T, n_heads, D // n_heads).transpose(1, 2)
+        if repeats > 1:   # grouped-query attention: each key / value head is shared by r query heads
+            x = x[:, :, None].expand(B, n_heads, repeats, T, D // n_heads)
+        return x.reshape(B * n_heads * repeats, T, D // n_heads)
 
     def forward(self, query, key, value, mask=None, beta=0, tau=1):
-        query, key, value = self.wq(query), self.wk(key), self.wv(value)   # B x T x D
-        B, Tq, D = query.size()
-        _, Tk, _ = key.size()
-        N = self.n_heads
+        B, Tq, _ = query.size()
+        Tk = key.size(1)
+        N, G = self.n_heads, self.n_kv_heads
 
         # reshape query-key-value for multi-head attention
-        query, key, value = (x.contiguous().view(B, -1, N, D//N).transpose(2, 1).contiguous().view(B*N, -1, D//N) for x in (query, key, value))
+        query, key, value = self.project(query, key, value)
+        query, key, value = self.split_heads(query, N), self.split_heads(key, G, N // G), self.split_heads(value, G, N // G)
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask[:, None, :].expand(B, N, Tk).contiguous().view(B*N, -1)
@@ -359,7 +684,10 @@ class MultiHead2(nn.Module):
         #         mask = mask * new_mask
 
         outputs = self.attention(query, key, value, mask, beta, tau)  # (B x n) x T x (D/n)
-        outputs = outputs.contiguous().view(B, N, -1, D//N).transpose(2, 1).contiguous().view(B, -1, D)
+        outputs = outputs.view(B, N, Tq, -1)
+        if self.head_mask is not None:
+            outputs = outputs * self.head_mask[None, :, None, None]
+        outputs = outputs.transpose(1, 2).reshape(B, Tq, -1)
         return self.wo(outputs)
 
 
@@ -377,6 +705,28 @@ class MultiHeadConv(nn.Module):
         o = torch.cat([self.convs[k](F.pad(x[:,:,k,:], (0, k))) for k in range(self.max_width)], 1)
         return o
 
+
+class Downsample(nn.Module):
+    """
+    a strided convolution (kernel = stride = factor) over the source embeddings, e.g. of byte-level models:
+    the encoder (and the cross-attention) runs over 1/factor of the positions.
+    The mask is reduced to match: a position is kept if any of its inputs is.
+    """
+    def __init__(self, d_model, factor):
+        super().__init__()
+        self.factor = factor
+        self.conv = nn.Conv1d(d_model, d_model, factor, stride=factor)
+
+    def forward(self, x, mask=None):
+        B, T, _ = x.size()
+        pad = (-T) % self.factor
+        if mask is not None:
+            x = x * mask[:, :, None]   # the embeddings of <pad> are not zeros
+            mask = F.pad(mask, (0, pad)).view(B, -1, self.factor).max(-1)[0]
+        x = self.conv(F.pad(x, (0, 0, 0, pad)).transpose(1, 2)).transpose(1, 2)
+        return x, mask
+
+
 class FeedForward(nn.Module):
 
     def __init__(self, d_model, d_hidden, drop_ratio=0.1, d_output=None):
@@ -394,23 +744,51 @@ class FeedForward(nn.Module):
         # return self.linear2(F.relu(self.linear1(x)))
 
 
+class AverageAttention(nn.Module):
+    """
+    average attention (Zhang et al., 2018) for the decoder self-attention: the cumulative average of the values,
+    a feed-forward layer and input / forget gates with the query. The queries are the last positions of the keys.
+    In greedy decoding the average is given (a running sum), so a step costs the same at any length.
+    """
+    def __init__(self, d_model, d_hidden, drop_ratio=0.1):
+        super().__init__()
+        self.feedforward = FeedForward(d_model, d_hidden, drop_ratio)
+        self.gates = Linear(d_model * 2, d_model * 2)
+
+    def cumulative_average(self, value, mask=None):
+        if mask is None:
+            counts = torch.arange(1, value.size(1) + 1, device=value.device, dtype=value.dtype)[None, :, None]
+            return value.cumsum(1) / counts
+        mask = mask.type_as(value)[:, :, None]
+        return (value * mask).cumsum(1) / mask.cumsum(1).clamp(min=1)
+
+    def forward(self, query, key, value, mask=None, average=None):
+        if average is None:
+            average = self.cumulative_average(value, mask)[:, -query.size(1):]
+        average = self.feedforward(average)
+        input_gate, forget_gate = torch.sigmoid(self.gates(torch.cat([query, average], -1))).chunk(2, -1)
+        return input_gate * query + forget_gate * average
+
+
 class Block(nn.Module):
 
-    def __init__(self, args, causal=False, cross=False, order='tdan', local=False):
+    def __init__(self, args, causal=False, cross=False, order='tdan', local=False, average=False, n_kv_heads=None):
         super().__init__()
-        self.selfattn = ResidualBlock(
-            MultiHead2(
+        if average:   # the decoder self-attention (--dec_selfattn average)
+            selfattn = AverageAttention(args.d_model, args.d_hidden, args.drop_ratio)
+        else:
+            selfattn = MultiHead2(
                 args.d_model, args.d_model, args.n_heads,
-                args.drop_ratio, causal, local=local),
-            args.d_model, args.drop_ratio, order=order)
+                args.drop_ratio, causal, local=local, window=args.local_window, chunk=args.attention_chunk, n_kv_heads=n_kv_heads)
+        self.selfattn = ResidualBlock(selfattn, args.d_model, args.drop_ratio, order=order, fused=(args.layernorm == 'fused'))
         self.feedforward = ResidualBlock(
             FeedForward(args.d_model, args.d_hidden, args.drop_ratio),
-            args.d_model, args.drop_ratio, order=order)
+            args.d_model, args.drop_ratio, order=order, fused=(args.layernorm == 'fused'))
 
         if cross:
             self.crossattn = ResidualBlock(
-            MultiHead2(args.d_model, args.d_model, args.n_cross_heads, args.drop_ratio),  
-            args.d_model, args.drop_ratio, order=order)
+            MultiHead2(args.d_model, args.d_model, args.n_cross_heads, args.drop_ratio, chunk=args.attention_chunk, n_kv_heads=n_kv_heads),
+            args.d_model, args.drop_ratio, order=order, fused=(args.layernorm == 'fused'))
 
         self.cross = cross
         self.causal = causal
@@ -424,45 +802,178 @@ class Block(nn.Module):
         return self.feedforward(x)
 
 
+def capture_attention(model, row=0, head=0, size=32):
+    """
+    keep the attention map of one sentence (batch row) and one head of every multi-head attention in the next forward
+    pass, average-pooled to at most size x size (without the padded keys), for visualization. Off by default: no
+    attention probabilities are kept after the forward pass unless this is called; collect_attention turns it off.
+    """
+    for module in model.modules():
+        if isinstance(module, MultiHead2):
+            module.attention.capture = (row * module.n_heads + min(head, module.n_heads - 1), size)
+
+
+def collect_attention(model):
+    """ the maps kept since capture_attention, as a list of (name, map) on the CPU; stops capturing. """
+    maps = []
+    for name, module in model.named_modules():
+        if isinstance(module, Attention) and (module.capture is not None):
+            if module.attention_map is not None:
+                maps.append(('attention/' + name[:-len('.attention')], module.attention_map.cpu()))
+            module.capture, module.attention_map = None, None
+    return maps
+
+
+class RevBlock(nn.Module):
+    """
+    Block as a reversible coupling (pre-norm):  y1 = x1 + F(x2),  y2 = x2 + G(y1)
+    F: self-attention (+ cross-attention), G: feed-forward. The inputs are recovered from the outputs in backward.
+    """
+    def __init__(self, args, causal=False, cross=False, local=False):
+        super().__init__()
+        self.selfattn = MultiHead2(
+            args.d_model, args.d_model, args.n_heads,
+            args.drop_ratio, causal, local=local, window=args.local_window, chunk=args.attention_chunk)
+        self.selfnorm = LayerNorm(args.d_model, fused=(args.layernorm == 'fused'))
+        self.feedforward = FeedForward(args.d_model, args.d_hidden, args.drop_ratio)
+        self.feedforwardnorm = LayerNorm(args.d_model, fused=(args.layernorm == 'fused'))
+        self.dropout = nn.Dropout(args.drop_ratio)
+
+        if cross:
+            self.crossattn = MultiHead2(args.d_model, args.d_model, args.n_cross_heads, args.drop_ratio, chunk=args.attention_chunk)
+            self.crossnorm = LayerNorm(args.d_model, fused=(args.layernorm == 'fused'))
+
+        self.cross = cross
+        self.causal = causal
+
+    def f(self, x, x_mask=None, y=None, y_mask=None):
+        h = self.selfnorm(x)
+        h = self.dropout(self.selfattn(h, h, h, x_mask))
+        if self.cross:
+            assert y is not None, 'cross attention needs source information'
+            h = h + self.dropout(self.crossattn(self.crossnorm(x + h), y, y, y_mask))
+        return h
+
+    def g(self, x):
+        return self.dropout(self.feedforward(self.feedforwardnorm(x)))
+
+    def forward(self, x1, x2, x_mask=None, y=None, y_mask=None):
+        y1 = x1 + self.f(x2, x_mask, y, y_mask)
+        return y1, x2 + self.g(y1)
+
+
+class RandomState(object):
+    """ records the random state (dropout) and autocast setting of a forward pass, and replays them. """
+    def __init__(self, device):
+        self.device = device
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_state = torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+        self.autocast = torch.is_autocast_enabled(device.type)
+        self.autocast_dtype = torch.get_autocast_dtype(device.type)
+
+    @contextlib.contextmanager
+    def replay(self):
+        with torch.random.fork_rng(devices=[self.device] if self.cuda_state is not None else []):
+            torch.set_rng_state(self.cpu_state)
+            if self.cuda_state is not None:
+                torch.cuda.set_rng_state(self.cuda_state, self.device)
+            with torch.enable_grad(), torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast):
+                yield
+
+
+class Reversible(Function):
+    """
+    runs a list of RevBlocks without storing any intermediate activations:
+    backward walks the blocks in reverse order, recomputing each block's inputs from its outputs.
+    """
+    @staticmethod
+    def forward(ctx, x1, x2, blocks, x_mask, y, y_mask):
+        ctx.blocks, ctx.states = blocks, []
+        for block in blocks:
+            state_f = RandomState(x2.device)
+            x1 = x1 + block.f(x2, x_mask, y, y_mask)
+            state_g = RandomState(x1.device)
+            x2 = x2 + block.g(x1)
+            ctx.states.append((state_f, state_g))
+
+        ctx.save_for_backward(x1, x2, x_mask, y, y_mask)
+        return x1, x2
+
+    @staticmethod
+    def backward(ctx, dy1, dy2):
+        y1, y2, x_mask, y, y_mask = ctx.saved_tensors
+        if y is not None:
+            y = y.detach().requires_grad_(y.requires_grad)
+
+        for block, (state_f, state_g) in zip(ctx.blocks[::-1], ctx.states[::-1]):
+            with state_g.replay():
+                y1 = y1.detach().requires_grad_()
+                gy1 = block.g(y1)
+                torch.autograd.backward(gy1, dy2)   # parameter gradients are accumulated here
+            with torch.no_grad():
+                x2 = y2 - gy1
+                dy1 = dy1 + y1.grad
+
+            with state_f.replay():
+                x2 = x2.detach().requires_grad_()
+                fx2 = block.f(x2, x_mask, y, y_mask)
+                torch.autograd.backward(fx2, dy1)
+            with torch.no_grad():
+                x1 = y1 - fx2
+                dy2 = dy2 + x2.grad
+
+            y1, y2 = x1, x2
+
+        dy = y.grad if (y is not None) and y.requires_grad else None
+        return dy1, dy2, None, None, dy, None
+
+
 class Stack(nn.Module):
 
     """
     --- Merge the Transformer's encoder & decoder into ONE class --
     """
 
-    def __init__(self, field, args, causal=False, cross=False, local=0):
+    def __init__(self, field, args, causal=False, cross=False, local=0, n_layers=None, n_source_layers=None, average=False, n_kv_heads=None):
 
         super().__init__()
+        n_layers = n_layers or args.n_layers
         
         self.layers = nn.ModuleList(
-            [Block(args, causal, cross, order=args.block_order, local=(i < local))
-            for i in range(args.n_layers)])
+            [Block(args, causal, cross, order=args.block_order, local=(i < local), average=average, n_kv_heads=n_kv_heads)
+            for i in range(n_layers)])
         self.dropout = nn.Dropout(args.drop_ratio)
 
         if args.normalize_emb:
-            self.layernorm = LayerNorm(args.d_model)
+            self.layernorm = LayerNorm(args.d_model, fused=(args.layernorm == 'fused'))
 
         self.field = field
         self.d_model = args.d_model
         self.share_embeddings = args.share_embeddings
         self.cross_attn_fashion = args.cross_attn_fashion
         self.normalize_emb = args.normalize_emb
+        self.checkpoint_every = args.checkpoint_every
+        self.n_source_layers = n_source_layers or n_layers   # layers of the encoder (cross-attention)
+        self.average = average   # average attention instead of the self-attention
+
+    def source_layers(self, n):  # which of the n source layers each layer attends to
+        D = len(self.layers)
+        if self.cross_attn_fashion == 'last_layer':
+            return [n - 1 for _ in range(D)]
+
+        index = [((l + 1) * n + D - 1) // D - 1 for l in range(D)]  # proportional (deep encoder / shallow decoder), one-to-one if n == D
+        if self.cross_attn_fashion == 'reverse':
+            index = index[::-1]
+        return index
 
     def prepare_encoder(self, encoding):
         if encoding is None:
             return encoding
 
-        if len(encoding) > len(self.layers):
+        if len(encoding) > self.n_source_layers:
             encoding = encoding[1:]
 
-        if self.cross_attn_fashion == 'reverse':
-            encoding = encoding[::-1]
-        elif self.cross_attn_fashion == 'last_layer':
-            encoding = [encoding[-1] for _ in range(len(self.layers))]
-        else:
-            pass
-
-        return encoding
+        return [encoding[i] for i in self.source_layers(len(encoding))]
 
     def prepare_embedding(self, embedding):
         embedding = self.dropout(embedding)
@@ -478,12 +989,194 @@ class Stack(nn.Module):
 
         for l, layer in enumerate(self.layers):
             y = encoding[l] if encoding is not None else None
-            x = layer(x, x_mask, y, y_mask)
+            if self.training and (self.checkpoint_every > 0) and (l % self.checkpoint_every == 0) and torch.is_grad_enabled():
+                x = checkpoint(layer, x, x_mask, y, y_mask, use_reentrant=False)  # keep the inputs only, recomputed in backward
+            else:
+                x = layer(x, x_mask, y, y_mask)
             outputs.append(x)
 
         return outputs
 
 
+class RevStack(Stack):
+    """
+    reversible variant of Stack (RevBlocks): the activation memory does not grow with the number of layers.
+    The input is copied into two streams, and their average (normalized) is the output.
+    Only the final outputs are returned, so the cross-attention of the decoder must use the 'last_layer'.
+    """
+    def __init__(self, field, args, causal=False, cross=False, local=0, n_layers=None, n_source_layers=None):
+        nn.Module.__init__(self)
+        n_layers = n_layers or args.n_layers
+
+        self.layers = nn.ModuleList(
+            [RevBlock(args, causal, cross, local=(i < local))
+            for i in range(n_layers)])
+        self.dropout = nn.Dropout(args.drop_ratio)
+        self.layernorm = LayerNorm(args.d_model, fused=(args.layernorm == 'fused'))
+
+        self.field = field
+        self.d_model = args.d_model
+        self.share_embeddings = args.share_embeddings
+        self.cross_attn_fashion = args.cross_attn_fashion
+        self.normalize_emb = False
+        self.n_source_layers = n_source_layers or n_layers
+
+    def forward(self, x, x_mask, encoding=None, y_mask=None):
+
+        outputs = [x]
+        x = self.prepare_embedding(x)
+        encoding = self.prepare_encoder(encoding)
+        y = encoding[-1] if encoding is not None else None
+
+        if torch.is_grad_enabled():
+            x1, x2 = Reversible.apply(x, x, list(self.layers), x_mask, y, y_mask)
+        else:
+            x1, x2 = x, x
+            for layer in self.layers:
+                x1, x2 = layer(x1, x2, x_mask, y, y_mask)
+
+        outputs.append(self.layernorm((x1 + x2) / 2))
+        return outputs
+
+
+class DecoderStepLayer(nn.Module):
+    """
+    one decoder Block at inference time, written with plain tensor ops (TorchScript-able).
+    It shares the parameters of the Block; the order of the ResidualBlocks is resolved here once.
+    """
+    def __init__(self, block):
+        super().__init__()
+        order = [c for c in block.selfattn.order if c != 'd']   # no dropout at inference
+        if sorted(order) != ['a', 'n', 't'] or order[0] != 't':
+            raise NotImplementedError('the decoder step supports the orders made of t, d, a, n (once each)')
+        self.norm_last = order.index('n') > order.index('a')   # tdan: norm(x + f(x)), tdna / tnda: x + norm(f(x))
+
+        selfattn, crossattn, feedforward = block.selfattn, block.crossattn, block.feedforward
+        assert isinstance(selfattn.layer, MultiHead2), 'the decoder step does not support the average attention'
+        assert isinstance(selfattn.layer.wqkv, nn.Linear), 'the decoder step does not support quantized models'
+
+        D = selfattn.layer.d_key
+        self.self_w, self.self_b = selfattn.layer.wqkv.weight, selfattn.layer.wqkv.bias
+        self.self_wo, self.self_bo = selfattn.layer.wo.weight, selfattn.layer.wo.bias
+        self.self_gamma, self.self_beta, self.self_eps = selfattn.layernorm.gamma, selfattn.layernorm.beta, selfattn.layernorm.eps
+        self.cross_w, self.cross_b = crossattn.layer.wqkv.weight, crossattn.layer.wqkv.bias
+        self.cross_wo, self.cross_bo = crossattn.layer.wo.weight, crossattn.layer.wo.bias
+        self.cross_gamma, self.cross_beta, self.cross_eps = crossattn.layernorm.gamma, crossattn.layernorm.beta, crossattn.layernorm.eps
+        self.ff_w1, self.ff_b1 = feedforward.layer.linear1.weight, feedforward.layer.linear1.bias
+        self.ff_w2, self.ff_b2 = feedforward.layer.linear2.weight, feedforward.layer.linear2.bias
+        self.ff_gamma, self.ff_beta, self.ff_eps = feedforward.layernorm.gamma, feedforward.layernorm.beta, feedforward.layernorm.eps
+        self.fused = feedforward.layernorm.fused
+
+        self.d_key = D
+        self.d_kv_key = selfattn.layer.d_kv_key
+        self.d_kv_value = selfattn.layer.d_kv_value
+        self.d_cross_key = crossattn.layer.d_key   # differs from d_key once the heads are pruned
+        self.d_cross_kv_key = crossattn.layer.d_kv_key
+        self.n_heads = selfattn.layer.n_heads
+        self.n_kv_heads = selfattn.layer.n_kv_heads
+        self.n_cross_heads = crossattn.layer.n_heads
+        self.n_cross_kv_heads = crossattn.layer.n_kv_heads
+        self.scale = selfattn.layer.attention.scale
+        self.inf = INF
+
+    def residual(self, x, y, gamma, beta, eps: float):
+        if self.norm_last:
+            y = x + y
+        y = layer_norm(y, gamma, beta, eps, self.fused)
+        if not self.norm_last:
+            y = x + y
+        return y
+
+    def attend(self, q, key, value, mask: Optional[torch.Tensor]):   # q: B x N x d, key / value: B x G x T x d (N / G heads per group)
+        B, N, G = q.size(0), q.size(1), key.size(1)
+        dot_products = key @ q.reshape(B, G, N // G, -1).transpose(-1, -2)   # B x G x T x (N / G)
+        if mask is not None:
+            dot_products = dot_products - (1 - mask[:, None, :, None]) * self.inf
+        probs = F.softmax(dot_products / self.scale, dim=-2)
+        return (probs.transpose(-1, -2) @ value).reshape(B, -1)
+
+    def memory(self, encoding, n_heads: int):   # keys / values of the source (n_heads: key / value heads), computed once per sentence
+        B, S, _ = encoding.size()
+        D, K = self.d_cross_key, self.d_cross_kv_key
+        kv = F.linear(encoding, self.cross_w[D:], self.cross_b[D:])
+        key, value = kv[..., :K], kv[..., K:]
+        return (key.reshape(B, S, n_heads, -1).transpose(1, 2).contiguous(),
+                value.reshape(B, S, n_heads, -1).transpose(1, 2).contiguous())
+
+    def forward(self, x, t, mask, keys, values, cross_keys, cross_values, mask_src: Optional[torch.Tensor]):
+        B, D, K = x.size(0), self.d_key, self.d_kv_key
+        N, G, M = self.n_heads, self.n_kv_heads, self.n_cross_heads
+
+        qkv = F.linear(x, self.self_w, self.self_b)
+        keys.index_copy_(2, t.view(1), qkv[:, D: D + K].reshape(B, G, 1, -1).to(keys.dtype))   # bf16 projections (autocast)
+        values.index_copy_(2, t.view(1), qkv[:, D + K:].reshape(B, G, 1, -1).to(values.dtype))
+        h = self.attend(qkv[:, :D].reshape(B, N, -1), keys, values, mask)
+        x = self.residual(x, F.linear(h, self.self_wo, self.self_bo), self.self_gamma, self.self_beta, self.self_eps)
+
+        q = F.linear(x, self.cross_w[:self.d_cross_key], self.cross_b[:self.d_cross_key]).reshape(B, M, -1)
+        h = self.attend(q, cross_keys, cross_values, mask_src)
+        x = self.residual(x, F.linear(h, self.cross_wo, self.cross_bo), self.cross_gamma, self.cross_beta, self.cross_eps)
+
+        h = F.linear(F.relu(F.linear(x, self.ff_w1, self.ff_b1)), self.ff_w2, self.ff_b2)
+        return self.residual(x, h, self.ff_gamma, self.ff_beta, self.ff_eps)
+
+
+class DecoderStep(nn.Module):
+    """
+    one step of decoding -- embedding, decoder layers with cached keys/values, output projection (logits: beam search),
+    argmax (forward: greedy decoding) -- as a single module that can be scripted (torch.jit.script) or compiled (torch.compile). Inference only;
+    it shares the parameters of the model and is not registered as its sub-module.
+    """
+    def __init__(self, model):
+        super().__init__()
+        assert type(model.io_dec) is IO, 'the decoder step only supports the full softmax output.'
+        self.layers = nn.ModuleList([DecoderStepLayer(block) for block in model.decoder.layers])
+        self.embed = model.io_dec.embedding()
+        self.out = model.io_dec.out
+        self.scale = model.io_dec.scale
+        self.normalize_emb = model.decoder.normalize_emb
+        if self.normalize_emb:
+            layernorm = model.decoder.layernorm
+            self.gamma, self.beta, self.eps, self.fused = layernorm.gamma, layernorm.beta, layernorm.eps, layernorm.fused
+        else:
+            self.gamma, self.beta, self.eps, self.fused = None, None, 0.0, False
+
+    def caches(self, encoding, T):   # self-attention keys / values of the decoded tokens (T steps), and of the source
+        B = encoding[0].size(0)
+        keys = [encoding[0].new_zeros(B, l.n_kv_heads, T, l.d_kv_key // l.n_kv_heads) for l in self.layers]
+        values = [encoding[0].new_zeros(B, l.n_kv_heads, T, l.d_kv_value // l.n_kv_heads) for l in self.layers]
+        cross_keys, cross_values = zip(*[l.memory(encoding[i], l.n_cross_kv_heads) for i, l in enumerate(self.layers)])
+        return keys, values, list(cross_keys), list(cross_values)
+
+    @torch.jit.export
+    def logits(self, tokens, position, t, keys: List[torch.Tensor], values: List[torch.Tensor],
+               cross_keys: List[torch.Tensor], cross_values: List[torch.Tensor], mask_src: Optional[torch.Tensor],
+               shortlist_weight: Optional[torch.Tensor] = None):
+        """
+        t is a 0-dim tensor: the caches keep a fixed size (T) and the future positions are masked,
+        so that the compiled step does not depend on t. With a shortlist (IO.restrict), only its rows are projected.
+        """
+        mask = (torch.arange(keys[0].size(2), device=t.device) <= t).type_as(position)[None, :]
+        x = F.embedding(tokens, self.embed) * self.scale + position
+        gamma, beta = self.gamma, self.beta
+        if (gamma is not None) and (beta is not None):
+            x = layer_norm(x, gamma, beta, self.eps, self.fused)
+
+        for i, layer in enumerate(self.layers):
+            x = layer(x, t, mask, keys[i], values[i], cross_keys[i], cross_values[i], mask_src)
+        if shortlist_weight is not None:
+            return F.linear(x, shortlist_weight)
+        return self.out(x)
+
+    def forward(self, tokens, position, t, keys: List[torch.Tensor], values: List[torch.Tensor],
+                cross_keys: List[torch.Tensor], cross_values: List[torch.Tensor], mask_src: Optional[torch.Tensor],
+                shortlist: Optional[torch.Tensor] = None, shortlist_weight: Optional[torch.Tensor] = None):
+        indices = self.logits(tokens, position, t, keys, values, cross_keys, cross_values, mask_src, shortlist_weight).max(-1)[1]
+        if shortlist is not None:
+            return shortlist[indices]
+        return indices
+
+
 class IO(nn.Module):
     
     def __init__(self, field, args):
@@ -492,28 +1185,178 @@ class IO(nn.Module):
         self.args = args
         self.out = nn.Linear(args.d_model, len(field.vocab), bias=False)
         self.scale = math.sqrt(args.d_model)
+        self.pos = PositionalEncoding(args.d_model)
+        self.register_buffer('embed', None)   # float copy of the embeddings, once `out` is quantized
+        self.shortlist, self.shortlist_weight = None, None
+
+    def embedding(self):   # tied with the output projection
+        return self.out.weight if self.embed is None else self.embed
 
     def i(self, x, pos=True):
-        x = F.embedding(x, self.out.weight * self.scale)
+        x = F.embedding(x, self.embedding()) * self.scale   # lookup-then-scale: only the rows needed
         if pos:
-            x = x + positional_encodings_like(x)
+            x = x + self.pos(x)
         return x
 
+    def restrict(self, shortlist=None):  # decoding: project onto a subset (sorted token ids) of the vocabulary only
+        self.shortlist = shortlist
+        self.shortlist_weight = None if shortlist is None else self.embedding()[shortlist]
+
     def o(self, x):
+        if self.shortlist is not None:
+            return F.linear(x, self.shortlist_weight)
         return self.out(x)
 
-    def cost(self, targets, masks, outputs, label_smooth=0.0, name=None):
+    def tokens(self, indices):   # indices over the outputs of o --> token ids
+        return indices if self.shortlist is None else self.shortlist[indices]
+
+    def top1(self, x):   # the most probable tokens
+        return self.tokens(self.o(x).max(-1)[1])
+
+    def xent(self, outputs, targets, label_smooth=0.0, project=None):
+        if project is None:
+            project = self.o
+        if self.args.loss_chunk > 0:  # never keep all the logits (N_tokens x |V|) in memory
+            return chunked_cross_entropy_with_smooth(project, outputs, targets, label_smooth, self.args.loss_chunk)
+        return cross_entropy_with_smooth(project(outputs), targets, label_smooth)
+
+    def cost(self, targets, masks, outputs, label_smooth=0.0, name=None, intermediates=None):
         loss = dict()
         if name is None:
             name = 'MLE'
         targets, outputs = with_mask(targets, outputs, masks.byte())
-        loss[name] = cross_entropy_with_smooth(self.o(outputs), targets, label_smooth)
+        loss[name] = self.xent(outputs, targets, label_smooth)
+
+        if intermediates is not None:  # early exit (--exit_loss): the same output layer on the intermediate layers
+            for l, hidden in enumerate(intermediates):
+                hidden = hidden[masks.bool()]   # the same tokens as outputs
+                loss['{}@{}'.format(name, l + 1)] = self.xent(hidden, targets, label_smooth) * self.args.exit_loss / len(intermediates)
         return loss
 
     def acc(self, targets, masks, outputs):
         with torch.cuda.device_of(targets):
             targets, outputs = with_mask(targets, outputs, masks.byte())
-            return (self.o(outputs).max(-1)[1] == targets).float().tolist()
+            return (self.top1(outputs) == targets).float().tolist()
+
+
+def load_lexical_table(path, src_vocab, trg_vocab, k=10):
+    """
+    the top-k target words of each source word in a lexical translation table of fast_align (-p):
+    one "source target log-prob" per line (<eps> as the NULL word). The target word spelled as the source
+    word is added as well (names, numbers). Returns |V_src| x (k + 1) token ids, padded with <pad>.
+    """
+    pad = trg_vocab.stoi['<pad>']
+    best = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            i, j = src_vocab.stoi.get(fields[0]), trg_vocab.stoi.get(fields[1])
+            if (i is None) or (j is None):
+                continue
+            heap = best[i]
+            if len(heap) < k:
+                heapq.heappush(heap, (float(fields[2]), j))
+            else:
+                heapq.heappushpop(heap, (float(fields[2]), j))
+
+    table = torch.LongTensor(len(src_vocab.itos), k + 1).fill_(pad)
+    for i, w in enumerate(src_vocab.itos):
+        words = [j for _, j in best.get(i, [])] + [trg_vocab.stoi.get(w, pad)]
+        table[i, :len(words)] = torch.LongTensor(words)
+    return table
+
+
+class Shortlist(object):
+    """
+    vocabulary shortlist for decoding: per batch, the union of the most frequent target words
+    and the candidates of each source token in a lexical table (load_lexical_table).
+    The special tokens of the target vocabulary are always included (a hypothesis must be able to end).
+    """
+    def __init__(self, table, vocab, frequent=1000):
+        self.table = table
+        specials = [vocab.stoi[w] for w in ['<unk>', '<pad>', '<init>', '<eos>'] if w in vocab.stoi]
+        self.frequent = torch.cat([torch.arange(frequent), torch.tensor(specials, dtype=torch.long)]).unique()
+        self.sizes = []
+
+    def candidates(self, source_inputs):
+        if self.table.device != source_inputs.device:
+            self.table, self.frequent = self.table.to(source_inputs.device), self.frequent.to(source_inputs.device)
+        shortlist = torch.cat([self.frequent, self.table[source_inputs].view(-1)]).unique()   # sorted
+        self.sizes.append(shortlist.size(0))
+        return shortlist
+
+
+def adaptive_cutoffs(vocab, coverage=[0.8, 0.95]):
+    """
+    cluster boundaries of the adaptive softmax, chosen from the counts of the (frequency-sorted) vocabulary:
+    the head covers coverage[0] of the training tokens, and each following cluster up to coverage[k].
+    """
+    counts = torch.tensor([float(vocab.freqs.get(w, 0)) for w in vocab.itos], dtype=torch.double)
+    counts = counts.cumsum(0) / counts.sum()
+
+    cutoffs = []
+    for c in coverage:
+        k = int((counts < c).sum().item()) + 1
+        if (k > (cutoffs[-1] if len(cutoffs) > 0 else 0)) and (k < len(vocab.itos)):
+            cutoffs.append(k)
+    return cutoffs + [len(vocab.itos)]
+
+
+class AdaptiveIO(IO):
+    """
+    IO with a frequency-clustered adaptive softmax (Grave et al., 2017) as the output layer.
+    The head (frequent words + one entry per cluster) shares its word vectors with the embeddings;
+    the rare words are predicted inside their clusters with reduced dimensions.
+    """
+    def __init__(self, field, args):
+        super().__init__(field, args)
+
+        self.cutoffs = adaptive_cutoffs(field.vocab, args.adaptive_coverage)
+        self.cluster = nn.Linear(args.d_model, len(self.cutoffs) - 1, bias=False)
+        self.tails = nn.ModuleList()
+        for k in range(len(self.cutoffs) - 1):
+            d_tail = max(args.d_model // (args.adaptive_div ** (k + 1)), 1)
+            self.tails.append(nn.Sequential(
+                nn.Linear(args.d_model, d_tail, bias=False),
+                nn.Linear(d_tail, self.cutoffs[k + 1] - self.cutoffs[k], bias=False)))
+
+    def head(self, x):  # log-probabilities of the frequent words, and of the clusters
+        return log_softmax(torch.cat([F.linear(x, self.embedding()[:self.cutoffs[0]]), self.cluster(x)], -1))
+
+    def o(self, x):     # full log-probabilities (only needed for beam-search / evaluation)
+        head = self.head(x)
+        outputs = [head[..., :self.cutoffs[0]]]
+        for k, tail in enumerate(self.tails):
+            outputs.append(head[..., self.cutoffs[0] + k: self.cutoffs[0] + k + 1] + log_softmax(tail(x)))
+        return torch.cat(outputs, -1)
+
+    def top1(self, x):  # only look into the clusters when the head predicts a cluster
+        preds = self.head(x).max(-1)[1]
+        rare = preds >= self.cutoffs[0]
+        if rare.any():
+            preds[rare] = self.o(x[rare]).max(-1)[1]
+        return preds
+
+    def xent(self, outputs, targets, label_smooth=0.0, project=None):
+        head = self.head(outputs)
+        head_targets = targets.clone()
+        clusters = []
+        for k in range(len(self.tails)):
+            in_cluster = (targets >= self.cutoffs[k]) & (targets < self.cutoffs[k + 1])
+            head_targets[in_cluster] = self.cutoffs[0] + k
+            clusters.append(in_cluster.nonzero()[:, 0])
+
+        logps = head.gather(1, head_targets[:, None])[:, 0]
+        for k, tail in enumerate(self.tails):
+            if clusters[k].size(0) > 0:
+                tail_logps = log_softmax(tail(outputs[clusters[k]])).gather(
+                    1, (targets[clusters[k]] - self.cutoffs[k])[:, None])[:, 0]
+                logps = logps.index_add(0, clusters[k], tail_logps)
+
+        # label-smoothing is applied over the head distribution (words + clusters)
+        return -logps.mean() * (1 - label_smooth) - head.mean() * label_smooth
 
 
 class MulIO(IO):
@@ -546,7 +1389,8 @@ class MulIO(IO):
             x = x.transpose(-1, -2)
         return self.out(x)
 
-    def cost(self, targets, masks, outputs, label_smooth=0.0, name=None):
+    def cost(self, targets, masks, outputs, label_smooth=0.0, name=None, intermediates=None):
+        assert intermediates is None, 'early exit (--exit_loss) is not supported by multi-step prediction.'
         
         # some internal printing setup
         self.printer_param[1] += 1
@@ -560,7 +1404,7 @@ class MulIO(IO):
 
         if self.dyn == 0:
             shifted_targets, block_outputs = with_mask(shifted_targets, block_outputs, shifted_masks.byte())
-            loss[name] = cross_entropy_with_smooth(self.out(block_outputs), shifted_targets, label_smooth)
+            loss[name] = self.xent(block_outputs, shifted_targets, label_smooth, self.out)
 
         else:   
 
@@ -584,8 +1428,8 @@ class MulIO(IO):
 
             optima_targets, optima_block_outputs = with_mask(shifted_targets, block_outputs, new_masks.byte())
             random_targets, random_block_outputs = with_mask(shifted_targets, block_outputs, new_random_masks.byte())
-            loss[name]   =  cross_entropy_with_smooth(self.out(optima_block_outputs), optima_targets, label_smooth) * self.dyn + \
-                            cross_entropy_with_smooth(self.out(random_block_outputs), random_targets, label_smooth) * (1 - self.dyn)
+            loss[name]   =  self.xent(optima_block_outputs, optima_targets, label_smooth, self.out) * self.dyn + \
+                            self.xent(random_block_outputs, random_targets, label_smooth, self.out) * (1 - self.dyn)
         
         return loss
 
@@ -605,25 +1449,24 @@ class MulIO(IO):
 
         scores = shift(scores * shifted_masks, blocksize, right=True, value=-INF)  # right-shifting
 
-        decisions = scores.new_zeros(batchsize, seqsize, blocksize).long() # all starts from 0
-        outputs   = scores.new_zeros(batchsize, seqsize, blocksize).add_(-INF)
-        outputs[:, 0, 0] = scores[:, 0, 0]
+        # states: k = the number of accepted steps ending at t (0: reject).
+        # only the backpointer of the reject state is needed; an accept state k always comes from k - 1.
+        outputs = scores.new_zeros(batchsize, blocksize).add_(-INF)
+        outputs[:, 0] = scores[:, 0, 0]
+        backpointers = scores.new_zeros(batchsize, seqsize).long()
 
         for t in range(1, seqsize):
-            
-            max_outputs, max_indx = outputs[:, t-1].max(1)
-
-            outputs[:, t, 0] = max_outputs + scores[:, t, 0]            # best score for reject
-            outputs[:, t, 1:] = outputs[:, t-1, :-1] + scores[:, t, 1:] # best score for accept 1,2,3,...
-
-            reject_decisions = decisions[:, :t].gather(2, max_indx[:, None, None].expand(batchsize, t, 1)) # best reject decision
-            decisions[:,  t, 1:] = decisions[:, t-1, :-1] + 1
-            decisions[:, :t, 1:] = decisions[:, :t,  :-1]
-            decisions[:,  t, :1] = 0
-            decisions[:, :t, :1] = reject_decisions
-            
-        best_outputs, best_indx = outputs[:, -1, :].max(1)
-        best_decision = decisions.gather(2, best_indx[:, None, None].expand(batchsize, seqsize, 1))
+            max_outputs, backpointers[:, t] = outputs.max(1)
+            outputs = torch.cat([max_outputs[:, None] + scores[:, t, :1],        # best score for reject
+                                 outputs[:, :-1] + scores[:, t, 1:]], 1)         # best score for accept 1,2,3,...
+
+        # backtrack
+        best_decision = scores.new_zeros(batchsize, seqsize).long()
+        decision = outputs.max(1)[1]
+        for t in range(seqsize - 1, -1, -1):
+            best_decision[:, t] = decision
+            decision = torch.where(decision > 0, decision - 1, backpointers[:, t])
+        best_decision = best_decision.unsqueeze(-1)
 
         acceptance = (best_decision.squeeze(-1) != 0).long()
         new_masks = scores.new_zeros(batchsize, seqsize, blocksize).scatter_(2, best_decision, 1)
@@ -658,6 +1501,108 @@ class MulIO(IO):
         return acceptance, new_mask
 
 
+def upgrade_state_dict(state_dict):
+    """
+    map the parameters of old checkpoints onto the current modules:
+    :: separate wq / wk / wv projections --> packed wqkv (MultiHead2)
+    """
+    for name in [k for k in state_dict if k.endswith('.wq.weight')]:
+        prefix = name[:-len('wq.weight')]
+        for p in ['weight', 'bias']:
+            state_dict[prefix + 'wqkv.' + p] = torch.cat(
+                [state_dict.pop(prefix + w + '.' + p) for w in ['wq', 'wk', 'wv']], 0)
+    return state_dict
+
+
+def quantize_int8(model):
+    """
+    post-training dynamic int8 quantization (CPU inference) of the projections in MultiHead2, FeedForward and IO.out.
+    The embeddings tied with IO.out are kept in float.
+    """
+    names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, IO):
+            module.embed = module.out.weight.detach().clone()
+            names.add(name + '.out')
+        elif isinstance(module, (MultiHead2, FeedForward)):
+            names.update(name + '.' + n for n, m in module.named_children() if isinstance(m, nn.Linear))
+
+    modules = dict(model.named_modules())
+    for name in names:  # our Linear only reshapes its inputs, which the quantized Linear does by itself
+        parent, child = name.rsplit('.', 1)
+        linear = modules[name]
+        if type(linear) is not nn.Linear:
+            new_linear = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+            new_linear.load_state_dict(linear.state_dict())
+            setattr(modules[parent], child, new_linear)
+
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), names, dtype=torch.qint8)
+
+
+def head_importance(model, batches):
+    """
+    importance of the attention heads (Michel et al., 2019): |dL / dm_h| of gates m_h = 1 on the outputs of each
+    head of MultiHead2, accumulated over the batches (no dropout) and normalized per module.
+    """
+    modules = {name: m for name, m in model.named_modules() if isinstance(m, MultiHead2)}
+    scores = {name: m.heads.new_zeros(m.n_heads).float() for name, m in modules.items()}
+    for m in modules.values():
+        m.head_mask = m.heads.new_ones(m.n_heads).float().requires_grad_()
+
+    model.eval()
+    with torch.enable_grad():
+        for batch in batches:
+            grads = torch.autograd.grad(model(batch)['loss'], [m.head_mask for m in modules.values()], allow_unused=True)
+            for name, g in zip(modules, grads):
+                if g is not None:
+                    scores[name] += g.abs()
+
+    for m in modules.values():
+        m.head_mask = None
+    return {name: score / (score.norm() + TINY) for name, score in scores.items()}
+
+
+def prune_heads(model, importance, ratio):
+    """ remove the least important heads (a ratio of all the heads), keeping at least one head per module. """
+    modules = dict(model.named_modules())
+    ranked = sorted((score, name, h) for name, scores in importance.items() for h, score in enumerate(scores.tolist()))
+    removed, n = defaultdict(set), int(len(ranked) * ratio)
+    for _, name, h in ranked:
+        if n == 0:
+            break
+        if len(removed[name]) + 1 < modules[name].n_heads:
+            removed[name].add(h)
+            n -= 1
+
+    for name in importance:
+        if len(removed[name]) > 0:
+            modules[name].prune([h for h in range(modules[name].n_heads) if h not in removed[name]])
+    return {name: modules[name].n_heads for name in importance}
+
+
+def prune_as(model, state_dict):
+    """ shrink the attention heads of a new model to the heads kept in a (pruned) checkpoint, before loading it. """
+    for name, module in model.named_modules():
+        if isinstance(module, MultiHead2) and ((name + '.heads') in state_dict):
+            heads = state_dict[name + '.heads'].tolist()
+            if len(heads) < module.n_heads:
+                module.prune(heads)
+    return model
+
+
+def group_as(model, state_dict):
+    """ a multi-head checkpoint for a model with grouped-query attention (--n_kv_heads): the key / value projections
+        of the heads in each group are averaged, before loading it (and fine-tuning). """
+    for name, module in model.named_modules():
+        weight, bias = state_dict.get(name + '.wqkv.weight'), state_dict.get(name + '.wqkv.bias')
+        if isinstance(module, MultiHead2) and (module.n_kv_heads < module.n_heads) and (weight is not None) \
+                and (weight.size(0) == module.d_key * 2 + module.d_value):
+            args = (module.d_key, module.d_value, module.n_heads, module.n_kv_heads)
+            state_dict[name + '.wqkv.weight'] = MultiHead2.group_rows(weight, *args)
+            state_dict[name + '.wqkv.bias'] = MultiHead2.group_rows(bias, *args)
+    return state_dict
+
+
 class Seq2Seq(nn.Module):
     """
     somehow an abstract class for seq2seq models.
@@ -667,6 +1612,11 @@ class Seq2Seq(nn.Module):
         param = [p for p in self.parameters() if p.requires_grad] 
         return [param]
 
+    def autocast(self):
+        """ --precision bf16: matmuls in bfloat16; masks, softmax, normalization and the loss stay in float32. """
+        return torch.autocast(next(self.parameters()).device.type, dtype=torch.bfloat16,
+                              enabled=(self.args.precision == 'bf16'))
+
     def prepare_masks(self, inputs):
         field, text = inputs
         if text.ndimension() == 2:  # index inputs
@@ -4,18 +4,27 @@ class Transformer(Seq2Seq):
 
     def __init__(self, src, trg, args):
         super().__init__()
-        self.encoder = Stack(src, args, causal=args.causal_enc, cross=False, local=args.local_attention)
-        self.decoder = Stack(trg, args, causal=True, cross=True)
+        if args.reversible_encoder:
+            assert args.cross_attn_fashion == 'last_layer', 'a reversible encoder only outputs its last layer.'
+            self.encoder = RevStack(src, args, causal=args.causal_enc, cross=False, local=args.local_attention, n_layers=args.n_enc_layers)
+        else:
+            self.encoder = Stack(src, args, causal=args.causal_enc, cross=False, local=args.local_attention, n_layers=args.n_enc_layers)
+        self.decoder = Stack(trg, args, causal=True, cross=True, n_layers=args.n_dec_layers, n_source_layers=len(self.encoder.layers),
+                             average=(args.dec_selfattn == 'average'), n_kv_heads=args.n_kv_heads)
         
         if args.multi_width > 1:
             self.io_dec = MulIO(trg, args)
             self.io_enc = IO(src, args)
+        elif args.adaptive_softmax:
+            self.io_dec = AdaptiveIO(trg, args)
+            self.io_enc = IO(src, args)
         else:
             self.io_dec = IO(trg, args)
             self.io_enc = IO(src, args)
 
         if args.share_embeddings:
             self.io_enc.out.weight = self.io_dec.out.weight
+        self.io_enc.pos = self.io_dec.pos  # one position table per model
 
         self.input_conv = None
         self.length_ratio = args.length_ratio
@@ -26,8 +35,16 @@ class Transformer(Seq2Seq):
             # self.input_conv = nn.Conv1d(args.d_model, args.d_model, 3, stride=1, padding=1)
             self.input_conv = MultiHeadConv(args.d_model, max_width=args.input_conv)
 
+        self.downsample = None
+        if args.downsample > 1:   # shorter source sequences (--downsample)
+            assert not args.encoder_lm, 'the source language model predicts every input token: no downsampling.'
+            self.downsample = Downsample(args.d_model, args.downsample)
+
         # decode or not:
         self.decode = False
+        self.decoder_steps = dict()  # single-step decoders for greedy decoding (--jit_decoder), built when needed
+        self.shortlist = None        # vocabulary shortlist for decoding (--shortlist), see Shortlist
+        self.exit_depth = 0          # early exit (--exit_threshold): decoder layers per token in the last greedy decoding
         
     # All in All: forward function for training
     def forward(self, batch, decoding=False, reverse=True, dataflow=['src', 'trg']):
@@ -50,67 +67,98 @@ class Transformer(Seq2Seq):
         if info['sents'] == 0:
             return info
 
-        # encoding
-        encoding_inputs  = self.io_enc.i(source_inputs, pos=True)
-        if self.input_conv is not None:
-            encoding_inputs = self.input_conv(encoding_inputs.permute(0, 2, 1)).permute(0, 2, 1)
+        with self.autocast():  # mixed precision (--precision bf16)
+            # encoding
+            encoding_inputs  = self.io_enc.i(source_inputs, pos=True)
+            if self.input_conv is not None:
+                encoding_inputs = self.input_conv(encoding_inputs.permute(0, 2, 1)).permute(0, 2, 1)
+            if self.downsample is not None:   # the masks of the source (encoder, cross-attention) are reduced as well
+                encoding_inputs, source_masks = self.downsample(encoding_inputs, source_masks)
         
-        encoding_outputs = self.encoder(encoding_inputs, source_masks)
-        if not decoding:
-            # Maximum Likelihood Training (with label smoothing trick)
+            encoding_outputs = self.encoder(encoding_inputs, source_masks)
+            if not decoding:
+                # Maximum Likelihood Training (with label smoothing trick)
 
-            decoding_outputs = self.decoder(self.io_dec.i(target_inputs), target_masks, encoding_outputs, source_masks)
-            loss = self.io_dec.cost(target_outputs, target_masks, outputs=decoding_outputs[-1], label_smooth=self.args.label_smooth)
+                decoding_outputs = self.decoder(self.io_dec.i(target_inputs), target_masks, encoding_outputs, source_masks)
+                loss = self.io_dec.cost(target_outputs, target_masks, outputs=decoding_outputs[-1], label_smooth=self.args.label_smooth,
+                                        intermediates=decoding_outputs[1:-1] if self.args.exit_loss > 0 else None)
             
-            for w in loss:
-                info['L@' + w] = loss[w]
-                if w[0] != '#':
-                    info['loss'] = info['loss'] + loss[w]
-
-            # Source side Language Model (optional, only works for causal-encoder)
-            if self.args.encoder_lm and self.args.causal_enc:
-                loss_lm = self.io_enc.cost(source_outputs, source_masks, outputs=encoding_outputs[-1])
-                for w in loss_lm:
+                for w in loss:
                     info['L@' + w] = loss[w]
                     if w[0] != '#':
                         info['loss'] = info['loss'] + loss[w]
 
-        else:
-            # Decoding (for evaluation)
-
-            if self.args.multi_width > 1: # -- the newly introduced block-wise decoding --
-                assert self.args.beam_size == 1, 'block-wise decoding only works for greedy decoding (for now).' 
-                translation_outputs = self.blockwise_parallel_decoding(encoding_outputs, source_masks, field=dataflow[1])
+                # Source side Language Model (optional, only works for causal-encoder)
+                if self.args.encoder_lm and self.args.causal_enc:
+                    loss_lm = self.io_enc.cost(source_outputs, source_masks, outputs=encoding_outputs[-1])
+                    for w in loss_lm:
+                        info['L@' + w] = loss[w]
+                        if w[0] != '#':
+                            info['loss'] = info['loss'] + loss[w]
 
             else:
-                if self.args.beam_size == 1:
-                    translation_outputs = self.greedy_decoding(encoding_outputs, source_masks, field=dataflow[1])
-                else:
-                    translation_outputs = self.beam_search(encoding_outputs, source_masks, self.args.beam_size, self.args.alpha, field=dataflow[1])
+                # Decoding (for evaluation)
+
+                if self.args.multi_width > 1: # -- the newly introduced block-wise decoding --
+                    assert self.args.beam_size == 1, 'block-wise decoding only works for greedy decoding (for now).' 
+                    translation_outputs = self.blockwise_parallel_decoding(encoding_outputs, source_masks, field=dataflow[1])
 
-            if reverse:
-                source_outputs = self.fields[dataflow[0]].reverse(source_outputs)
-                target_outputs = self.fields[dataflow[1]].reverse(target_outputs)
+                else:
+                    if (self.shortlist is not None) and (dataflow == ['src', 'trg']):  # vocabulary shortlist (--shortlist)
+                        self.io_dec.restrict(self.shortlist.candidates(source_inputs))
+
+                    if self.args.beam_size == 1:
+                        translation_outputs = self.greedy_decoding(encoding_outputs, source_masks, T=source_inputs.size(1), field=dataflow[1])
+                        if self.args.exit_threshold < 1:
+                            info['exit_depth'] = self.exit_depth
+                    else:
+                        translation_outputs, n_best = self.beam_search(encoding_outputs, source_masks, self.args.beam_size, self.args.alpha,
+                                                                       T=source_inputs.size(1), field=dataflow[1], n_best=self.args.n_best)
+                        if self.args.n_best > 1:
+                            info['n_best'] = [[(self.fields[dataflow[1]].reverse(tokens[None])[0], score) for tokens, score in hypotheses]
+                                              for hypotheses in n_best]
+                    self.io_dec.restrict(None)
+
+                if reverse:
+                    source_outputs = self.fields[dataflow[0]].reverse(source_outputs)
+                    target_outputs = self.fields[dataflow[1]].reverse(target_outputs)
                 
-                # specially for multi_step decoding #
-                if self.args.multi_width > 1:
-                    translation_outputs, saved_time, pred_acc, decisions = self.fields[dataflow[1]].reverse(translation_outputs, width=self.args.multi_width, return_saved_time=True)
+                    # specially for multi_step decoding #
+                    if self.args.multi_width > 1:
+                        translation_outputs, saved_time, pred_acc, decisions = self.fields[dataflow[1]].reverse(translation_outputs, width=self.args.multi_width, return_saved_time=True)
                     
-                    info['saved_time'] = saved_time
-                    info['pred_acc'] = pred_acc
-                    info['decisions'] = decisions
+                        info['saved_time'] = saved_time
+                        info['pred_acc'] = pred_acc
+                        info['decisions'] = decisions
                 
-                else:
-                    translation_outputs = self.fields[dataflow[1]].reverse(translation_outputs)
+                    else:
+                        translation_outputs = self.fields[dataflow[1]].reverse(translation_outputs)
 
-            info['src'] = source_outputs
-            info['trg'] = target_outputs
-            info['dec'] = translation_outputs
+                info['src'] = source_outputs
+                info['trg'] = target_outputs
+                info['dec'] = translation_outputs
         
         return info
 
+    def decoder_step(self, mode='eager'):
+        if mode not in self.decoder_steps:
+            step = DecoderStep(self)
+            if mode == 'script':
+                runner = torch.jit.script(step)
+            elif mode == 'compile':
+                runner = torch.compile(step, dynamic=True)
+            else:
+                runner = step
+            self.decoder_steps[mode] = (step, runner)
+        return self.decoder_steps[mode]
+
     def greedy_decoding(self, encoding=None, mask_src=None, T=None, field='trg'):
 
+        early_exit = self.args.exit_threshold < 1  # early exit runs in the layer loop below
+        average = self.decoder.average   # average attention: running sums instead of the keys of the prefix
+        if (self.args.jit_decoder != 'none') and (not early_exit) and self.single_step():
+            return self.step_decoding(encoding, mask_src, T, field)
+
         encoding = self.decoder.prepare_encoder(encoding)
         if T is None:
             T = encoding[0].size()[1]
@@ -118,97 +166,216 @@ class Transformer(Seq2Seq):
         T *= self.length_ratio
 
         outs = encoding[0].new_zeros(B, T + 1).long().fill_(self.fields[field].vocab.stoi['<init>'])
-        hiddens = [encoding[0].new_zeros(B, T, C) for l in range(len(self.decoder.layers) + 1)]
-        hiddens[0] = hiddens[0] + positional_encodings_like(hiddens[0])
-        eos_yet = encoding[0].new_zeros(B).byte()
+        positions = self.io_dec.pos.prefix(T)
+        hiddens = [encoding[0].new_zeros(B, min(encoding[0].size(1), T), C) for l in range(len(self.decoder.layers) + 1)]
+        eos_yet = encoding[0].new_zeros(B, dtype=torch.bool)
+        D = len(self.decoder.layers)
+        sums = [encoding[0].new_zeros(B, 1, C) for l in range(D)] if average else None
+        depths = [0, 0]  # early exit: decoder layers run, tokens decoded
 
         for t in range(T):
+            if t == hiddens[0].size(1):  # grown geometrically, instead of allocating T = length_ratio x source-length
+                hiddens = [grow(h, t + 1, T) for h in hiddens]
             
             # add dropout, etc.
-            hiddens[0][:, t] = self.decoder.prepare_embedding(hiddens[0][:, t] + self.io_dec.i(outs[:, t], pos=False))
-
-            for l in range(len(self.decoder.layers)):
-                x = hiddens[l][:, :t+1]
-                x = self.decoder.layers[l].selfattn(hiddens[l][:, t:t+1], x, x)   # we need to make the dimension 3D
+            hiddens[0][:, t] = self.decoder.prepare_embedding(positions[t] + self.io_dec.i(outs[:, t], pos=False))
+
+            exited = eos_yet.clone()   # early exit (--exit_threshold): finished sentences need no layer
+            exit_preds, exit_depth = outs.new_zeros(B), outs.new_zeros(B).fill_(D)
+            for l in range(D):
+                if average:
+                    x = hiddens[l][:, t:t+1]
+                    x = self.decoder.layers[l].selfattn(x, None, None, None, (sums[l] + x) / (t + 1))
+                else:
+                    x = hiddens[l][:, :t+1]
+                    x = self.decoder.layers[l].selfattn(hiddens[l][:, t:t+1], x, x)   # we need to make the dimension 3D
                 hiddens[l + 1][:, t] = self.decoder.layers[l].feedforward(
                     self.decoder.layers[l].crossattn(x, encoding[l], encoding[l], mask_src))[:, 0]
 
-            _, preds = self.io_dec.o(hiddens[-1][:, t]).max(-1)
+                if early_exit:
+                    hiddens[l + 1][:, t][exited] = hiddens[l][:, t][exited]  # the exited states are copied upwards (keys of the next steps)
+
+                if early_exit and (l < D - 1):
+                    confidence, candidates = softmax(self.io_dec.o(hiddens[l + 1][:, t])).max(-1)  # the shared output layer
+                    exits = (confidence > self.args.exit_threshold) & ~exited
+                    exit_preds[exits] = self.io_dec.tokens(candidates)[exits]
+                    exit_depth[exits] = l + 1
+                    exited = exited | exits
+                    if exited.all():
+                        for k in range(l + 1, D):
+                            hiddens[k + 1][:, t] = hiddens[l + 1][:, t]
+                        break
+
+            if average:
+                for l in range(D):
+                    sums[l] += hiddens[l][:, t:t+1]
+
+            if early_exit and exited.all():
+                preds = exit_preds
+            else:
+                preds = self.io_dec.top1(hiddens[-1][:, t])
+                if early_exit:
+                    preds[exited] = exit_preds[exited]
+            if early_exit:
+                depths[0] += exit_depth[~eos_yet].sum().item()
+                depths[1] += (~eos_yet).sum().item()
             preds[eos_yet] = self.fields[field].vocab.stoi['<pad>']
             eos_yet = eos_yet | (preds == self.fields[field].vocab.stoi['<eos>'])
             outs[:, t + 1] = preds
             if eos_yet.all():
                 break
 
+        self.exit_depth = depths[0] / max(depths[1], 1)  # average number of decoder layers per token
         return outs[:, 1:t+2]
 
-    def beam_search(self, encoding, mask_src=None, width=2, alpha=0.6, T=None, field='trg'):  # width: beamsize, alpha: length-norm
-        
-        encoding = self.decoder.prepare_encoder(encoding)
+    def step_decoding(self, encoding=None, mask_src=None, T=None, field='trg'):
+        """ greedy decoding with the single-step decoder module (--jit_decoder eager|script|compile) """
+        step, runner = self.decoder_step(self.args.jit_decoder)
 
-        W = width
+        encoding = self.decoder.prepare_encoder(encoding)
         if T is None:
-            T = encoding[0].size()
-        B, C = encoding[0].size()[0], encoding[0].size()[-1]  # batch_size, decoding-length, size
-
-        # expanding
-        for i in range(len(encoding)):
-            encoding[i] = encoding[i][:, None, :].expand(B, W, T, C).contiguous().view(B * W, T, C)
-        mask_src = mask_src[:, None, :].expand(B, W, T).contiguous().view(B * W, T)
-
+            T = encoding[0].size()[1]
+        B, C = encoding[0].size()[0], encoding[0].size()[-1]
         T *= self.length_ratio
-        outs = encoding[0].new_zeros(B, W, T + 1).long().fill_(self.fields[field].vocab.stoi['<pad>'])
-        outs[:, :, 0] = self.fields[field].vocab.stoi['<init>']
-
-        logps = encoding[0].new_zeros(B, W).float() # scores
-        hiddens = [encoding[0].new_zeros(B, W, T, C) for l in range(len(self.decoder.layers) + 1)]
 
-        hiddens[0] = hiddens[0] + positional_encodings_like(hiddens[0])
-        eos_yet = encoding[0].new_zeros(B, W).byte() # batch x beamsize, all the sentences are not finished yet.
-        eos_mask = eos_yet.float().fill_(INF)[:, :, None].expand(B, W, W).contiguous()  # --- BUG, logps < 0 assign INF here 
-                                                                                        # --- UPDATE: Aug 9, 2018: BUG again, expand needs contiguous
-                                                                                        # --- otherwise everything will become 0.
-        eos_mask[:, :, 0] = 0  # batch x beam x beam
+        outs = encoding[0].new_zeros(B, T + 1).long().fill_(self.fields[field].vocab.stoi['<init>'])
+        positions = self.io_dec.pos.prefix(T)
+        steps = torch.arange(T, device=outs.device)
+        keys, values, cross_keys, cross_values = step.caches(encoding, min(encoding[0].size(1), T))
+        eos_yet = encoding[0].new_zeros(B, dtype=torch.bool)
 
         for t in range(T):
-            hiddens[0][:, :, t] = self.decoder.prepare_embedding(hiddens[0][:, :, t] + self.io_dec.i(outs[:, :, t], pos=False))
+            if t == keys[0].size(2):
+                keys, values = [grow(k, t + 1, T, dim=2) for k in keys], [grow(v, t + 1, T, dim=2) for v in values]
+            preds = runner(outs[:, t], positions[t], steps[t], keys, values, cross_keys, cross_values, mask_src,
+                           self.io_dec.shortlist, self.io_dec.shortlist_weight)
+            preds[eos_yet] = self.fields[field].vocab.stoi['<pad>']
+            eos_yet = eos_yet | (preds == self.fields[field].vocab.stoi['<eos>'])
+            outs[:, t + 1] = preds
+            if eos_yet.all():
+                break
 
-            for l in range(len(self.layers)):
-                x = hiddens[l][:, :, :t + 1].contiguous().view(B * W, -1, C)
-                x = self.decoder.layers[l].selfattn(x[:, -1:, :], x, x)
-                hiddens[l + 1][:, :, t] = self.decoder.layers[l].feedforward(
-                    self.decoder.layers[l].crossattn(x, encoding[l], encoding[l], mask_src)).view(B, W, C)
+        return outs[:, 1:t+2]
 
-            # topk2_logps: scores, topk2_inds: top word index at each beam, batch x beam x beam
-            topk2_logps = log_softmax(self.io_dec.o(hiddens[-1][:, :, t]))
-            topk2_logps[:, :, self.fields[field].vocab.stoi['<pad>']] = -INF
-            topk2_logps, topk2_inds = topk2_logps.topk(W, dim=-1)
+    def single_step(self):   # can the decoder run as one DecoderStep module (full softmax, multi-head self-attention, float, tdan / tdna / tnda)
+        return (type(self.io_dec) is IO) and (not self.decoder.average) and \
+               (self.decoder.layers[0].selfattn.order.replace('d', '') in ('tan', 'tna')) and \
+               all(isinstance(layer.selfattn.layer.wqkv, nn.Linear) for layer in self.decoder.layers)
+
+    def beam_search(self, encoding, mask_src=None, width=2, alpha=1, T=None, field='trg', n_best=1):  # width: beamsize, alpha: length-norm
+        """
+        batched beam search with incremental states: the cached keys / values of every layer (DecoderStep), or, for the
+        models it does not support (adaptive softmax, average attention, int8), the inputs / running sums of every layer
+        with the log-probabilities of io_dec. W live hypotheses per sentence, scored by the sum of log-probabilities
+        divided by length ** alpha (the length counts <eos>), as tools.numpy_runtime. A sentence stops once W finished
+        hypotheses beat the best score any of its live ones can still reach; the rows of the finished sentences are
+        dropped. Returns the best hypotheses (batch x length, with <eos>) and the n-best (tokens, score) of every sentence.
+        """
+        vocab = self.fields[field].vocab
+        init, eos, pad = vocab.stoi['<init>'], vocab.stoi['<eos>'], vocab.stoi['<pad>']
 
-            # mask out the sentences which are finished
-            topk2_logps = topk2_logps * (eos_yet[:, :, None].float() * eos_mask + 1 - eos_yet[:, :, None].float())
-            topk2_logps = topk2_logps + logps[:, :, None]
+        encoding = self.decoder.prepare_encoder(encoding)
+        if T is None:
+            T = encoding[0].size(1)
+        B, W, C = encoding[0].size(0), width, encoding[0].size(-1)
+        T *= self.length_ratio
+        positions = self.io_dec.pos.prefix(T)
+        steps = torch.arange(T, device=mask_src.device)
+        D = len(self.decoder.layers)
+
+        # the state of every hypothesis (rows: sentence x beam) and the memory of the source, computed once per sentence
+        rows = torch.arange(B, device=mask_src.device).repeat_interleave(W)
+        if self.single_step():
+            step, runner = self.decoder_step('eager' if self.args.jit_decoder == 'none' else self.args.jit_decoder)
+            keys, values, cross_keys, cross_values = step.caches(encoding, min(encoding[0].size(1), T))
+            state, memory = keys + values, cross_keys + cross_values
+
+            def scores(tokens, t, state, memory, mask):
+                if t == state[0].size(2):
+                    state[:] = [grow(x, t + 1, T, dim=2) for x in state]
+                return runner.logits(tokens, positions[t], steps[t], state[:D], state[D:], memory[:D], memory[D:],
+                                     mask, self.io_dec.shortlist_weight)
+        else:   # the decoder layers, as greedy_decoding
+            average = self.decoder.average
+            state = [encoding[0].new_zeros(B, 1 if average else min(encoding[0].size(1), T), C) for l in range(D)]
+            memory = list(encoding)
+
+            def scores(tokens, t, state, memory, mask):
+                if (not average) and (t == state[0].size(1)):
+                    state[:] = [grow(x, t + 1, T) for x in state]
+                x = self.decoder.prepare_embedding(positions[t] + self.io_dec.i(tokens, pos=False))[:, None]
+                for l, layer in enumerate(self.decoder.layers):
+                    if average:
+                        h = layer.selfattn(x, None, None, None, (state[l] + x) / (t + 1))
+                        state[l] = state[l] + x
+                    else:
+                        state[l][:, t] = x[:, 0]
+                        h = layer.selfattn(x, state[l][:, :t + 1], state[l][:, :t + 1])
+                    x = layer.feedforward(layer.crossattn(h, memory[l], memory[l], mask))
+                return self.io_dec.o(x[:, 0])
+
+        state, memory = [x.index_select(0, rows) for x in state], [x.index_select(0, rows) for x in memory]
+        mask_src = mask_src.index_select(0, rows)
+
+        tokens = rows.new_zeros(B * W, 1).fill_(init)
+        logps = encoding[0].new_zeros(B, W).float()
+        logps[:, 1:] = -INF   # one live hypothesis at first
+
+        sentences = list(range(B))   # the sentences still searched, in the order of the rows
+        finished = [[] for _ in range(B)]
+        for t in range(T):
+            logits = log_softmax(scores(tokens[:, -1], t, state, memory, mask_src))
+            V = logits.size(-1)
+            logits[:, self.io_dec.tokens(torch.arange(V, device=rows.device)) == pad] = -INF
+            candidates, beams = (logits.view(-1, W, V) + logps[:, :, None]).view(-1, W * V).topk(2 * W, dim=-1)   # at most W <eos>
+            beams, words = beams // V, self.io_dec.tokens(beams % V)
+
+            # the first W candidates not ending with <eos> stay live; the <eos> candidates ranked above them are finished
+            ranks = torch.arange(2 * W, device=rows.device)[None, :]
+            live = (words != eos) & (candidates > -INF / 2)
+            live = live & (live.long().cumsum(-1) <= W)
+            last = (ranks * live.long()).max(-1)[0]
+            ended = (words == eos) & (candidates > -INF / 2) & (ranks <= last[:, None])
+
+            for i, k in ended.nonzero().tolist():
+                finished[sentences[i]].append((torch.cat([tokens[i * W + beams[i, k], 1:], words[i, k:k+1]]),
+                                               candidates[i, k].item() / (t + 1) ** alpha))
+
+            # W live hypotheses per sentence (padded by dead ones when there are fewer). The log-probability of a live
+            # hypothesis only decreases, and it ends with a length in (t + 1, T]: its best reachable score is the best
+            # of the two ends (alpha > 0: the longest).
+            order = ((~live).long() * 2 * W + ranks).sort(-1)[1][:, :W]
+            logps = torch.where(live.gather(1, order), candidates.gather(1, order), torch.full_like(logps, -INF))
+            best = logps.max(-1)[0]
+            best = torch.max(best / (t + 1) ** alpha, best / T ** alpha).tolist()
+            keep = []
+            for i, b in enumerate(sentences):
+                finished[b] = sorted(finished[b], key=lambda x: -x[1])[:max(W, n_best)]
+                if not ((len(finished[b]) >= W) and (finished[b][W - 1][1] > best[i])):
+                    keep.append(i)
+
+            # reorder (and drop the finished sentences from) the states, by the rows of the live hypotheses
+            keep = torch.tensor(keep, device=rows.device, dtype=torch.long)
+            index = ((keep * W)[:, None] + beams.index_select(0, keep).gather(1, order.index_select(0, keep))).view(-1)
+            tokens = torch.cat([tokens.index_select(0, index), words.index_select(0, keep).gather(1, order.index_select(0, keep)).view(-1, 1)], 1)
+            logps = logps.index_select(0, keep)
+            state = [x.index_select(0, index) for x in state]
+            if keep.size(0) < len(sentences):
+                index = (keep[:, None] * W + torch.arange(W, device=keep.device)[None, :]).view(-1)
+                memory, mask_src = [x.index_select(0, index) for x in memory], mask_src.index_select(0, index)
+                sentences = [sentences[i] for i in keep.tolist()]
+            if len(sentences) == 0:
+                break
 
-            if t == 0:
-                logps, topk_inds = topk2_logps[:, 0].topk(W, dim=-1)
-            else:
-                logps, topk_inds = topk2_logps.view(B, W * W).topk(W, dim=-1)
+        for i, b in enumerate(sentences):   # the unfinished hypotheses of the sentences still searched
+            finished[b] += [(tokens[i * W + w, 1:], logps[i, w].item() / (tokens.size(1) - 1) ** alpha)
+                            for w in range(W) if logps[i, w].item() > -INF / 2]
+        nbest = [sorted(f, key=lambda x: -x[1])[:n_best] for f in finished]
 
-            topk_beam_inds = topk_inds.div(W)
-            topk_token_inds = topk2_inds.view(B, W * W).gather(1, topk_inds)
-            eos_yet = eos_yet.gather(1, topk_beam_inds.data)
-            
-            # logps = logps * (1 - Variable(eos_yet.float()) * 1 / (t + 2)).pow(alpha) # -- bug
-            logps = logps * (1 + (eos_yet.float()) * 1 / (t + 1)).pow(alpha)
-            outs = outs.gather(1, topk_beam_inds[:, :, None].expand_as(outs)).contiguous()
-            outs[:, :, t + 1] = topk_token_inds
-            topk_beam_inds = topk_beam_inds[:, :, None, None].expand_as(hiddens[0]).contiguous()
-
-            for i in range(len(hiddens)):
-                hiddens[i] = hiddens[i].gather(1, topk_beam_inds)
-            eos_yet = eos_yet | (topk_token_inds == self.fields[self.trg].vocab.stoi['<eos>'])
-            if eos_yet.all():
-                return outs[:, 0, 1:]
-        return outs[:, 0, 1:]
+        outs = rows.new_zeros(B, max(f[0][0].size(0) for f in nbest)).fill_(pad)
+        for b, f in enumerate(nbest):
+            outs[b, :f[0][0].size(0)] = f[0][0]
+        return outs, nbest
 
     def simultaneous_decoding(self, input_stream, mask_stream, agent=None):
 
@@ -229,9 +396,10 @@ class Transformer(Seq2Seq):
         outputs_mask = mask_stream.new_zeros(B, T + 1)
 
         encoding_outputs = [input_stream.new_zeros(B, T, self.args.d_model).float() 
-                            for _ in range(self.args.n_layers + 1)]
+                            for _ in range(len(self.encoder.layers) + 1)]
         decoding_outputs = [input_stream.new_zeros(B, T, self.args.d_model).float()
-                            for _ in range(self.args.n_layers + 1)]
+                            for _ in range(len(self.decoder.layers) + 1)]
+        sources = self.decoder.source_layers(len(self.encoder.layers))
 
         t_enc = input_stream.new_zeros(B, 1)
         t_dec = input_stream.new_zeros(B, 1)
@@ -246,10 +414,10 @@ class Transformer(Seq2Seq):
 
             # encoding
             encoding_outputs[0][:, t:t+1] = self.io_enc.i(inputs[:, t:t+1], pos=False) 
-            encoding_outputs[0][:, t:t+1] += positional_encodings_like(encoding_outputs[0][:, t:t+1], t_enc)
+            encoding_outputs[0][:, t:t+1] += self.io_enc.pos(encoding_outputs[0][:, t:t+1], t_enc)
             encoding_outputs[0][:, t:t+1] = self.encoder.prepare_embedding(encoding_outputs[0][:, t:t+1])
 
-            for l in range(self.args.n_layers):
+            for l in range(len(self.encoder.layers)):
                 encoding_outputs[l + 1][:, t:t+1] = self.encoder.layers[l].feedforward(
                     self.encoder.layers[l].selfattn(
                         encoding_outputs[l][:, t:t+1], 
@@ -259,20 +427,20 @@ class Transformer(Seq2Seq):
 
             # decoding
             decoding_outputs[0][:, t:t+1] = self.io_dec.i(outputs[:, t:t+1], pos=False)
-            decoding_outputs[0][:, t:t+1] += positional_encodings_like(decoding_outputs[0][:, t:t+1], t_dec)
+            decoding_outputs[0][:, t:t+1] += self.io_dec.pos(decoding_outputs[0][:, t:t+1], t_dec)
             decoding_outputs[0][:, t:t+1] = self.decoder.prepare_embedding(decoding_outputs[0][:, t:t+1])
 
 
-            for l in range(self.args.n_layers):
+            for l in range(len(self.decoder.layers)):
                 x = decoding_outputs[l][:, :t+1]
                 x = self.decoder.layers[l].selfattn(decoding_outputs[l][:, t:t+1], x, x, outputs_mask[:, :t+1])
                 decoding_outputs[l + 1][:, t:t+1] = self.decoder.layers[l].feedforward(
                     self.decoder.layers[l].crossattn(
-                        x, encoding_outputs[l + 1][:, :t+1], 
-                        encoding_outputs[l + 1][:, :t+1], 
+                        x, encoding_outputs[sources[l] + 1][:, :t+1], 
+                        encoding_outputs[sources[l] + 1][:, :t+1], 
                         inputs_mask[:, :t+1]))
 
-            preds = self.io_dec.o(decoding_outputs[-1][:, t:t+1]).max(-1)[1]
+            preds = self.io_dec.top1(decoding_outputs[-1][:, t:t+1])
             
 
             # random :: decision
@@ -324,7 +492,7 @@ class Transformer(Seq2Seq):
         outputs = mask_stream.new_zeros(B, T2 + 1).long().fill_(self.fields[field].vocab.stoi['<init>'])
         outputs_mask = mask_stream.new_zeros(B, T2 + 1)
         decoding_outputs = [mask_stream.new_zeros(B, T2, self.args.d_model).float()
-                            for _ in range(self.args.n_layers + 1)]
+                            for _ in range(len(self.decoder.layers) + 1)]
 
         t_dec = mask_stream.new_zeros(B, 1).long()           # head
         paces = torch.arange(0, N, device=t_dec.get_device())
@@ -348,10 +516,10 @@ class Transformer(Seq2Seq):
 
             # 1. predict multiple words.
             decoding_outputs[0][:, t: t+offset] = self.io_dec.i(outputs[:, t:t+offset], pos=False)
-            decoding_outputs[0][:, t: t+offset] += positional_encodings_like(decoding_outputs[0][:, t:t+offset], pos)
+            decoding_outputs[0][:, t: t+offset] += self.io_dec.pos(decoding_outputs[0][:, t:t+offset], pos)
             decoding_outputs[0][:, t: t+offset] = self.decoder.prepare_embedding(decoding_outputs[0][:, t:t+offset])
 
-            for l in range(self.args.n_layers):
+            for l in range(len(self.decoder.layers)):
                 x = decoding_outputs[l][:, :t+offset]
                 x = self.decoder.layers[l].selfattn(decoding_outputs[l][:, t:t+offset], x, x, outputs_mask[:, :t+offset])
                 decoding_outputs[l + 1][:, t:t+offset] = self.decoder.layers[l].feedforward(
@@ -21,6 +21,7 @@ class AutoTransformer2(Transformer):
         self.io_enc = IO(src, args)
         if args.share_embeddings:
             self.io_enc.out.weight = self.io_dec.out.weight
+        self.io_enc.pos = self.io_dec.pos
 
         self.length_ratio = args.length_ratio
         self.fields = {'src': src, 'trg': trg}
@@ -0,0 +1,51 @@
+"""
+-- Shared helpers of the equivalence checks --
+Small random models (2 layers, d_model 64, 4 heads) on the dummy vocabularies of tools.benchmark:
+only the agreement between two code paths matters, not the translations.
+
+Run from the root of the repository:
+
+    python -m pytest -q tests
+"""
+import torch
+
+from models.transformer import Transformer
+from tools.benchmark import DummyField, model_args
+
+
+def small_args(**kwargs):
+    args = dict(d_model=64, d_hidden=128, n_layers=2, n_heads=4, n_cross_heads=4, vocab_size=40, length_ratio=2)
+    args.update(kwargs)
+    return model_args(**args)
+
+
+def small_model(seed=0, noise=0.0, eos_scale=1.0, **kwargs):
+    """ a random model in eval mode. noise spreads the (small) initial weights, eos_scale makes <eos> likelier. """
+    torch.manual_seed(seed)
+    args = small_args(**kwargs)
+    model = Transformer(DummyField(args.vocab_size), DummyField(args.vocab_size), args)
+    model.eval()
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * noise)
+        model.io_dec.out.weight[model.fields['trg'].vocab.stoi['<eos>']] *= eos_scale
+    return model
+
+
+def sources(B, S, vocab_size, seed=0):
+    """ B random source sentences of at most S tokens (the first one is full), padded with <pad>, and their masks. """
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(1, S + 1, (B,), generator=generator)
+    lengths[0] = S
+    masks = (torch.arange(S)[None, :] < lengths[:, None]).float()
+    tokens = torch.randint(4, vocab_size, (B, S), generator=generator).masked_fill(masks == 0, 1)
+    return tokens, masks
+
+
+def encode(model, tokens, masks):
+    """ the encoder outputs and the source masks, as Transformer.forward computes them for decoding. """
+    with torch.no_grad(), model.autocast():
+        x = model.io_enc.i(tokens, pos=True)
+        if model.downsample is not None:
+            x, masks = model.downsample(x, masks)
+        return model.encoder(x, masks), masks
@@ -0,0 +1,56 @@
+"""
+chunked attention (--attention_chunk) and the sliding window of --local_attention
+give the outputs and gradients of the dense attention.
+"""
+import pytest
+import torch
+
+from models.core import Attention
+
+
+def inputs(B, Tq, Tk, d, mask_dim=2, seed=0):
+    """ random queries / keys / values, keys padded at the end, and the query rows compared (the unpadded ones). """
+    torch.manual_seed(seed)
+    query, key, value = (torch.randn(B, T, d, requires_grad=True) for T in [Tq, Tk, Tk])
+    mask = (torch.arange(Tk)[None, :] < torch.randint(Tk // 2, Tk + 1, (B, 1))).float()
+    rows = mask[:, :, None] if Tq == Tk else torch.ones(B, Tq, 1)   # padded queries may see no key in their window
+    if mask_dim == 3:
+        mask = mask[:, None].expand(B, Tq, Tk).contiguous()
+    return query, key, value, mask, rows
+
+
+def gradients(output, tensors):
+    return torch.autograd.grad(output.pow(2).sum(), tensors)
+
+
+@pytest.mark.parametrize('causal, local, mask_dim, Tq, Tk', [
+    (False, False, 2, 37, 37), (True, False, 2, 37, 37), (True, False, 2, 5, 37),
+    (False, True, 2, 37, 37), (True, True, 2, 37, 37), (False, False, 3, 20, 33)])
+def test_chunked_attention(causal, local, mask_dim, Tq, Tk):
+    dense = Attention(64, 0.0, causal, local=local)
+    chunked = Attention(64, 0.0, causal, local=local, chunk=8)
+    query, key, value, mask, rows = inputs(6, Tq, Tk, 16, mask_dim)
+
+    a, b = dense(query, key, value, mask) * rows, chunked(query, key, value, mask) * rows
+    assert torch.allclose(a, b, atol=1e-5)
+    for x, y in zip(gradients(a, (query, key, value)), gradients(b, (query, key, value))):
+        assert torch.allclose(x, y, atol=1e-5)
+
+
+def test_chunked_attention_gradcheck():
+    chunked = Attention(64, 0.0, True, chunk=4)
+    query = torch.randn(2, 9, 4, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(lambda q: chunked(q, q, q), (query,))
+
+
+@pytest.mark.parametrize('causal', [False, True])
+@pytest.mark.parametrize('window', [1, 2, 5])
+def test_local_attention(causal, window):
+    attention = Attention(64, 0.0, causal, local=True, window=window)
+    query, key, value, mask, rows = inputs(6, 23, 23, 16)
+
+    banded = attention(query, key, value, mask) * rows                                      # sliding window
+    dense = attention(query, key, value, mask[:, None].expand(6, 23, 23).contiguous()) * rows   # 3-D masks: the dense path
+    assert torch.allclose(banded, dense, atol=1e-5)
+    for x, y in zip(gradients(banded, (query, key, value)), gradients(dense, (query, key, value))):
+        assert torch.allclose(x, y, atol=1e-5)
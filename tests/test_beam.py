@@ -0,0 +1,109 @@
+"""
+the batched beam search: width 1 gives the greedy outputs, the layer-loop state the n-best of the DecoderStep state,
+and the early stop the n-best of a search without it (960 sentences).
+"""
+import pytest
+import torch
+from torch.nn.functional import log_softmax
+
+from models.core import INF, quantize_int8
+from tests.common import encode, small_model, sources
+
+
+def beam(model, tokens, masks, width, alpha, n_best=1):
+    encoding, masks = encode(model, tokens, masks)
+    with torch.no_grad(), model.autocast():
+        return model.beam_search(encoding, masks, width, alpha, T=tokens.size(1), n_best=n_best)
+
+
+def full_search(model, tokens, masks, W, alpha, n_best):
+    """
+    beam search without the early stop, the decoder run over every whole prefix: at each step, the W best candidates
+    not ending with <eos> stay live and the <eos> candidates ranked above them are finished.
+    """
+    vocab = model.fields['trg'].vocab
+    init, eos, pad = vocab.stoi['<init>'], vocab.stoi['<eos>'], vocab.stoi['<pad>']
+    encoding, masks = encode(model, tokens, masks)
+    B, T = tokens.size(0), tokens.size(1) * model.length_ratio
+
+    live = [[([init], 0.0)] for _ in range(B)]
+    finished = [[] for _ in range(B)]
+    for t in range(T):
+        rows = [b for b in range(B) for _ in live[b]]
+        prefixes = torch.tensor([h for b in range(B) for h, _ in live[b]])
+        with torch.no_grad():
+            x = model.decoder(model.io_dec.i(prefixes), None, [e[rows] for e in encoding], masks[rows])[-1]
+            logits = log_softmax(model.io_dec.o(x[:, -1]).float(), dim=-1)
+        logits[:, pad] = -INF
+
+        k = 0
+        for b in range(B):
+            candidates = [(logp + logits[k + i, w].item(), h + [w])
+                          for i, (h, logp) in enumerate(live[b]) for w in range(logits.size(1)) if w != pad]
+            k += len(live[b])
+            live[b] = []
+            for logp, h in sorted(candidates, key=lambda x: -x[0]):
+                if len(live[b]) == W:
+                    break
+                if h[-1] == eos:
+                    finished[b].append((h[1:], logp / (t + 1) ** alpha))
+                else:
+                    live[b].append((h, logp))
+
+    for b in range(B):
+        finished[b] += [(h[1:], logp / T ** alpha) for h, logp in live[b]]
+    return [sorted(f, key=lambda x: -x[1])[:n_best] for f in finished]
+
+
+def test_early_stop():
+    total = same = 0
+    for seed in range(20):
+        model = small_model(seed, noise=0.3, eos_scale=1 + 0.2 * seed, length_ratio=3)
+        tokens, masks = sources(6, 7, model.args.vocab_size, seed)
+        for width in [2, 4]:
+            for alpha in [0, 0.6, 1, 1.5]:
+                n_best = beam(model, tokens, masks, width, alpha, n_best=width)[1]
+                reference = full_search(model, tokens, masks, width, alpha, n_best=width)
+                for hypotheses, expected in zip(n_best, reference):
+                    total += 1
+                    assert len(hypotheses) == len(expected)
+                    assert all(abs(h[1] - e[1]) < 1e-3 for h, e in zip(hypotheses, expected))
+                    same += [h[0].tolist() for h in hypotheses] == [e[0] for e in expected]
+    assert total == 960 and same >= 0.99 * total   # the tokens may differ at near-ties only
+
+
+@pytest.mark.parametrize('build', [
+    lambda: small_model(noise=0.5, eos_scale=2.5),
+    lambda: small_model(noise=0.5, eos_scale=2.5, n_kv_heads=2, block_order='tnda', layernorm='fused')])
+def test_layer_loop(build):
+    model = build()
+    assert model.single_step()
+    tokens, masks = sources(5, 9, model.args.vocab_size)
+    n_best = beam(model, tokens, masks, 4, 1, n_best=3)[1]
+    model.single_step = lambda: False
+    for hypotheses, expected in zip(beam(model, tokens, masks, 4, 1, n_best=3)[1], n_best):
+        assert [h[0].tolist() for h in hypotheses] == [e[0].tolist() for e in expected]
+        assert all(abs(h[1] - e[1]) < 1e-3 for h, e in zip(hypotheses, expected))
+
+
+@pytest.mark.parametrize('build', [
+    lambda: small_model(noise=0.5, eos_scale=2.5),
+    lambda: small_model(noise=0.5, eos_scale=2.5, adaptive_softmax=True),
+    lambda: small_model(noise=0.5, eos_scale=2.5, dec_selfattn='average'),
+    lambda: quantize_int8(small_model(noise=0.5, eos_scale=2.5)),
+    lambda: small_model(noise=0.5, eos_scale=2.5, precision='bf16'),
+    lambda: small_model(noise=0.5, eos_scale=2.5, precision='bf16', jit_decoder='script')])
+def test_width_one(build):
+    """
+    alpha = 0: a finished hypothesis stops the search once it beats the live one, as in greedy decoding. One sentence
+    at a time: the dynamic int8 quantization scales the activations of the whole batch, which shrinks in the beam search.
+    """
+    model = build()
+    tokens, masks = sources(5, 9, model.args.vocab_size)
+    for b in range(5):
+        length = int(masks[b].sum().item())
+        sentence, mask = tokens[b:b+1, :length], masks[b:b+1, :length]
+        encoding, source_mask = encode(model, sentence, mask)
+        with torch.no_grad(), model.autocast():
+            greedy = model.greedy_decoding(encoding, source_mask, T=length)
+        assert torch.equal(beam(model, sentence, mask, 1, 0)[0], greedy)
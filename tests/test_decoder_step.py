@@ -0,0 +1,72 @@
+"""
+the single-step decoder (--jit_decoder eager / script) gives the logits of the full decoder on random prefixes, and
+greedy decoding with it the outputs of the layer loop; the models it does not support fall back to the layer loop.
+"""
+import pytest
+import torch
+
+from models.core import MultiHead2, quantize_int8
+from tests.common import encode, small_model, sources
+
+
+def greedy(model, tokens, masks, mode):
+    model.args.jit_decoder = mode
+    encoding, masks = encode(model, tokens, masks)
+    with torch.no_grad(), model.autocast():
+        return model.greedy_decoding(encoding, masks, T=tokens.size(1))
+
+
+def pruned_model():
+    model = small_model(noise=0.5)
+    for module in model.modules():
+        if isinstance(module, MultiHead2):
+            module.prune([0, 2])
+    return model
+
+
+CONFIGS = [
+    lambda: small_model(noise=0.5),
+    lambda: small_model(noise=0.5, block_order='tdna'),
+    lambda: small_model(noise=0.5, block_order='tnda', layernorm='fused'),
+    lambda: small_model(noise=0.5, normalize_emb=True, share_embeddings=True),
+    lambda: small_model(noise=0.5, n_kv_heads=2),
+    pruned_model]
+
+
+@pytest.mark.parametrize('build', CONFIGS)
+@pytest.mark.parametrize('mode', ['eager', 'script'])
+def test_step_logits(build, mode):
+    model = build()
+    tokens, masks = sources(5, 9, model.args.vocab_size)
+    encoding, masks = encode(model, tokens, masks)
+    targets = torch.randint(4, model.args.vocab_size, (5, 12))
+    with torch.no_grad():
+        logits = model.io_dec.o(model.decoder(model.io_dec.i(targets), None, encoding, masks)[-1])   # teacher forcing
+
+        step, runner = model.decoder_step(mode)
+        keys, values, cross_keys, cross_values = step.caches(model.decoder.prepare_encoder(encoding), 12)
+        positions, steps = model.io_dec.pos.prefix(12), torch.arange(12)
+        for t in range(12):
+            outputs = runner.logits(targets[:, t], positions[t], steps[t], keys, values, cross_keys, cross_values, masks)
+            assert torch.allclose(outputs, logits[:, t], rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize('build', CONFIGS + [lambda: small_model(noise=0.5, precision='bf16')])
+def test_step_decoding(build):
+    model = build()
+    assert model.single_step()
+    tokens, masks = sources(5, 9, model.args.vocab_size)
+    outputs = greedy(model, tokens, masks, 'none')
+    for mode in ['eager', 'script']:
+        assert torch.equal(greedy(model, tokens, masks, mode), outputs)
+
+
+@pytest.mark.parametrize('build', [
+    lambda: small_model(noise=0.5, adaptive_softmax=True),
+    lambda: small_model(noise=0.5, dec_selfattn='average'),
+    lambda: quantize_int8(small_model(noise=0.5))])
+def test_fallback(build):
+    model = build()
+    assert not model.single_step()
+    tokens, masks = sources(5, 9, model.args.vocab_size)
+    assert torch.equal(greedy(model, tokens, masks, 'eager'), greedy(model, tokens, masks, 'none'))
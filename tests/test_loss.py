@@ -0,0 +1,27 @@
+"""
+the chunked loss (--loss_chunk) gives the loss and the gradients of cross_entropy_with_smooth over the full logits.
+"""
+import pytest
+import torch
+from torch import nn
+
+from models.core import chunked_cross_entropy_with_smooth, cross_entropy_with_smooth
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 64, 4096])
+def test_chunked_loss(chunk):
+    torch.manual_seed(0)
+    project = nn.Linear(16, 50)
+    inputs, targets = torch.randn(37, 16, requires_grad=True), torch.randint(0, 50, (37,))
+
+    def run(loss):
+        project.zero_grad()
+        inputs.grad = None
+        loss.backward()
+        return loss.detach(), [inputs.grad.clone(), project.weight.grad.clone(), project.bias.grad.clone()]
+
+    full, full_gradients = run(cross_entropy_with_smooth(project(inputs), targets, 0.1))
+    chunked, chunked_gradients = run(chunked_cross_entropy_with_smooth(project, inputs, targets, 0.1, chunk))
+    assert torch.allclose(full, chunked, atol=1e-6)
+    for a, b in zip(full_gradients, chunked_gradients):
+        assert torch.allclose(a, b, atol=1e-6)
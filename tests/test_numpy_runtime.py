@@ -0,0 +1,89 @@
+"""
+a model exported with tools.export_numpy and run by tools.numpy_runtime gives the logits, the greedy outputs and the
+beam search n-best of the PyTorch model.
+"""
+import numpy as np
+import pytest
+import torch
+
+from models.core import MultiHead2
+from tests.common import encode, small_model, sources
+from tools.export_numpy import export
+from tools.numpy_runtime import Translator
+
+
+def translator(model, path):
+    settings = dict(vars(model.args))
+    settings['base'] = 'bpe'
+    np.savez(str(path), **export(model.state_dict(), settings, model.fields['src'].vocab, model.fields['trg'].vocab))
+    return Translator(str(path))
+
+
+def pruned_model():
+    model = small_model(noise=0.5)
+    for module in model.modules():
+        if isinstance(module, MultiHead2):
+            module.prune([0, 2])
+    return model
+
+
+CONFIGS = [
+    lambda: small_model(noise=0.5),
+    lambda: small_model(noise=0.5, block_order='tdna'),
+    lambda: small_model(noise=0.5, block_order='tnda', layernorm='fused', normalize_emb=True),
+    lambda: small_model(noise=0.5, share_embeddings=True, cross_attn_fashion='reverse'),
+    lambda: small_model(noise=0.5, cross_attn_fashion='last_layer'),
+    lambda: small_model(noise=0.5, n_enc_layers=3, n_dec_layers=1),
+    lambda: small_model(noise=0.5, n_kv_heads=2),
+    lambda: small_model(noise=0.5, dec_selfattn='average'),
+    lambda: small_model(noise=0.5, downsample=2),
+    pruned_model]
+
+
+@pytest.mark.parametrize('build', CONFIGS)
+def test_logits_and_greedy(build, tmp_path):
+    model = build()
+    runtime = translator(model, tmp_path / 'model.npz')
+    tokens, masks = sources(4, 8, model.args.vocab_size)
+    encoding, source_masks = encode(model, tokens, masks)
+    np_encoding, np_masks = runtime.encode(tokens.numpy(), masks.numpy())
+    assert np.allclose(np_masks, source_masks.numpy())
+
+    targets = torch.randint(4, model.args.vocab_size, (4, 10))
+    with torch.no_grad():
+        logits = model.io_dec.o(model.decoder(model.io_dec.i(targets), None, encoding, source_masks)[-1])   # teacher forcing
+        outputs = model.greedy_decoding(encoding, source_masks, T=tokens.size(1))
+
+    state = runtime.start(np_encoding)
+    for t in range(10):
+        assert np.allclose(runtime.step(targets[:, t].numpy(), state, np_masks), logits[:, t].numpy(), rtol=1e-4, atol=1e-3)
+
+    np_outputs = runtime.greedy(np_encoding, np_masks, tokens.size(1) * model.args.length_ratio)
+    assert [best[0][0] for best in np_outputs] == outputs.tolist()
+
+
+def test_beam_search(tmp_path):
+    """ the n-best of both beam searches agree, up to near-ties between hypotheses (their scores still agree). """
+    total = same = 0
+    for seed in range(3):
+        for build in [lambda: small_model(seed, noise=0.5, eos_scale=1 + 0.5 * seed),
+                      lambda: small_model(seed, noise=0.5, eos_scale=1 + 0.5 * seed, n_kv_heads=2, block_order='tnda')]:
+            model = build()
+            runtime = translator(model, tmp_path / 'model.npz')
+            tokens, masks = sources(6, 8, model.args.vocab_size, seed)
+            encoding, source_masks = encode(model, tokens, masks)
+            np_encoding, np_masks = runtime.encode(tokens.numpy(), masks.numpy())
+            T = tokens.size(1) * model.args.length_ratio
+
+            for width in [2, 4, 8]:
+                for alpha in [0, 0.6, 1]:
+                    with torch.no_grad():
+                        n_best = model.beam_search(encoding, source_masks, width, alpha, T=tokens.size(1), n_best=3)[1]
+                    np_n_best = runtime.beam_search(np_encoding, np_masks, T, width, alpha, n_best=3)
+                    for hypotheses, np_hypotheses in zip(n_best, np_n_best):
+                        total += 1
+                        assert len(hypotheses) == len(np_hypotheses)
+                        assert hypotheses[0][0].tolist() == np_hypotheses[0][0]
+                        assert np.allclose([s for _, s in hypotheses], [s for _, s in np_hypotheses], rtol=1e-3, atol=1e-3)
+                        same += all(h[0].tolist() == n[0] for h, n in zip(hypotheses, np_hypotheses))
+    assert same >= 0.99 * total
@@ -0,0 +1,67 @@
+"""
+the vectorized Viterbi search and shift of MulIO (--multi_width) against the step-by-step versions they replaced,
+on 200 random cases (with ties).
+"""
+import torch
+
+from models.core import INF, MulIO, shift
+from tests.common import small_args
+from tools.benchmark import DummyField
+
+
+def loop_shift(x, n, right=False, value=0):
+    if x.dim() == 2:
+        x = x.unsqueeze(-1).expand(*x.size()[:2], n)
+    new_x = x.new_zeros(*x.size()) + value
+    new_x[:, :, 0] = x[:, :, 0]
+    for i in range(1, n):
+        if not right:
+            new_x[:, :-i, i] = x[:, i:, i]
+        else:
+            new_x[:, i:, i] = x[:, :-i, i]
+    return new_x
+
+
+def loop_viterbi(scores, shifted_masks, c=0):
+    batchsize, seqsize, blocksize = scores.size()
+    scores[:, :, 0] = scores[:, :, 0] - c
+    scores = loop_shift(scores * shifted_masks, blocksize, right=True, value=-INF)
+    decisions = scores.new_zeros(batchsize, seqsize, blocksize).long()
+    outputs = scores.new_zeros(batchsize, seqsize, blocksize).add_(-INF)
+    outputs[:, 0, 0] = scores[:, 0, 0]
+    for t in range(1, seqsize):
+        max_outputs, max_indx = outputs[:, t - 1].max(1)
+        outputs[:, t, 0] = max_outputs + scores[:, t, 0]
+        outputs[:, t, 1:] = outputs[:, t - 1, :-1] + scores[:, t, 1:]
+        reject_decisions = decisions[:, :t].gather(2, max_indx[:, None, None].expand(batchsize, t, 1))
+        decisions[:, t, 1:] = decisions[:, t - 1, :-1] + 1
+        decisions[:, :t, 1:] = decisions[:, :t, :-1].clone()
+        decisions[:, t, :1] = 0
+        decisions[:, :t, :1] = reject_decisions
+    best_outputs, best_indx = outputs[:, -1, :].max(1)
+    best_decision = decisions.gather(2, best_indx[:, None, None].expand(batchsize, seqsize, 1))
+    acceptance = (best_decision.squeeze(-1) != 0).long()
+    new_masks = scores.new_zeros(batchsize, seqsize, blocksize).scatter_(2, best_decision, 1)
+    new_masks = loop_shift(new_masks, blocksize, right=False) * shifted_masks
+    return acceptance, new_masks
+
+
+def test_shift_and_viterbi():
+    torch.manual_seed(0)
+    io = MulIO(DummyField(30), small_args(multi_width=4, dyn=0.5))
+    for trial in range(200):
+        B, T, W = torch.randint(1, 6, (1,)).item(), torch.randint(1, 30, (1,)).item(), torch.randint(2, 6, (1,)).item()
+        scores = torch.randn(B, T, W)
+        if trial % 3 == 0:
+            scores = scores.round()   # ties
+        for right in [False, True]:
+            for value in [0, -INF]:
+                assert torch.equal(shift(scores, W, right, value), loop_shift(scores, W, right, value))
+
+        masks = (torch.rand(B, T) > 0.2).float()
+        assert torch.equal(shift(masks, W), loop_shift(masks, W))
+
+        shifted_masks = loop_shift(masks, W)
+        acceptance, new_masks = io.viterbi(scores.clone(), shifted_masks, 0.3)
+        reference = loop_viterbi(scores.clone(), shifted_masks, 0.3)
+        assert torch.equal(acceptance, reference[0]) and torch.equal(new_masks, reference[1])
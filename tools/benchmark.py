@@ -0,0 +1,825 @@
+"""
+-- Micro-benchmarks for Squirrel --
+Run from the root of the repository, e.g.
+
+    python -m tools.benchmark positions --shapes 32x64 16x128 64x32 --threads 4
+    python -m tools.benchmark attention --lengths 256 512 1024 2048 --chunk 128
+    python -m tools.benchmark local --lengths 256 512 1024 2048 --window 2
+    python -m tools.benchmark loss --tokens 2048 4096 8192 --vocab_size 50000 --loss_chunk 1024
+    python -m tools.benchmark adaptive --tokens 2048 4096 8192 --vocab_size 50000 --batch 32
+    python -m tools.benchmark precision --shapes 32x32 16x64 --d_model 512 --n_layers 6
+    python -m tools.benchmark checkpoint --shapes 32x64 --layers 6 12 24 --every 0 1 2
+    python -m tools.benchmark reversible --shapes 32x64 --layers 6 12 24
+    python -m tools.benchmark quantize --shapes 1x32 16x32 --d_model 512 --n_layers 6
+    python -m tools.benchmark step --batches 1 2 4 8 16 32 64 --lengths 32
+    python -m tools.benchmark viterbi --lengths 64 128 256 512 --batch 64 --width 4
+    python -m tools.benchmark alloc --batches 1 8 32 --lengths 32
+    python -m tools.benchmark residual --shapes 32x64 64x32 --d_model 512
+    python -m tools.benchmark shortlist --batches 1 8 32 --lengths 32 --vocab_size 50000
+    python -m tools.benchmark depth --depths 12-1 6-3 6-6 --batch 1 --lengths 32
+    python -m tools.benchmark exit --thresholds 1 0.999 0.01 0 --batch 1 --lengths 32 --vocab_size 8000
+    python -m tools.benchmark average --lengths 32 128 512 --batch 1 --vocab_size 8000
+    python -m tools.benchmark gqa --kv_heads 8 4 2 1 --batch 20 --lengths 32
+    python -m tools.benchmark downsample --factors 1 2 4 --shapes 8x1000 --vocab_size 260
+    python -m tools.benchmark numpy --batches 1 8 32 --lengths 32 --vocab_size 16000
+    python -m tools.benchmark prune --ratios 0 0.25 0.5 0.75 --shapes 32x64 --batch 1 --lengths 32
+    python -m tools.benchmark beam --widths 1 4 6 8 --batch 16 --lengths 24 --vocab_size 16000
+
+All benchmarks use randomly initialized models and random tokens, so only the timing matters.
+"""
+import argparse
+import copy
+import time
+import torch
+
+from collections import Counter
+from models.core import *
+from models.transformer import Transformer
+
+
+# ====================== Dummy inputs =========================================== #
+
+class DummyVocab(object):
+    """ a frequency-sorted vocabulary like torchtext's: specials first. """
+    def __init__(self, size):
+        self.itos = ['<unk>', '<pad>', '<init>', '<eos>'] + ['w{}'.format(i) for i in range(size - 4)]
+        self.stoi = {w: i for i, w in enumerate(self.itos)}
+        self.freqs = Counter({w: 1000000 // (i + 1) for i, w in enumerate(self.itos[4:])})
+
+    def __len__(self):
+        return len(self.itos)
+
+
+class DummyField(object):
+    def __init__(self, size):
+        self.vocab = DummyVocab(size)
+
+    def reverse(self, batch, **kwargs):
+        return [' '.join(self.vocab.itos[i] for i in ex) for ex in batch.tolist()]
+
+
+class DummyBatch(object):
+    def __init__(self, B, T, vocab_size, device='cpu'):
+        self.src = torch.randint(4, vocab_size, (B, T + 1), device=device)
+        self.trg = torch.randint(4, vocab_size, (B, T + 1), device=device)
+
+
+def model_args(**kwargs):
+    """ t2t-base sized defaults; only the options used by the models. """
+    args = dict(d_model=512, d_hidden=2048, n_layers=6, n_enc_layers=None, n_dec_layers=None, n_heads=8, n_cross_heads=8, n_kv_heads=None, drop_ratio=0.1,
+                block_order='tdan', dec_selfattn='multihead', layernorm='std', normalize_emb=False, causal_enc=False, encoder_lm=False,
+                cross_attn_fashion='forward', share_embeddings=False, reversible_encoder=False, exit_threshold=1.0, exit_loss=0, relative_pos=False,
+                adaptive_softmax=False, adaptive_coverage=[0.8, 0.95], adaptive_div=4,
+                multi_width=1, dyn=0, constant_penalty=0, exact_match=False,
+                local_attention=0, local_window=2, attention_chunk=0, input_conv=0, downsample=1, length_ratio=2, label_smooth=0.1, loss_chunk=0,
+                beam_size=1, alpha=1, n_best=1, jit_decoder='none', inter_size=1, checkpoint_every=0, precision='fp32', local_rank=0, vocab_size=32000)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def build_model(args):
+    src, trg = DummyField(args.vocab_size), DummyField(args.vocab_size)
+    return Transformer(src, trg, args)
+
+
+def base_model(opts, **overrides):
+    """ the model of the command line (--d_model, --n_layers, --vocab_size; d_hidden = 4 x d_model), with the given options changed. """
+    args = dict(d_model=opts.d_model, d_hidden=opts.d_model * 4, n_layers=opts.n_layers, vocab_size=opts.vocab_size)
+    args.update(overrides)
+    return build_model(model_args(**args))
+
+
+def shapes(values):
+    return [tuple(int(a) for a in v.split('x')) for v in values]
+
+
+def timeit(fn, repeat=10, warmup=2):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000  # millisecs
+
+
+def saved_bytes(fn):
+    """ run fn, and count the bytes of the activations kept for backward (each storage counted once). """
+    storages = dict()
+
+    def pack(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        outputs = fn()
+    return outputs, sum(storages.values())
+
+
+def allocated_bytes(fn):
+    """ run fn, and count the bytes allocated on CPU (torch.profiler). """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        outputs = fn()
+    return outputs, sum(e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0)
+
+
+# ====================== Benchmarks =========================================== #
+
+def bench_positions(opts):
+    """ position table and attention masks: rebuilt per call (before) v.s. cached (after). """
+    args = model_args(d_model=opts.d_model, n_layers=opts.n_layers, vocab_size=opts.vocab_size)
+    model = build_model(args)
+    table = PositionalEncoding(args.d_model)
+
+    print('{:>10} | {:>12} {:>12} | {:>12} {:>12} | {:>12}'.format(
+          'B x T', 'pos (old)', 'pos (new)', 'mask (old)', 'mask (new)', 'forward'))
+    for B, T in shapes(opts.shapes):
+        x = torch.randn(B, T, args.d_model)
+
+        def old_mask():
+            tri = x.new(T, T).fill_(1).triu(1) * INF
+            window_mask = x.new_ones(T, T)
+            window_mask = (window_mask.triu(3) + window_mask.tril(-3)) * INF
+            return tri, window_mask
+
+        def new_mask():
+            return cached_mask(T, x.device, x.dtype), cached_mask(T, x.device, x.dtype, window=2)
+
+        batch = DummyBatch(B, T, args.vocab_size)
+        model.train()
+
+        def forward():
+            with torch.no_grad():
+                model(batch)
+
+        print('{:>10} | {:>10.3f}ms {:>10.3f}ms | {:>10.3f}ms {:>10.3f}ms | {:>10.3f}ms'.format(
+              '{}x{}'.format(B, T),
+              timeit(lambda: positional_encodings_like(x), opts.repeat * 10), timeit(lambda: table(x), opts.repeat * 10),
+              timeit(old_mask, opts.repeat * 10), timeit(new_mask, opts.repeat * 10),
+              timeit(forward, opts.repeat)))
+
+
+def bench_attention(opts):
+    """ full v.s. chunked (online-softmax) attention: activation memory and time of forward + backward. """
+    n_heads = 8
+    print('{:>6} | {:>14} {:>14} | {:>12} {:>12}'.format('T', 'memory (full)', 'memory (chunk)', 'time (full)', 'time (chunk)'))
+    for T in opts.lengths:
+        q, k, v = (torch.randn(opts.batch * n_heads, T, opts.d_model // n_heads, requires_grad=True) for _ in range(3))
+        mask = q.new_ones(opts.batch * n_heads, T)
+
+        results = []
+        for chunk in [0, opts.chunk]:
+            attention = Attention(opts.d_model, 0.1, causal=opts.causal, chunk=chunk)
+
+            def step():
+                outputs, memory = saved_bytes(lambda: attention(q, k, v, mask))
+                outputs.sum().backward()
+                return memory
+
+            results += [step() / 1024 ** 2, timeit(step, opts.repeat, warmup=1)]
+        print('{:>6} | {:>12.1f}MB {:>12.1f}MB | {:>10.1f}ms {:>10.1f}ms'.format(T, results[0], results[2], results[1], results[3]))
+
+
+def bench_local(opts):
+    """ local attention: full scores with a band mask (3-D mask fallback) v.s. the sliding-window scores. """
+    n_heads = 8
+    print('{:>6} | {:>14} {:>14} | {:>12} {:>12}'.format('T', 'memory (band)', 'memory (slide)', 'time (band)', 'time (slide)'))
+    for T in opts.lengths:
+        q, k, v = (torch.randn(opts.batch * n_heads, T, opts.d_model // n_heads, requires_grad=True) for _ in range(3))
+        attention = Attention(opts.d_model, 0.1, causal=opts.causal, local=True, window=opts.window)
+
+        results = []
+        for mask in [q.new_ones(opts.batch * n_heads, T, T), q.new_ones(opts.batch * n_heads, T)]:
+
+            def step():
+                outputs, memory = saved_bytes(lambda: attention(q, k, v, mask))
+                outputs.sum().backward()
+                return memory
+
+            results += [step() / 1024 ** 2, timeit(step, opts.repeat, warmup=1)]
+        print('{:>6} | {:>12.1f}MB {:>12.1f}MB | {:>10.1f}ms {:>10.1f}ms'.format(T, results[0], results[2], results[1], results[3]))
+
+
+def bench_loss(opts):
+    """ label-smoothed loss over all the target tokens at once v.s. over slices (--loss_chunk). """
+    print('{:>8} | {:>14} {:>14} | {:>12} {:>12}'.format('tokens', 'memory (full)', 'memory (chunk)', 'time (full)', 'time (chunk)'))
+    for N in opts.tokens:
+        results = []
+        for chunk in [0, opts.loss_chunk]:
+            io = IO(DummyField(opts.vocab_size), model_args(d_model=opts.d_model, loss_chunk=chunk))
+            outputs = torch.randn(1, N, opts.d_model, requires_grad=True)
+            targets = torch.randint(4, opts.vocab_size, (1, N))
+            masks = outputs.new_ones(1, N)
+
+            def step():
+                loss, memory = saved_bytes(lambda: io.cost(targets, masks, outputs, label_smooth=0.1)['MLE'])
+                loss.backward()
+                return memory
+
+            results += [step() / 1024 ** 2, timeit(step, opts.repeat, warmup=1)]
+        print('{:>8} | {:>12.1f}MB {:>12.1f}MB | {:>10.1f}ms {:>10.1f}ms'.format(N, results[0], results[2], results[1], results[3]))
+
+
+def bench_adaptive(opts):
+    """ full softmax v.s. adaptive softmax (--adaptive_softmax) on a word-level vocabulary: training loss and greedy steps. """
+    field = DummyField(opts.vocab_size)
+    ios = [IO(field, model_args(d_model=opts.d_model)),
+           AdaptiveIO(field, model_args(d_model=opts.d_model, adaptive_softmax=True))]
+    print('cutoffs: {}'.format(ios[1].cutoffs))
+
+    # targets follow the (Zipfian) counts of the dummy vocabulary
+    counts = torch.tensor([float(field.vocab.freqs.get(w, 0)) for w in field.vocab.itos])
+    print('{:>8} | {:>12} {:>12} | {:>12} {:>12}'.format('tokens', 'loss (full)', 'loss (adapt)', 'step (full)', 'step (adapt)'))
+    for N in opts.tokens:
+        outputs = torch.randn(1, N, opts.d_model, requires_grad=True)
+        targets = torch.multinomial(counts, N, replacement=True)[None, :]
+        masks = outputs.new_ones(1, N)
+        hiddens = torch.randn(opts.batch, opts.d_model)
+
+        results = []
+        for io in ios:
+            results.append(timeit(lambda: io.cost(targets, masks, outputs, label_smooth=0.1)['MLE'].backward(), opts.repeat))
+        for io in ios:
+            with torch.no_grad():
+                results.append(timeit(lambda: io.top1(hiddens), opts.repeat * 10))
+        print('{:>8} | {:>10.1f}ms {:>10.1f}ms | {:>10.3f}ms {:>10.3f}ms'.format(N, *results))
+
+
+def bench_precision(opts):
+    """ fp32 v.s. bf16 autocast (--precision bf16): training and greedy decoding throughput, and how much the outputs move. """
+    model = base_model(opts)
+
+    print('{:>10} | {:>12} {:>12} | {:>12} {:>12} | {:>10} {:>10}'.format(
+          'B x T', 'train (fp32)', 'train (bf16)', 'dec (fp32)', 'dec (bf16)', 'loss diff', 'same dec'))
+    for B, T in shapes(opts.shapes):
+        batch = DummyBatch(B, T, opts.vocab_size)
+        results, losses, decodes = [], [], []
+        for precision in ['fp32', 'bf16']:
+            model.args.precision = precision
+
+            def train():
+                model.train()
+                model.zero_grad()
+                loss = model(batch)['loss']
+                loss.backward()
+                return loss
+
+            def decode():
+                model.eval()
+                with torch.no_grad():
+                    return model(batch, decoding=True, reverse=False)['dec']
+
+            results += [B * T / timeit(train, opts.repeat, warmup=1) * 1000, B / timeit(decode, opts.repeat, warmup=1) * 1000]
+            torch.manual_seed(19920206)
+            losses.append(train().item())
+            decodes.append(decode())
+        model.args.precision = 'fp32'
+        print('{:>10} | {:>8.0f}tok/s {:>8.0f}tok/s | {:>7.1f}sent/s {:>7.1f}sent/s | {:>10.4f} {:>9.1f}%'.format(
+              '{}x{}'.format(B, T), results[0], results[2], results[1], results[3],
+              abs(losses[0] - losses[1]), (decodes[0] == decodes[1]).float().mean().item() * 100))
+
+
+def bench_checkpoint(opts):
+    """ activation checkpointing (--checkpoint_every k): activation memory and training throughput for several depths. """
+    B, T = shapes(opts.shapes)[0]
+    batch = DummyBatch(B, T, opts.vocab_size)
+
+    print('{:>8} | {:>8} | {:>14} | {:>12}'.format('n_layers', 'k', 'memory', 'train'))
+    for n_layers in opts.layers:
+        torch.manual_seed(19920206)
+        model = base_model(opts, n_layers=n_layers)
+        model.train()
+        for k in opts.every:
+            for stack in [model.encoder, model.decoder]:
+                stack.checkpoint_every = k
+
+            def train():
+                model.zero_grad()
+                loss, memory = saved_bytes(lambda: model(batch)['loss'])
+                loss.backward()
+                return memory
+
+            memory = train() / 1024 ** 2
+            print('{:>8} | {:>8} | {:>12.1f}MB | {:>7.0f}tok/s'.format(
+                  n_layers, k, memory, B * T / timeit(train, opts.repeat, warmup=1) * 1000))
+
+
+def bench_reversible(opts):
+    """ encoder Stack v.s. reversible RevStack (--reversible_encoder): activation memory and throughput for several depths. """
+    B, T = shapes(opts.shapes)[0]
+    x = torch.randn(B, T, opts.d_model, requires_grad=True)
+    mask = x.new_ones(B, T)
+
+    print('{:>8} | {:>14} {:>14} | {:>12} {:>12}'.format('n_layers', 'memory (stack)', 'memory (rev)', 'train (stack)', 'train (rev)'))
+    for n_layers in opts.layers:
+        args = model_args(d_model=opts.d_model, d_hidden=opts.d_model * 4, n_layers=n_layers, cross_attn_fashion='last_layer')
+        results = []
+        for encoder in [Stack(None, args), RevStack(None, args)]:
+            encoder.train()
+
+            def train():
+                encoder.zero_grad()
+                outputs, memory = saved_bytes(lambda: encoder(x, mask)[-1])
+                outputs.sum().backward()
+                return memory
+
+            results += [train() / 1024 ** 2, B * T / timeit(train, opts.repeat, warmup=1) * 1000]
+        print('{:>8} | {:>12.1f}MB {:>12.1f}MB | {:>7.0f}tok/s {:>7.0f}tok/s'.format(n_layers, results[0], results[2], results[1], results[3]))
+
+
+def bench_quantize(opts):
+    """ fp32 v.s. dynamic int8 (ez_run.py --mode quantize): greedy decoding speed and agreement on CPU. """
+    model = base_model(opts)
+    model.eval()
+    models = [model, quantize_int8(copy.deepcopy(model))]
+
+    print('{:>10} | {:>12} {:>12} | {:>8}'.format('B x T', 'dec (fp32)', 'dec (int8)', 'same dec'))
+    for B, T in shapes(opts.shapes):
+        batch = DummyBatch(B, T, opts.vocab_size)
+        results, decodes = [], []
+        for m in models:
+            with torch.no_grad():
+                results.append(B / timeit(lambda: m(batch, decoding=True, reverse=False), opts.repeat, warmup=1) * 1000)
+                decodes.append(m(batch, decoding=True, reverse=False)['dec'])
+        print('{:>10} | {:>7.1f}sent/s {:>7.1f}sent/s | {:>7.1f}%'.format(
+              '{}x{}'.format(B, T), results[0], results[1], (decodes[0] == decodes[1]).float().mean().item() * 100))
+
+
+def bench_step(opts):
+    """ greedy decoding: per-step latency of the layer loop v.s. the single-step decoder (--jit_decoder eager|script|compile). """
+    model = base_model(opts)
+    model.eval()
+    modes = ['none', 'eager', 'script', 'compile']
+
+    print('{:>6} | '.format('B') + ' '.join('{:>12}'.format(m) for m in modes))
+    for B in opts.batches:
+        batch = DummyBatch(B, opts.lengths[0], opts.vocab_size)
+        results = []
+        for mode in modes:
+            model.args.jit_decoder = mode
+            with torch.no_grad():
+                source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+                encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+
+                def decode():
+                    return model.greedy_decoding(encoding, source_masks).size(1)
+
+                steps = decode()
+                results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+        model.args.jit_decoder = 'none'
+        print('{:>6} | '.format(B) + ' '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_viterbi(opts):
+    """ MulIO.viterbi / shift (--dyn > 0): the previous loops (full decision copies per step) v.s. backpointers. """
+
+    def shift_loop(x, n, right=False, value=0):
+        if x.dim() == 2:
+            x = x.unsqueeze(-1).expand(*x.size()[:2], n)
+        new_x = x.new_zeros(*x.size()) + value
+        new_x[:, :, 0] = x[:, :, 0]
+        for i in range(1, n):
+            if not right:
+                new_x[:, :-i, i] = x[:, i:, i]
+            else:
+                new_x[:, i:, i] = x[:, :-i, i]
+        return new_x
+
+    def viterbi_loop(scores, shifted_masks):
+        batchsize, seqsize, blocksize = scores.size()
+        scores = shift_loop(scores * shifted_masks, blocksize, right=True, value=-INF)
+        decisions = scores.new_zeros(batchsize, seqsize, blocksize).long()
+        outputs = scores.new_zeros(batchsize, seqsize, blocksize).add_(-INF)
+        outputs[:, 0, 0] = scores[:, 0, 0]
+        for t in range(1, seqsize):
+            max_outputs, max_indx = outputs[:, t-1].max(1)
+            outputs[:, t, 0] = max_outputs + scores[:, t, 0]
+            outputs[:, t, 1:] = outputs[:, t-1, :-1] + scores[:, t, 1:]
+            reject_decisions = decisions[:, :t].gather(2, max_indx[:, None, None].expand(batchsize, t, 1))
+            decisions[:,  t, 1:] = decisions[:, t-1, :-1] + 1
+            decisions[:, :t, 1:] = decisions[:, :t,  :-1].clone()
+            decisions[:,  t, :1] = 0
+            decisions[:, :t, :1] = reject_decisions
+        best_decision = decisions.gather(2, outputs[:, -1, :].max(1)[1][:, None, None].expand(batchsize, seqsize, 1))
+        new_masks = scores.new_zeros(batchsize, seqsize, blocksize).scatter_(2, best_decision, 1)
+        return (best_decision.squeeze(-1) != 0).long(), shift_loop(new_masks, blocksize, right=False) * shifted_masks
+
+    W = opts.width
+    io = MulIO(DummyField(100), model_args(d_model=8, multi_width=W, dyn=0.5))
+    print('{:>6} | {:>12} {:>12} | {:>12} {:>12} | {:>6}'.format('T', 'shift (loop)', 'shift (new)', 'viterbi (loop)', 'viterbi (new)', 'same'))
+    for T in opts.lengths:
+        masks = shift(torch.ones(opts.batch, T), W)
+        scores = torch.randn(opts.batch, T, W)
+        same = all((a == b).all().item() for a, b in zip(viterbi_loop(scores.clone(), masks), io.viterbi(scores.clone(), masks)))
+        print('{:>6} | {:>10.3f}ms {:>10.3f}ms | {:>12.2f}ms {:>11.2f}ms | {:>6}'.format(T,
+              timeit(lambda: shift_loop(scores, W, right=True, value=-INF), opts.repeat * 10),
+              timeit(lambda: shift(scores, W, right=True, value=-INF), opts.repeat * 10),
+              timeit(lambda: viterbi_loop(scores.clone(), masks), opts.repeat),
+              timeit(lambda: io.viterbi(scores.clone(), masks), opts.repeat), str(same)))
+
+
+def bench_alloc(opts):
+    """ bytes allocated per decoding step: embedding lookup (scale-then-lookup before) and greedy decoding. """
+    model = base_model(opts)
+    model.eval()
+    io = model.io_dec
+
+    print('{:>6} | {:>14} {:>14} | {:>14} {:>14}'.format('B', 'emb (before)', 'emb (after)', 'greedy', 'greedy (step)'))
+    for B in opts.batches:
+        batch = DummyBatch(B, opts.lengths[0], opts.vocab_size)
+        tokens = batch.trg[:, 0]
+        results = []
+        with torch.no_grad():
+            results.append(allocated_bytes(lambda: F.embedding(tokens, io.out.weight * io.scale))[1])
+            results.append(allocated_bytes(lambda: io.i(tokens, pos=False))[1])
+
+            source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+            encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+            for mode in ['none', 'eager']:
+                model.args.jit_decoder = mode
+                outs, memory = allocated_bytes(lambda: model.greedy_decoding(encoding, source_masks))
+                results.append(memory / outs.size(1))
+            model.args.jit_decoder = 'none'
+        print('{:>6} | '.format(B) + ' '.join('{:>12.1f}KB'.format(r / 1024) for r in results))
+
+
+def bench_residual(opts):
+    """ ResidualBlock (around a d x d Linear) per order: the order walked per call with the two-pass norm (before),
+        specialized at construction (std), with the native layer norm only (norm), and with the native layer norm and
+        the dropout + residual add in one op (--layernorm fused). forward + backward. """
+
+    def walk(block, *x):   # previous ResidualBlock.forward / LayerNorm.forward
+        y = x
+        assert len(block.order) >= 4, 'at least 4 operations in one block'
+        assert block.order[0] == 't', 'we must start from transformation'
+        for c in block.order:
+            if c == 't':
+                y = block.layer(*y)
+            elif c == 'd':
+                y = block.dropout(y)
+            elif c == 'a':
+                y = x[block.pos] + y
+            elif c == 'n':
+                mean = y.mean(-1, keepdim=True)
+                std = y.std(-1, keepdim=True)
+                y = block.layernorm.gamma * (y - mean) / (std + block.layernorm.eps) + block.layernorm.beta
+        return y
+
+    print('{:>10} | {:>6} | {:>12} {:>12} {:>12} {:>12}'.format('B x T', 'order', 'before', 'std', 'norm', 'fused'))
+    for B, T in shapes(opts.shapes):
+        x = torch.randn(B, T, opts.d_model, requires_grad=True)
+        for order in ['tdan', 'tdna', 'tnda']:
+            results = []
+            for fused, forward in [(False, walk), (False, None), (True, 'norm'), (True, None)]:
+                block = ResidualBlock(Linear(opts.d_model, opts.d_model), opts.d_model, 0.1, order=order, fused=fused)
+                if forward == 'norm':   # the native norm, with the dropout and the add as separate ops
+                    block.residual = {'tdan': block.post_norm, 'tdna': block.pre_add, 'tnda': block.pre_dropout}[order]
+                    forward = None
+                forward = forward or (lambda block, *x: block(*x))
+
+                def train():
+                    forward(block, x).sum().backward()
+
+                results.append(timeit(train, opts.repeat, warmup=1))
+            print('{:>10} | {:>6} | '.format('{}x{}'.format(B, T), order) + ' '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_shortlist(opts):
+    """ greedy decoding (--jit_decoder none / eager): per-step latency over the full vocabulary v.s. a shortlist
+        (--shortlist; a random lexical table with --shortlist_k candidates per source word here). """
+    model = base_model(opts)
+    model.eval()
+    table = torch.randint(4, opts.vocab_size, (opts.vocab_size, opts.shortlist_k))
+
+    print('{:>6} | {:>10} | {:>12} {:>12} | {:>12} {:>12}'.format('B', 'shortlist', 'full', 'shortlist', 'full (step)', 'short (step)'))
+    for B in opts.batches:
+        batch = DummyBatch(B, opts.lengths[0], opts.vocab_size)
+        results = []
+        with torch.no_grad():
+            source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+            encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+            shortlist = Shortlist(table, model.fields['trg'].vocab, opts.shortlist_frequent).candidates(source_inputs)
+            for mode in ['none', 'eager']:
+                model.args.jit_decoder = mode
+                for restricted in [None, shortlist]:
+                    model.io_dec.restrict(restricted)
+
+                    def decode():
+                        return model.greedy_decoding(encoding, source_masks).size(1)
+
+                    steps = decode()
+                    results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+            model.io_dec.restrict(None)
+            model.args.jit_decoder = 'none'
+        print('{:>6} | {:>10} | '.format(B, shortlist.size(0)) + ' '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_depth(opts):
+    """ encoder-decoder depths (--n_enc_layers / --n_dec_layers): encoding time and greedy decoding latency per step. """
+    print('{:>8} | {:>10} | {:>12} | {:>12} {:>12}'.format('enc-dec', 'params', 'encode', 'step', 'step (jit)'))
+    for depth in opts.depths:
+        E, D = [int(n) for n in depth.split('-')]
+        torch.manual_seed(19920206)
+        model = base_model(opts, n_enc_layers=E, n_dec_layers=D)
+        model.eval()
+        batch = DummyBatch(opts.batch, opts.lengths[0], opts.vocab_size)
+
+        results = []
+        with torch.no_grad():
+            source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+
+            def encode():
+                return model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+
+            results.append(timeit(encode, opts.repeat, warmup=1))
+            encoding = encode()
+            for mode in ['none', 'eager']:
+                model.args.jit_decoder = mode
+
+                def decode():
+                    return model.greedy_decoding(encoding, source_masks).size(1)
+
+                steps = decode()
+                results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+            model.args.jit_decoder = 'none'
+
+        params = sum(p.numel() for p in model.parameters()) / 1e6
+        print('{:>8} | {:>9.1f}M | '.format(depth, params) + ' '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_exit(opts):
+    """ early-exit greedy decoding (--exit_threshold): decoder layers per token and latency per step.
+        The confidences of a random model mean nothing: this only shows the latency for the depths reached. """
+    model = base_model(opts)
+    model.eval()
+    batch = DummyBatch(opts.batch, opts.lengths[0], opts.vocab_size)
+
+    print('{:>10} | {:>8} | {:>12}'.format('threshold', 'layers', 'step'))
+    with torch.no_grad():
+        source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+        encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+        for threshold in opts.thresholds:
+            model.args.exit_threshold = threshold
+
+            def decode():
+                return model.greedy_decoding(encoding, source_masks).size(1)
+
+            steps = decode()
+            latency = timeit(decode, opts.repeat, warmup=1) / steps
+            print('{:>10} | {:>8.2f} | {:>10.3f}ms'.format(threshold, model.exit_depth if threshold < 1 else len(model.decoder.layers), latency))
+        model.args.exit_threshold = 1.0
+
+
+def bench_average(opts):
+    """ average attention in the decoder (--dec_selfattn average): greedy decoding latency per step v.s. the output length
+        (--lengths) for a source of 16 tokens. <eos> is never predicted, so every output has the full length. """
+    print('{:>6} | {:>12} {:>12} | {:>12}'.format('T', 'multihead', '(jit)', 'average'))
+    for T in opts.lengths:
+        results = []
+        for selfattn, mode in [('multihead', 'none'), ('multihead', 'eager'), ('average', 'none')]:
+            torch.manual_seed(19920206)
+            model = base_model(opts, dec_selfattn=selfattn, jit_decoder=mode, length_ratio=max(T // 16, 1))
+            model.eval()
+            model.fields['trg'].vocab.stoi['<eos>'] = -1
+            batch = DummyBatch(opts.batch, 15, opts.vocab_size)
+            with torch.no_grad():
+                source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+                encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+
+                def decode():
+                    return model.greedy_decoding(encoding, source_masks).size(1)
+
+                steps = decode()
+                results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+        print('{:>6} | {:>10.3f}ms {:>10.3f}ms | {:>10.3f}ms'.format(steps, *results))
+
+
+def bench_gqa(opts):
+    """ grouped-query attention in the decoder (--n_kv_heads): size of the key / value caches of the single-step decoder,
+        the time to reorder them (the gather of beam search, batch x beam rows) and the latency per step. """
+    print('{:>8} | {:>12} | {:>12} | {:>12}'.format('kv heads', 'caches', 'gather', 'step'))
+    for G in opts.kv_heads:
+        torch.manual_seed(19920206)
+        model = base_model(opts, n_kv_heads=G, jit_decoder='eager')
+        model.eval()
+        batch = DummyBatch(opts.batch, opts.lengths[0], opts.vocab_size)
+        with torch.no_grad():
+            source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+            encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+            step, _ = model.decoder_step('eager')
+            caches = step.caches(model.decoder.prepare_encoder(encoding), source_inputs.size(1) * model.length_ratio)
+            caches = [c for cache in caches for c in cache]
+            size = sum(c.numel() * c.element_size() for c in caches)
+            order = torch.randperm(opts.batch)
+
+            def gather():
+                return [c.index_select(0, order) for c in caches]
+
+            def decode():
+                return model.greedy_decoding(encoding, source_masks).size(1)
+
+            results = [timeit(gather, opts.repeat, warmup=1)]
+            steps = decode()
+            results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+        print('{:>8} | {:>10.1f}KB | '.format(G, size / 1024) + ' | '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_downsample(opts):
+    """ strided downsampling of the source (--downsample), e.g. byte-level inputs: training step time and greedy decoding
+        latency per step (32 steps), v.s. the factor. """
+    print('{:>6} | {:>10} | {:>8} | {:>12} | {:>12}'.format('factor', 'shape', 'encoder', 'train', 'step'))
+    for B, T in shapes(opts.shapes):
+        batch = DummyBatch(B, T, opts.vocab_size)
+        for factor in opts.factors:
+            torch.manual_seed(19920206)
+            model = base_model(opts, downsample=factor, jit_decoder='eager')
+
+            def train():
+                model.zero_grad()
+                model(batch)['loss'].backward()
+
+            model.train()
+            results = [timeit(train, opts.repeat, warmup=1)]
+
+            model.eval()
+            with torch.no_grad():
+                source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+                inputs = model.io_enc.i(source_inputs, pos=True)
+                if model.downsample is not None:
+                    inputs, source_masks = model.downsample(inputs, source_masks)
+                encoding = model.encoder(inputs, source_masks)
+
+                def decode():
+                    return model.greedy_decoding(encoding, source_masks, T=16).size(1)
+
+                steps = decode()
+                results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+            print('{:>6} | {:>10} | {:>8} | '.format(factor, '{}x{}'.format(B, T), inputs.size(1)) + ' | '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_numpy(opts):
+    """ NumPy runtime (tools.export_numpy / tools.numpy_runtime) v.s. greedy decoding in torch: latency per step,
+        and whether the translations are the same. """
+    import numpy as np
+    import tempfile
+    from tools.export_numpy import export
+    from tools.numpy_runtime import Translator
+
+    model = base_model(opts)
+    model.eval()
+    field = model.fields['trg']
+    with tempfile.NamedTemporaryFile(suffix='.npz') as f:
+        np.savez(f.name, **export(model.state_dict(), vars(model.args), field.vocab, field.vocab))
+        start = time.time()
+        translator = Translator(f.name)
+        print('NumPy runtime loaded in {:.3f}s'.format(time.time() - start))
+
+    print('{:>6} | {:>12} {:>12} | {:>12} | {:>6}'.format('B', 'torch', '(jit)', 'numpy', 'same'))
+    for B in opts.batches:
+        batch = DummyBatch(B, opts.lengths[0], opts.vocab_size)
+        batch.src[:, 0] = field.vocab.stoi['<init>']
+        batch.src[:, -1] = field.vocab.stoi['<eos>']
+        results = []
+        with torch.no_grad():
+            source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+            encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+            for mode in ['none', 'eager']:
+                model.args.jit_decoder = mode
+
+                def decode():
+                    return model.greedy_decoding(encoding, source_masks)
+
+                outputs = decode()
+                results.append(timeit(decode, opts.repeat, warmup=1) / outputs.size(1))
+            model.args.jit_decoder = 'none'
+
+        inputs, masks = source_inputs.numpy(), source_masks.numpy()
+
+        def decode():
+            return translator.greedy(*translator.encode(inputs, masks), inputs.shape[1] * translator.config['length_ratio'])
+
+        same = all(best[0][0] == row for best, row in zip(decode(), outputs.tolist()))
+        results.append(timeit(decode, opts.repeat, warmup=1) / outputs.size(1))
+        print('{:>6} | {:>10.3f}ms {:>10.3f}ms | {:>10.3f}ms | {:>6}'.format(B, *results, str(same)))
+
+
+def bench_prune(opts):
+    """ attention head pruning (--mode prune): training step time and greedy decoding latency per step, v.s. the ratio
+        of heads removed. The heads are ranked by their importance on random batches, so only the timing matters. """
+    torch.manual_seed(19920206)
+    model = base_model(opts)
+    B, T = shapes(opts.shapes)[0]
+    batch = DummyBatch(B, T, opts.vocab_size)
+    importance = head_importance(model, [batch])
+
+    print('{:>6} | {:>6} | {:>10} | {:>12} | {:>12}'.format('ratio', 'heads', 'params', 'train', 'step'))
+    for ratio in opts.ratios:
+        pruned = copy.deepcopy(model)
+        heads = prune_heads(pruned, importance, ratio)
+
+        def train():
+            pruned.zero_grad()
+            pruned(batch)['loss'].backward()
+
+        pruned.train()
+        results = [timeit(train, opts.repeat, warmup=1)]
+
+        pruned.eval()
+        pruned.args.jit_decoder = 'eager'
+        with torch.no_grad():
+            source_inputs, _, source_masks, _, _, _ = pruned.prepare_data(DummyBatch(opts.batch, opts.lengths[0], opts.vocab_size))
+            encoding = pruned.encoder(pruned.io_enc.i(source_inputs, pos=True), source_masks)
+
+            def decode():
+                return pruned.greedy_decoding(encoding, source_masks).size(1)
+
+            steps = decode()
+            results.append(timeit(decode, opts.repeat, warmup=1) / steps)
+
+        params = sum(p.numel() for p in pruned.parameters()) / 1e6
+        print('{:>6} | {:>6} | {:>9.1f}M | '.format(ratio, sum(heads.values()), params) + ' | '.join('{:>10.3f}ms'.format(r) for r in results))
+
+
+def bench_beam(opts):
+    """ batched beam search (--beam_size, with the cached keys / values of the single-step decoder) v.s. greedy decoding
+        (width 1): latency per step and sentences per second. A random model rarely ends with <eos>, so every sentence
+        runs to the maximum length: the early termination per sentence is not measured here. """
+    model = base_model(opts, jit_decoder='eager')
+    model.eval()
+    batch = DummyBatch(opts.batch, opts.lengths[0], opts.vocab_size)
+
+    print('{:>6} | {:>6} | {:>12} | {:>12}'.format('width', 'steps', 'step', 'sents/s'))
+    with torch.no_grad():
+        source_inputs, _, source_masks, _, _, _ = model.prepare_data(batch)
+        encoding = model.encoder(model.io_enc.i(source_inputs, pos=True), source_masks)
+        for W in opts.widths:
+
+            def decode():
+                if W == 1:
+                    return model.greedy_decoding(encoding, source_masks, T=source_inputs.size(1)).size(1)
+                return model.beam_search(encoding, source_masks, W, T=source_inputs.size(1))[0].size(1)
+
+            steps = decode()
+            latency = timeit(decode, opts.repeat, warmup=1)
+            print('{:>6} | {:>6} | {:>10.3f}ms | {:>12.2f}'.format(W, steps, latency / steps, opts.batch / latency * 1000))
+
+
+BENCHMARKS = {
+    'positions': bench_positions,
+    'attention': bench_attention,
+    'local': bench_local,
+    'loss': bench_loss,
+    'adaptive': bench_adaptive,
+    'precision': bench_precision,
+    'checkpoint': bench_checkpoint,
+    'reversible': bench_reversible,
+    'quantize': bench_quantize,
+    'step': bench_step,
+    'viterbi': bench_viterbi,
+    'alloc': bench_alloc,
+    'residual': bench_residual,
+    'shortlist': bench_shortlist,
+    'depth': bench_depth,
+    'exit': bench_exit,
+    'average': bench_average,
+    'gqa': bench_gqa,
+    'downsample': bench_downsample,
+    'numpy': bench_numpy,
+    'prune': bench_prune,
+    'beam': bench_beam,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the Transformer components (CPU).')
+    parser.add_argument('benchmark', type=str, choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--shapes', type=str, nargs='*', default=['32x64', '16x128', '64x32'], help='batch_size x length')
+    parser.add_argument('--d_model', type=int, default=512)
+    parser.add_argument('--n_layers', type=int, default=6)
+    parser.add_argument('--layers', type=int, nargs='*', default=[6, 12, 24], help='numbers of layers (checkpoint, reversible)')
+    parser.add_argument('--depths', type=str, nargs='*', default=['12-1', '6-3', '6-6'], help='encoder-decoder layers (depth)')
+    parser.add_argument('--thresholds', type=float, nargs='*', default=[1, 0.999, 0.01, 0], help='early-exit thresholds (exit)')
+    parser.add_argument('--kv_heads', type=int, nargs='*', default=[8, 4, 2, 1], help='numbers of key / value heads (gqa)')
+    parser.add_argument('--factors', type=int, nargs='*', default=[1, 2, 4], help='downsampling factors of the source (downsample)')
+    parser.add_argument('--widths', type=int, nargs='*', default=[1, 4, 6, 8], help='beam sizes, 1: greedy decoding (beam)')
+    parser.add_argument('--ratios', type=float, nargs='*', default=[0, 0.25, 0.5, 0.75], help='ratios of attention heads removed (prune)')
+    parser.add_argument('--every', type=int, nargs='*', default=[0, 1, 2], help='checkpoint every k-th block (checkpoint)')
+    parser.add_argument('--vocab_size', type=int, default=32000)
+    parser.add_argument('--lengths', type=int, nargs='*', default=[256, 512, 1024, 2048], help='sequence lengths (attention; step, alloc, shortlist, depth, exit, gqa, prune, beam: source length; average: output length)')
+    parser.add_argument('--batch', type=int, default=2, help='batch size (attention, decoding steps, depth, exit, average, gqa, prune, beam)')
+    parser.add_argument('--batches', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32, 64], help='batch sizes (step, alloc, shortlist)')
+    parser.add_argument('--chunk', type=int, default=128, help='block size of the chunked attention')
+    parser.add_argument('--causal', action='store_true', help='use causal attention')
+    parser.add_argument('--window', type=int, default=2, help='window of the local attention')
+    parser.add_argument('--width', type=int, default=4, help='block size of the multi-step models (viterbi)')
+    parser.add_argument('--tokens', type=int, nargs='*', default=[2048, 4096, 8192], help='number of target tokens (loss)')
+    parser.add_argument('--loss_chunk', type=int, default=1024, help='slice size of the chunked loss')
+    parser.add_argument('--shortlist_k', type=int, default=10, help='candidates per source word (shortlist)')
+    parser.add_argument('--shortlist_frequent', type=int, default=1000, help='most frequent words in the shortlist (shortlist)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0, help='number of CPU threads (0: use the default)')
+    opts = parser.parse_args()
+
+    if opts.threads > 0:
+        torch.set_num_threads(opts.threads)
+    torch.manual_seed(19920206)
+    BENCHMARKS[opts.benchmark](opts)
@@ -0,0 +1,95 @@
+"""
+-- Export a Transformer checkpoint for the NumPy runtime (tools.numpy_runtime) --
+Run from the root of the repository, e.g.
+
+    python -m tools.export_numpy --checkpoint models/wmt16.pt --vocab data/wmt16/en-ro/vocab.en-ro.s.w.pt \
+        --settings settings/wmt16.json --output models/wmt16.npz
+
+--settings is the json of the hyper-parameters that ez_run.py saves for every run (settings/<prefix><hp_str>.json).
+The parameters are written in float32 with their names, with the configuration and the vocabularies, into one
+(uncompressed) .npz file. Pruned heads (--mode prune), grouped-query attention (--n_kv_heads), the average
+attention (--dec_selfattn average) and the source downsampling (--downsample) are read from the checkpoint.
+"""
+import argparse
+import json
+import numpy as np
+import torch
+
+from models.core import upgrade_state_dict
+
+
+def source_layers(n_dec_layers, n_enc_layers, cross_attn_fashion):   # as Stack.source_layers, over the encoder outputs
+    if cross_attn_fashion == 'last_layer':
+        return [n_enc_layers for _ in range(n_dec_layers)]
+    index = [((l + 1) * n_enc_layers + n_dec_layers - 1) // n_dec_layers for l in range(n_dec_layers)]
+    return index[::-1] if cross_attn_fashion == 'reverse' else index
+
+
+def count_layers(state_dict, prefix):
+    return len({k.split('.')[2] for k in state_dict if k.startswith(prefix + '.layers.')})
+
+
+def export(state_dict, settings, src_vocab, trg_vocab):
+    """ a checkpoint (state_dict), its hyper-parameters and vocabularies --> the arrays of the .npz file """
+    for name in ['reversible_encoder', 'adaptive_softmax', 'causal_enc']:
+        assert not settings.get(name, False), '--{} is not supported by the NumPy runtime.'.format(name)
+    for name in ['input_conv', 'local_attention']:
+        assert settings.get(name, 0) == 0, '--{} is not supported by the NumPy runtime.'.format(name)
+    assert settings.get('multi_width', 1) == 1, 'block-wise decoding is not supported by the NumPy runtime.'
+    assert not any(k.endswith('_packed_params') for k in state_dict), 'export the float checkpoint, not the int8 one.'
+
+    d_model = state_dict['io_dec.out.weight'].size(1)
+    n_enc_layers, n_dec_layers = count_layers(state_dict, 'encoder'), count_layers(state_dict, 'decoder')
+    order = settings.get('block_order', 'tdan')
+
+    heads = dict()   # query heads and key / value heads of every attention (pruned / grouped)
+    for name in [k[:-len('.wqkv.weight')] for k in state_dict if k.endswith('.wqkv.weight')]:
+        n_heads = settings.get('n_cross_heads', 8) if '.crossattn.' in name else settings.get('n_heads', 8)
+        d = d_model // n_heads
+        N = state_dict[name + '.heads'].numel() if (name + '.heads') in state_dict else n_heads
+        heads[name] = [N, (state_dict[name + '.wqkv.weight'].size(0) - N * d) // (2 * d)]
+
+    share_embeddings = torch.equal(state_dict['io_enc.out.weight'], state_dict['io_dec.out.weight']) and (src_vocab.itos == trg_vocab.itos)
+    config = {
+        'd_model': d_model, 'n_enc_layers': n_enc_layers, 'n_dec_layers': n_dec_layers, 'heads': heads,
+        'norm_last': order.index('n') > order.index('a'), 'fused': settings.get('layernorm', 'std') == 'fused', 'eps': 1e-6,
+        'normalize_emb': 'encoder.layernorm.gamma' in state_dict, 'share_embeddings': share_embeddings,
+        'cross_layers': source_layers(n_dec_layers, n_enc_layers, settings.get('cross_attn_fashion', 'forward')),
+        'average': 'decoder.layers.0.selfattn.layer.gates.weight' in state_dict,
+        'downsample': state_dict['downsample.conv.weight'].size(2) if 'downsample.conv.weight' in state_dict else 1,
+        'length_ratio': settings.get('length_ratio', 6), 'base': settings.get('base', 'bpe'),
+        'src_init': not settings.get('remove_enc_eos', False), 'src_eos': not settings.get('remove_enc_eos', False),
+        'specials': {w: trg_vocab.stoi[w] for w in ['<pad>', '<init>', '<eos>', '<unk>']},
+    }
+
+    arrays = {k: v.float().cpu().numpy() for k, v in state_dict.items()
+              if torch.is_tensor(v) and v.is_floating_point() and not (share_embeddings and k == 'io_enc.out.weight')}
+    arrays['__config__'] = np.array(json.dumps(config))
+    arrays['__src_itos__'] = np.array(src_vocab.itos)
+    arrays['__trg_itos__'] = np.array(trg_vocab.itos)
+    return arrays
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a Transformer checkpoint for the NumPy runtime.')
+    parser.add_argument('--checkpoint', type=str, required=True, help='parameters of the model (.pt)')
+    parser.add_argument('--vocab', type=str, required=True, help='vocabulary file (.pt) the model was trained with')
+    parser.add_argument('--settings', type=str, required=True, help='hyper-parameters of the model (.json saved by ez_run.py)')
+    parser.add_argument('--output', type=str, required=True, help='exported model (.npz)')
+    parser.add_argument('--reverse', action='store_true', help='the direction is the reverse of the pair in the vocabulary file')
+    args = parser.parse_args()
+
+    src_vocab, trg_vocab = torch.load(args.vocab)
+    if args.reverse:
+        src_vocab, trg_vocab = trg_vocab, src_vocab
+    state_dict = upgrade_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    with open(args.settings) as f:
+        settings = json.load(f)
+
+    arrays = export(state_dict, settings, src_vocab, trg_vocab)
+    np.savez(args.output, **arrays)
+
+    config = json.loads(str(arrays['__config__']))
+    size = sum(v.nbytes for k, v in arrays.items() if not k.startswith('__'))
+    print('encoder / decoder layers: {} / {}'.format(config['n_enc_layers'], config['n_dec_layers']))
+    print('saved {} ({:.1f}MB, vocabularies {} / {})'.format(args.output, size / 1024 ** 2, len(src_vocab.itos), len(trg_vocab.itos)))
@@ -0,0 +1,356 @@
+"""
+-- Translate with a Transformer exported by tools.export_numpy, using NumPy only --
+Run from the root of the repository, e.g.
+
+    python -m tools.numpy_runtime --model models/wmt16.npz --beam_size 1 < test.bpe.ro > test.en
+
+The source lines are tokenized as in training (--base of the model: BPE words, characters or bytes), and
+the translations are detokenized (<eos> trimmed, BPE merged, bytes decoded). Nothing but NumPy is imported,
+so a translation worker starts fast. The encoder and the greedy decoder (cached keys / values) compute the
+same as Transformer.greedy_decoding, within float32 rounding; --beam_size > 1 runs a batched beam search.
+"""
+import argparse
+import json
+import math
+import sys
+import numpy as np
+
+INF = 1e10
+
+
+# ====================== Layers ==================================================== #
+
+def sinusoid_table(T, d_model):   # as models.core.sinusoid_table (interleaved sin / cos)
+    positions = np.arange(T, dtype=np.float32)
+    channels = 1 / (10000 ** (np.arange(0, d_model, 2, dtype=np.float32) / d_model))
+    encodings = positions[:, None] @ channels[None, :].astype(np.float32)
+    return np.stack([np.sin(encodings), np.cos(encodings)], -1).reshape(T, d_model)
+
+
+def linear(x, weight, bias=None):
+    y = x @ weight.T
+    return y if bias is None else y + bias
+
+
+def layer_norm(x, gamma, beta, eps, fused):
+    mean = x.mean(-1, keepdims=True)
+    if fused:   # biased variance, eps inside the sqrt (--layernorm fused)
+        return gamma * (x - mean) / np.sqrt(x.var(-1, keepdims=True) + eps) + beta
+    return gamma * (x - mean) / (x.std(-1, ddof=1, keepdims=True) + eps) + beta
+
+
+def softmax(x, axis=-1):
+    x = np.exp(x - x.max(axis, keepdims=True))
+    return x / x.sum(axis, keepdims=True)
+
+
+def log_softmax(x, axis=-1):
+    x = x - x.max(axis, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis, keepdims=True))
+
+
+def sigmoid(x):
+    return np.exp(-np.logaddexp(0, -x))
+
+
+def attend(q, key, value, mask, scale):
+    """ q: B x N x Tq x d, key / value: B x G x Tk x d (N / G query heads per key / value head), mask: B x Tk """
+    B, N, Tq, d = q.shape
+    G = key.shape[1]
+    q = q.reshape(B, G, N // G * Tq, d)
+    dots = q @ key.transpose(0, 1, 3, 2)
+    if mask is not None:
+        dots = dots - (1 - mask[:, None, None, :]) * INF
+    outputs = softmax(dots / scale) @ value
+    return outputs.reshape(B, N, Tq, d).transpose(0, 2, 1, 3).reshape(B, Tq, N * d)
+
+
+# ====================== Model ===================================================== #
+
+class Translator(object):
+
+    def __init__(self, path):
+        with np.load(path) as f:
+            self.params = {k: f[k] for k in f.files}
+        self.config = json.loads(str(self.params.pop('__config__')))
+        self.src_itos = list(self.params.pop('__src_itos__'))
+        self.trg_itos = list(self.params.pop('__trg_itos__'))
+        self.src_stoi = {w: i for i, w in enumerate(self.src_itos)}
+
+        c = self.config
+        self.d_model, self.scale, self.eps, self.fused = c['d_model'], math.sqrt(c['d_model']), c['eps'], c['fused']
+        self.src_embed = self.params['io_enc.out.weight' if not c['share_embeddings'] else 'io_dec.out.weight']
+        self.trg_embed = self.params['io_dec.out.weight']
+        self.positions = sinusoid_table(256, self.d_model)
+
+        self.pad, self.init, self.eos = (c['specials'][w] for w in ['<pad>', '<init>', '<eos>'])
+
+    # -- helpers -- #
+    def p(self, name):
+        return self.params[name]
+
+    def position(self, T):
+        if T > self.positions.shape[0]:
+            self.positions = sinusoid_table(max(T, 2 * self.positions.shape[0]), self.d_model)
+        return self.positions[:T]
+
+    def norm(self, x, prefix):
+        return layer_norm(x, self.p(prefix + '.gamma'), self.p(prefix + '.beta'), self.eps, self.fused)
+
+    def residual(self, x, y, prefix):   # the block order, once the dropout is gone
+        if self.config['norm_last']:
+            return self.norm(x + y, prefix + '.layernorm')
+        return x + self.norm(y, prefix + '.layernorm')
+
+    def feedforward(self, x, prefix):
+        h = np.maximum(linear(x, self.p(prefix + '.linear1.weight'), self.p(prefix + '.linear1.bias')), 0)
+        return linear(h, self.p(prefix + '.linear2.weight'), self.p(prefix + '.linear2.bias'))
+
+    def heads(self, prefix):   # number of query heads, key / value heads, and the head size
+        N, G = self.config['heads'][prefix]
+        return N, G, self.p(prefix + '.wo.weight').shape[1] // N
+
+    def split(self, x, n_heads):   # B x T x (n x d) --> B x n x T x d
+        B, T, _ = x.shape
+        return x.reshape(B, T, n_heads, -1).transpose(0, 2, 1, 3)
+
+    def project_kv(self, x, prefix):   # keys / values of the source (cross-attention) or of new positions
+        N, G, d = self.heads(prefix)
+        kv = linear(x, self.p(prefix + '.wqkv.weight')[N * d:], self.p(prefix + '.wqkv.bias')[N * d:])
+        return self.split(kv[..., :G * d], G), self.split(kv[..., G * d:], G)
+
+    def project_q(self, x, prefix):
+        N, G, d = self.heads(prefix)
+        return self.split(linear(x, self.p(prefix + '.wqkv.weight')[:N * d], self.p(prefix + '.wqkv.bias')[:N * d]), N)
+
+    def output(self, h, prefix):
+        return linear(h, self.p(prefix + '.wo.weight'), self.p(prefix + '.wo.bias'))
+
+    # -- encoder -- #
+    def downsample(self, x, mask):
+        weight, bias = self.p('downsample.conv.weight'), self.p('downsample.conv.bias')   # C_out x C_in x K
+        B, T, C = x.shape
+        K = weight.shape[2]
+        pad = (-T) % K
+        x = np.pad(x * mask[:, :, None], ((0, 0), (0, pad), (0, 0)))
+        mask = np.pad(mask, ((0, 0), (0, pad))).reshape(B, -1, K).max(-1)
+        x = x.reshape(B, -1, K * C) @ weight.transpose(2, 1, 0).reshape(K * C, -1) + bias
+        return x, mask
+
+    def encode(self, inputs, mask):
+        x = self.src_embed[inputs] * self.scale + self.position(inputs.shape[1])
+        if self.config['downsample'] > 1:
+            x, mask = self.downsample(x, mask)
+
+        outputs = [x]
+        if self.config['normalize_emb']:
+            x = self.norm(x, 'encoder.layernorm')
+        for l in range(self.config['n_enc_layers']):
+            prefix = 'encoder.layers.{}'.format(l)
+            a = prefix + '.selfattn.layer'
+            key, value = self.project_kv(x, a)
+            x = self.residual(x, self.output(attend(self.project_q(x, a), key, value, mask, self.scale), a), prefix + '.selfattn')
+            x = self.residual(x, self.feedforward(x, prefix + '.feedforward.layer'), prefix + '.feedforward')
+            outputs.append(x)
+        return [outputs[i] for i in self.config['cross_layers']], mask
+
+    # -- decoder -- #
+    def start(self, encoding):   # the state of the decoder: caches of the self-attention, memories of the source
+        B = encoding[0].shape[0]
+        state = {'t': 0, 'memory': [], 'keys': [], 'values': [], 'sums': []}
+        for l in range(self.config['n_dec_layers']):
+            prefix = 'decoder.layers.{}'.format(l)
+            state['memory'].append(self.project_kv(encoding[l], prefix + '.crossattn.layer'))
+            if self.config['average']:
+                state['sums'].append(np.zeros((B, 1, self.d_model), dtype=np.float32))
+            else:
+                _, G, d = self.heads(prefix + '.selfattn.layer')
+                state['keys'].append(np.zeros((B, G, 0, d), dtype=np.float32))
+                state['values'].append(np.zeros((B, G, 0, d), dtype=np.float32))
+        return state
+
+    def reorder(self, state, index):   # beam search: keep the rows (batch x beam) of the live hypotheses
+        for name in ['keys', 'values', 'sums']:
+            state[name] = [x[index] for x in state[name]]
+        state['memory'] = [(k[index], v[index]) for k, v in state['memory']]
+        return state
+
+    def step(self, tokens, state, mask):   # B tokens --> B x |V| logits, the state is updated in place
+        t = state['t']
+        x = (self.trg_embed[tokens] * self.scale + self.position(t + 1)[t])[:, None, :]
+        if self.config['normalize_emb']:
+            x = self.norm(x, 'decoder.layernorm')
+
+        for l in range(self.config['n_dec_layers']):
+            prefix = 'decoder.layers.{}'.format(l)
+            a = prefix + '.selfattn.layer'
+            if self.config['average']:
+                average = (state['sums'][l] + x) / (t + 1)
+                state['sums'][l] = state['sums'][l] + x
+                average = self.feedforward(average, a + '.feedforward')
+                input_gate, forget_gate = np.split(sigmoid(linear(np.concatenate([x, average], -1),
+                                                                  self.p(a + '.gates.weight'), self.p(a + '.gates.bias'))), 2, -1)
+                h = input_gate * x + forget_gate * average
+            else:
+                key, value = self.project_kv(x, a)
+                state['keys'][l] = np.concatenate([state['keys'][l], key], 2)
+                state['values'][l] = np.concatenate([state['values'][l], value], 2)
+                h = self.output(attend(self.project_q(x, a), state['keys'][l], state['values'][l], None, self.scale), a)
+            x = self.residual(x, h, prefix + '.selfattn')
+
+            a = prefix + '.crossattn.layer'
+            key, value = state['memory'][l]
+            x = self.residual(x, self.output(attend(self.project_q(x, a), key, value, mask, self.scale), a), prefix + '.crossattn')
+            x = self.residual(x, self.feedforward(x, prefix + '.feedforward.layer'), prefix + '.feedforward')
+
+        state['t'] = t + 1
+        return linear(x[:, 0], self.trg_embed)
+
+    def greedy(self, encoding, mask, T, alpha=1):   # scored as in beam_search
+        B = mask.shape[0]
+        state = self.start(encoding)
+        outs = np.full((B, 1), self.init, dtype=np.int64)
+        eos_yet = np.zeros(B, dtype=bool)
+        logps, lengths = np.zeros(B, dtype=np.float32), np.zeros(B)
+        for t in range(T):
+            scores = log_softmax(self.step(outs[:, -1], state, mask))
+            preds = scores.argmax(-1)
+            logps += np.where(eos_yet, 0, scores[np.arange(B), preds])
+            lengths += ~eos_yet
+            preds[eos_yet] = self.pad
+            eos_yet |= preds == self.eos
+            outs = np.concatenate([outs, preds[:, None]], 1)
+            if eos_yet.all():
+                break
+        return [[(row.tolist(), logp / length ** alpha)] for row, logp, length in zip(outs[:, 1:], logps, lengths)]
+
+    def beam_search(self, encoding, mask, T, width, alpha=1, n_best=1):
+        """
+        batched beam search: W live hypotheses per sentence, scored by the sum of log-probabilities divided by
+        length ** alpha (the length counts <eos>). A sentence stops once W finished hypotheses beat the best score any of
+        its live ones can still reach, and its rows are dropped from the state. Returns the n-best (tokens, score) of every sentence,
+        as Transformer.beam_search.
+        """
+        B, W = mask.shape[0], width
+        V = self.trg_embed.shape[0]
+        rows = np.repeat(np.arange(B), W)
+        state = self.reorder(self.start(encoding), rows)
+        mask = mask[rows]
+
+        tokens = np.full((B, W, 1), self.init, dtype=np.int64)
+        logps = np.tile(np.array([0] + [-INF] * (W - 1), dtype=np.float32), (B, 1))   # one live hypothesis at first
+        finished = [[] for _ in range(B)]
+        sentences = list(range(B))   # the sentences still searched, in the order of the rows
+
+        for t in range(T):
+            n = len(sentences)
+            scores = log_softmax(self.step(tokens[:, :, -1].reshape(-1), state, mask)).reshape(n, W, V)
+            scores[:, :, self.pad] = -INF
+            scores = (scores + logps[:, :, None]).reshape(n, W * V)
+            candidates = np.argsort(-scores, -1)[:, :2 * W]   # at most W of them end with <eos>
+
+            index, new_tokens, new_logps, keep = [], [], [], []
+            for i, b in enumerate(sentences):
+                live = []
+                for c in candidates[i]:
+                    beam, token, score = c // V, c % V, scores[i, c]
+                    if token == self.eos:
+                        if score > -INF / 2:
+                            finished[b].append((tokens[i, beam, 1:].tolist() + [token], score / (t + 1) ** alpha))
+                    elif score > -INF / 2:
+                        live.append((beam, token, score))
+                    if len(live) == W:
+                        break
+                live += [(0, self.pad, -INF)] * (W - len(live))
+
+                finished[b] = sorted(finished[b], key=lambda x: -x[1])[:max(W, n_best)]
+                best_live = max(score for _, _, score in live)   # only decreases, over a final length in (t + 1, T]
+                best_live = max(best_live / (t + 1) ** alpha, best_live / T ** alpha)
+                if (len(finished[b]) >= W) and (finished[b][W - 1][1] > best_live):
+                    continue
+                keep.append(i)
+                index += [i * W + beam for beam, _, _ in live]
+                new_tokens.append([token for _, token, _ in live])
+                new_logps.append([score for _, _, score in live])
+
+            sentences = [sentences[i] for i in keep]
+            if len(sentences) == 0:
+                break
+            index = np.array(index)
+            tokens = np.concatenate([tokens.reshape(n * W, -1)[index], np.array(new_tokens).reshape(-1, 1)], 1).reshape(len(keep), W, -1)
+            logps = np.array(new_logps, dtype=np.float32)
+            state = self.reorder(state, index)
+            mask = mask[index]
+
+        for i, b in enumerate(sentences):   # the unfinished hypotheses of the sentences still searched
+            finished[b] += [(tokens[i, w, 1:].tolist(), logps[i, w] / (tokens.shape[2] - 1) ** alpha)
+                            for w in range(W) if logps[i, w] > -INF / 2]
+        return [sorted(f, key=lambda x: -x[1])[:n_best] for f in finished]
+
+    # -- text -- #
+    def tokenize(self, line):
+        base = self.config['base']
+        if base == 'byte':
+            words = line.encode('utf-8').hex()
+            words = [words[k: k + 2] for k in range(0, len(words), 2)]
+        elif base == 'char':
+            words = list(line)
+        else:
+            words = line.split()
+        ids = [self.src_stoi.get(w, self.src_stoi['<unk>']) for w in words]
+        if self.config['src_init']:
+            ids = [self.src_stoi['<init>']] + ids
+        if self.config['src_eos']:
+            ids = ids + [self.src_stoi['<eos>']]
+        return ids
+
+    def detokenize(self, ids):
+        words = []
+        for i in ids:
+            if i == self.eos:
+                break
+            if i not in (self.init, self.pad):
+                words.append(self.trg_itos[i])
+        base = self.config['base']
+        if base == 'byte':
+            try:
+                return bytes.fromhex(''.join(words)).decode('utf-8')
+            except Exception:
+                return ''
+        elif base == 'char':
+            return ''.join(words)
+        return ' '.join(words).replace('@@ ', '')
+
+    def translate(self, lines, beam_size=1, alpha=1, n_best=1):
+        """ a batch of source lines --> the n-best (translation, score) of each line """
+        data = [self.tokenize(line) for line in lines]
+        S = max(len(x) for x in data) - 1   # the inputs are data[:-1], masked by data[1:] (as Seq2Seq.prepare_field)
+        inputs = np.array([x[:-1] + [self.pad] * (S + 1 - len(x)) for x in data], dtype=np.int64)
+        mask = np.array([[1] * (len(x) - 1) + [0] * (S + 1 - len(x)) for x in data], dtype=np.float32)
+
+        encoding, mask = self.encode(inputs, mask)
+        T = S * self.config['length_ratio']
+        if beam_size == 1:
+            outputs = self.greedy(encoding, mask, T, alpha)
+        else:
+            outputs = self.beam_search(encoding, mask, T, beam_size, alpha, n_best)
+        return [[(self.detokenize(ids), float(score)) for ids, score in best] for best in outputs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translate with an exported Transformer (NumPy only).')
+    parser.add_argument('--model', type=str, required=True, help='exported model (.npz, tools.export_numpy)')
+    parser.add_argument('--beam_size', type=int, default=1)
+    parser.add_argument('--alpha', type=float, default=1, help='length normalization weights (beam search)')
+    parser.add_argument('--n_best', type=int, default=1, help='translations per line (beam search; tab separated with scores)')
+    parser.add_argument('--batch_size', type=int, default=32, help='sentences per batch')
+    args = parser.parse_args()
+
+    translator = Translator(args.model)
+    lines = [line.strip() for line in sys.stdin]
+    for k in range(0, len(lines), args.batch_size):
+        for best in translator.translate(lines[k: k + args.batch_size], args.beam_size, args.alpha, args.n_best):
+            if args.n_best == 1:
+                print(best[0][0])
+            else:
+                print('\t'.join('{}\t{:.4f}'.format(text, score) for text, score in best))
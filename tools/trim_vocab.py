@@ -0,0 +1,102 @@
+"""
+-- Trim the vocabulary of a checkpoint for one translation direction --
+Run from the root of the repository, e.g.
+
+    python -m tools.trim_vocab --checkpoint models/wmt16.pt --vocab data/wmt16/en-ro/vocab.en-ro.s.w.pt \
+        --corpus data/wmt16/en-ro/train.bpe.ro --src_corpus data/wmt16/en-ro/train.bpe.en --output models/wmt16.ro
+
+The target words kept are the special tokens and the words of --corpus / --tokens; the rows of IO.out
+for all the other words are removed, and the ids are remapped in the (frequency) order of the original
+vocabulary. Only the full softmax with float weights is supported: trim before --mode quantize, and
+not with --adaptive_softmax (its clusters are fixed ranges of the original ids). With shared embeddings (--share_embeddings)
+the encoder reads the same rows, so the words of the source side (--src_corpus / --src_tokens) are kept too.
+
+It writes <output>.pt (parameters) and <output>.vocab.pt (vocabulary), to be decoded with
+--load_from / --vocab_file.
+"""
+import argparse
+import copy
+import torch
+
+from collections import Counter
+
+SPECIALS = ['<unk>', '<pad>', '<init>', '<eos>']
+
+
+def read_words(corpus=None, tokens=None):
+    words = set()
+    for path in [p for p in [corpus, tokens] if p is not None]:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                words.update(line.split())
+    return words
+
+
+def trim(vocab, words):
+    """ a copy of the (torchtext) vocabulary with the given words only; returns it and the kept (old) ids. """
+    keep = [i for i, w in enumerate(vocab.itos) if (w in words) or (w in SPECIALS)]
+
+    new_vocab = copy.copy(vocab)
+    new_vocab.itos = [vocab.itos[i] for i in keep]
+    new_vocab.stoi = copy.copy(vocab.stoi)   # keeps the default (<unk>) of the defaultdict
+    new_vocab.stoi.clear()
+    new_vocab.stoi.update({w: i for i, w in enumerate(new_vocab.itos)})
+    new_vocab.freqs = Counter({w: c for w, c in vocab.freqs.items() if w in new_vocab.stoi})
+    if getattr(vocab, 'vectors', None) is not None:
+        new_vocab.vectors = vocab.vectors[keep]
+    return new_vocab, torch.LongTensor(keep)
+
+
+def trim_rows(state_dict, prefix, keep):   # IO.out.weight (full softmax, float weights)
+    assert not any('_packed_params' in k for k in state_dict), \
+        'quantized checkpoint: trim the vocabulary before --mode quantize.'
+    assert not any((prefix + '.tails.') in k for k in state_dict), \
+        'adaptive softmax ({}.tails): the clusters are fixed ranges of the original ids.'.format(prefix)
+    names = [k for k in state_dict if k.endswith(prefix + '.out.weight')]
+    assert len(names) == 1, 'no output layer ({}.out.weight) found.'.format(prefix)
+    for name in names:
+        state_dict[name] = state_dict[name].index_select(0, keep.to(state_dict[name].device)).clone()
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trim the vocabulary of a checkpoint for one translation direction.')
+    parser.add_argument('--checkpoint', type=str, required=True, help='parameters of the model (.pt)')
+    parser.add_argument('--vocab', type=str, required=True, help='vocabulary file (.pt) the model was trained with')
+    parser.add_argument('--output', type=str, required=True, help='writes <output>.pt and <output>.vocab.pt')
+    parser.add_argument('--corpus', type=str, default=None, help='target-side corpus (tokenized as the model input)')
+    parser.add_argument('--tokens', type=str, default=None, help='allowed target tokens (whitespace separated)')
+    parser.add_argument('--src_corpus', type=str, default=None, help='source-side corpus (shared embeddings)')
+    parser.add_argument('--src_tokens', type=str, default=None, help='allowed source tokens (shared embeddings)')
+    parser.add_argument('--reverse', action='store_true', help='the direction is the reverse of the pair in the vocabulary file')
+    args = parser.parse_args()
+
+    assert (args.corpus is not None) or (args.tokens is not None), 'a target-side corpus or token list is needed.'
+    src_vocab, trg_vocab = torch.load(args.vocab)
+    if args.reverse:
+        src_vocab, trg_vocab = trg_vocab, src_vocab
+    state_dict = torch.load(args.checkpoint, map_location='cpu')
+
+    shared = src_vocab.itos == trg_vocab.itos
+    words = read_words(args.corpus, args.tokens)
+    if shared:
+        assert (args.src_corpus is not None) or (args.src_tokens is not None), \
+            'shared embeddings: the encoder reads the same rows, a source-side corpus or token list is needed.'
+        words |= read_words(args.src_corpus, args.src_tokens)
+
+    new_trg_vocab, keep = trim(trg_vocab, words)
+    names = trim_rows(state_dict, 'io_dec', keep)
+    if shared:
+        new_src_vocab = new_trg_vocab
+        names += trim_rows(state_dict, 'io_enc', keep)
+    else:
+        new_src_vocab = src_vocab
+
+    vocabs = (new_trg_vocab, new_src_vocab) if args.reverse else (new_src_vocab, new_trg_vocab)
+    torch.save(state_dict, args.output + '.pt')
+    torch.save(vocabs, args.output + '.vocab.pt')
+
+    size = sum(v.numel() * v.element_size() for v in state_dict.values() if torch.is_tensor(v))
+    print('target vocabulary: {} -> {} words{}'.format(len(trg_vocab.itos), len(new_trg_vocab.itos), ' (shared)' if shared else ''))
+    print('trimmed: {}'.format(', '.join(names)))
+    print('saved {}.pt ({:.1f}MB) and {}.vocab.pt'.format(args.output, size / 1024 ** 2, args.output))
@@ -166,7 +166,7 @@ def colored_seq(seq, bound, char=False):
         return ''.join(new_seq)
 
 def visualize_attention(seq1, seq2, attention):
-    fig, ax = plt.subplots(figsize=(len(seq1) // 3, len(seq2) // 3), dpi=100)
+    fig, ax = plt.subplots(figsize=(max(len(seq1) // 3, 2), max(len(seq2) // 3, 2)), dpi=100)
     sns.heatmap(attention, ax=ax, cbar=False, cmap=sns.cubehelix_palette(start=2.4, rot=.1, light=1), square=True, xticklabels=seq1, yticklabels=seq2)
     ax.xaxis.tick_top()
     for tick in ax.get_xticklabels():